@@ -0,0 +1,85 @@
+""" Configures APNS transport """
+import os
+import time
+
+environment = os.getenv('ENVIRONMENT')
+
+class APNSTestClient:
+    """ APNS testing client interface """
+
+    sent = []
+
+    def push(self, messages) -> list:
+        """ Adds (token, alert, sound, extra) messages to sent list """
+        for token, alert, sound, extra in messages:
+            self.sent.append({
+                'token': token,
+                'alert': alert,
+                'sound': sound,
+                'extra': extra,
+            })
+        return ['Success'] * len(messages)
+
+class APNSClient:
+    """ Pushes notifications over one long-lived APNS connection """
+
+    EXPIRATION = 30 * 24 * 60 * 60
+
+    def __init__(self):
+        self.connection = None
+
+    def connect(self):
+        """ Opens the connection once and reuses it afterwards """
+        if not self.connection:
+            from push_notifications.apns import _apns_create_socket
+            self.connection = _apns_create_socket()
+        return self.connection
+
+    def push(self, messages) -> list:
+        """
+        Sends (token, alert, sound, extra) messages as HTTP/2 batches.
+        Returns 'Success' or the APNS failure reason for each message.
+        """
+        from apns2.client import Notification
+        from apns2.payload import Payload
+        from push_notifications.conf import get_manager
+
+        topic = get_manager().get_apns_topic()
+        expiration = int(time.time()) + self.EXPIRATION
+        results = [None] * len(messages)
+
+        # APNS reports batch results per token, so a token is sent at most once per batch
+        remaining = list(range(len(messages)))
+        try:
+            while remaining:
+                batch, deferred, tokens = [], [], set()
+                for i in remaining:
+                    token = messages[i][0]
+                    (deferred if token in tokens else batch).append(i)
+                    tokens.add(token)
+
+                notifications = []
+                for i in batch:
+                    token, alert, sound, extra = messages[i]
+                    payload = Payload(alert=alert, sound=sound, custom=extra)
+                    notifications.append(Notification(token=token, payload=payload))
+
+                batch_results = self.connect().send_notification_batch(
+                    notifications, topic, expiration=expiration,
+                )
+                for i in batch:
+                    result = batch_results[messages[i][0]]
+                    results[i] = result[0] if isinstance(result, tuple) else result
+                remaining = deferred
+        except Exception:
+            self.connection = None
+            raise
+
+        return results
+
+apns_auth_key_id = os.environ.get('APNS_AUTH_KEY_ID')
+
+if environment == 'local' or not apns_auth_key_id:
+    apns_client = APNSTestClient()
+else:
+    apns_client = APNSClient()
@@ -12,5 +12,18 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "backend.settings")
+# Request threads do not outlive their request under ASGI
+os.environ.setdefault("CONN_MAX_AGE", "0")
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from users.events import EventStream
+
+event_stream = EventStream()
+
+
+async def application(scope, receive, send):
+    """ Streams user events from /events/ and serves everything else with Django """
+    if scope['type'] == 'http' and scope['path'] == '/events/':
+        return await event_stream(scope, receive, send)
+    return await django_application(scope, receive, send)
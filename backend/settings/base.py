@@ -39,6 +39,13 @@ INSTALLED_APPS = [
     "users",
 ]
 
+# Store user locations as PostGIS points and find candidates by distance.
+# Requires the postgis extension in the database. Can be enabled on an
+# existing database at any time, followed by a migrate
+USE_POSTGIS = os.environ.get('USE_POSTGIS', 'false').lower() == 'true'
+if USE_POSTGIS:
+    INSTALLED_APPS.append("users.postgis")
+
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -114,6 +121,12 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Default user model
 AUTH_USER_MODEL = 'users.User'
 
+# Match users while handling location updates. Disable when run_matcher pairs users instead
+INLINE_MATCHING = os.environ.get('INLINE_MATCHING', 'true').lower() != 'false'
+
+# Seconds location pings are buffered before being written. Zero writes every ping immediately
+LOCATION_FLUSH_INTERVAL = float(os.environ.get('LOCATION_FLUSH_INTERVAL', 2))
+
 # Email details
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
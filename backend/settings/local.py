@@ -9,6 +9,9 @@ DEBUG = True
 # Any host is allowed
 ALLOWED_HOSTS = ['*']
 
+# Write location pings immediately
+LOCATION_FLUSH_INTERVAL = 0
+
 # Database
 # https://docs.djangoproject.com/en/4.0/ref/settings/#databases
 DATABASES = {
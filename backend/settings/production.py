@@ -18,7 +18,11 @@ import django_heroku
 django_heroku.settings(locals())
 
 import dj_database_url
-DATABASES = {'default': dj_database_url.config(conn_max_age=600)}
+# Connections persist across requests on the sync workers. backend.asgi sets
+# CONN_MAX_AGE to 0, as each ASGI request's sync code runs in a thread of its
+# own and persistent connections would pile up one per request thread
+DATABASES = {'default': dj_database_url.config(conn_max_age=int(os.environ.get('CONN_MAX_AGE', 600)))}
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
 
 # TODO: Pictures
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media') 
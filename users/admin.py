@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from users.models import BannedEmail, Category, EmailAuthentication, Interest, NumericalQuestion, PhoneAuthentication, TextAnswerChoice, TextQuestion, User, Match, Notification, NumericalResponse, TextResponse, BaseQuestion, WaitingEmail, Message
+from users.models import BannedEmail, Category, EmailAuthentication, Interest, NumericalQuestion, PhoneAuthentication, TextAnswerChoice, TextQuestion, User, Match, MatchArchive, Notification, NumericalResponse, TextResponse, BaseQuestion, WaitingEmail, Message
 
 admin.site.register(User)
 
@@ -8,6 +8,7 @@ admin.site.register(User)
     EmailAuthentication, 
     PhoneAuthentication, 
     Match, 
+    MatchArchive,
     Notification, 
     NumericalResponse,
     TextResponse,
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "users"
+
+    def ready(self):
+        from django.db.models.signals import pre_delete
+        from users import match_history, survey_catalog
+        from users.models import Match, clear_active_match
+        pre_delete.connect(clear_active_match, sender=Match, dispatch_uid='clear_active_match')
+        match_history.connect_signals()
+        survey_catalog.connect_signals()
@@ -0,0 +1,65 @@
+""" Base view for async endpoints """
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.utils.decorators import classonlymethod
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+
+class AsyncAPIView(View):
+    """
+    Async counterpart of a DRF view for endpoints on the hot path.
+
+    DRF views are synchronous, so under ASGI every request to them holds
+    a thread while it waits on Postgres. Handlers of this view await the
+    database instead, through Django's async ORM or sync_to_async for
+    whole transactions. Requests are authenticated, throttled and parsed
+    with the same DRF settings, and answered with the same JSON bodies
+    and status codes. The sync workers serve them too, running each
+    request's handler in an event loop of its own.
+    """
+    serializer_class = None
+    authentication_classes = api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES
+    throttle_classes = api_settings.DEFAULT_THROTTLE_CLASSES
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Marked rather than wrapped with csrf_exempt, whose wrapper hides
+        # that the view is a coroutine function before Django 5.0.
+        view.csrf_exempt = True
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        request = Request(
+          request,
+          parsers=[parser() for parser in self.parser_classes],
+          authenticators=[authenticator() for authenticator in self.authentication_classes],
+        )
+        try:
+            if not await sync_to_async(self.allow_request)(request):
+                return JsonResponse(
+                  {'detail': 'Request was throttled.'},
+                  status=status.HTTP_429_TOO_MANY_REQUESTS,
+                )
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as error:
+            return JsonResponse({'detail': error.detail}, status=error.status_code)
+
+    def allow_request(self, request) -> bool:
+        """ Whether every throttle lets the request through """
+        return all(
+          throttle_class().allow_request(request, self)
+          for throttle_class in self.throttle_classes
+        )
+
+    def validate(self, request):
+        """ The validated serializer, or the 400 response to answer with """
+        serializer = self.serializer_class(data=request.data)
+        if not serializer.is_valid():
+            return None, JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return serializer, None
@@ -0,0 +1,108 @@
+""" Compact survey answer vectors for compatibility checks """
+import zlib
+from functools import lru_cache
+
+""" Text answers are packed as one fixed-width code per text question """
+LANE_BITS = 16
+LANE_MASK = (1 << LANE_BITS) - 1
+
+""" Year answers that restrict who a user can match with """
+AGE_GROUPS = ("freshman", "graduate")
+
+
+def popcount(bits) -> int:
+    """ Number of set bits """
+    return bin(bits).count('1')
+
+def to_bytes(bits) -> bytes:
+    """ Serializes a bitset for storage """
+    return bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+
+def from_bytes(data) -> int:
+    """ Deserializes a stored bitset """
+    return int.from_bytes(bytes(data or b''), 'little')
+
+def answer_code(answer) -> int:
+    """ Non-zero code identifying a text answer; zero marks unanswered """
+    return zlib.crc32(str(answer).encode()) % LANE_MASK + 1
+
+@lru_cache(maxsize=64)
+def lane_masks(lanes) -> tuple:
+    """ Masks selecting the low and high bits of every lane """
+    low = high = 0
+    for _ in range(lanes):
+        low = (low << LANE_BITS) | (LANE_MASK >> 1)
+        high = (high << LANE_BITS) | (1 << (LANE_BITS - 1))
+    return low, high
+
+def nonzero_lanes(bits, low, high) -> int:
+    """ Sets the high bit of every lane that holds a non-zero code """
+    return (((bits & low) + low) | bits) & high
+
+def encode_numerical(responses) -> tuple:
+    """
+    Encodes (question_id, answer, average) triples as an answered bitset
+    and an above-average bitset, both indexed by question id.
+    """
+    answered = above = 0
+    for question_id, answer, average in responses:
+        answered |= 1 << question_id
+        if answer > average:
+            above |= 1 << question_id
+    return answered, above
+
+def encode_text(responses) -> int:
+    """ Encodes (question_id, answer) pairs as one code per question lane """
+    codes = 0
+    for question_id, answer in responses:
+        shift = question_id * LANE_BITS
+        codes &= ~(LANE_MASK << shift)
+        codes |= answer_code(answer) << shift
+    return codes
+
+def encode_age_group(answers) -> str:
+    """ The age group a user's text answers place them in, if any """
+    for group in AGE_GROUPS:
+        if group in answers:
+            return group
+    return ''
+
+
+class CompatibilityVector:
+    """ Decoded survey answers of a single user """
+
+    def __init__(self, numerical_answered=0, numerical_above=0, text_answers=0, age_group='') -> None:
+        self.numerical_answered = numerical_answered
+        self.numerical_above = numerical_above
+        self.text_answers = text_answers
+        self.age_group = age_group
+
+    @classmethod
+    def from_user(cls, user):
+        """ Decodes the vector stored on a user """
+        return cls(
+            from_bytes(user.numerical_answered),
+            from_bytes(user.numerical_above),
+            from_bytes(user.text_answers),
+            user.age_group,
+        )
+
+    def shared_numerical_count(self, other) -> int:
+        """ Questions both answered on the same side of the average """
+        answered = self.numerical_answered & other.numerical_answered
+        return popcount(answered & ~(self.numerical_above ^ other.numerical_above))
+
+    def shared_text_count(self, other) -> int:
+        """ Questions both answered identically """
+        longest = max(self.text_answers.bit_length(), other.text_answers.bit_length())
+        low, high = lane_masks(-(-longest // LANE_BITS))
+        answered = (
+            nonzero_lanes(self.text_answers, low, high) &
+            nonzero_lanes(other.text_answers, low, high)
+        )
+        different = nonzero_lanes(self.text_answers ^ other.text_answers, low, high)
+        return popcount(answered & ~different)
+
+    def is_age_compatible(self, other) -> bool:
+        """ Restricted age groups only match within themselves """
+        return self.age_group == other.age_group
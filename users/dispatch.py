@@ -0,0 +1,107 @@
+""" Delivers queued notifications outside of the request cycle """
+import logging
+import time
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from users.models import Notification
+
+import sys
+sys.path.append(".")
+from apns_config import apns_client
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationDispatcher:
+    """
+    Drains the notification outbox.
+
+    Views only write Notification rows. The dispatcher claims unsent rows
+    in batches, pushes them and records the outcome, retrying failures
+    with exponential backoff until MAX_ATTEMPTS is reached. A batch that
+    raises is retried whole; devices that fail for a transient reason
+    are retried on their own. Rows are claimed with SKIP LOCKED so
+    several workers can drain concurrently.
+    """
+    BATCH_SIZE = 100
+    MAX_ATTEMPTS = 5
+    BACKOFF = timezone.timedelta(seconds=2)
+
+    def __init__(self, client=apns_client) -> None:
+        self.client = client
+
+    def pending_notifications(self):
+        """ Unsent notifications due for an attempt """
+        return Notification.objects.filter(
+          is_sent=False,
+          attempts__lt=self.MAX_ATTEMPTS,
+          next_attempt_time__lte=timezone.now(),
+        ).order_by('next_attempt_time')
+
+    def backoff(self, attempts) -> timezone.timedelta:
+        """ Delay before the next attempt """
+        return self.BACKOFF * 2**(attempts - 1)
+
+    def dispatch_pending(self) -> int:
+        """ Sends one batch of due notifications and returns its size """
+        with transaction.atomic():
+            notifications = list(
+              self.pending_notifications()
+                .select_for_update(skip_locked=True)[:self.BATCH_SIZE]
+            )
+            if not notifications: return 0
+
+            try:
+                failures = Notification.send_to_devices(notifications, self.client)
+            except Exception as error:
+                logger.warning('notification batch failed: %r', error)
+                for notification in notifications:
+                    self.schedule_retry(notification, error)
+            else:
+                for notification in notifications:
+                    self.record_delivery(notification, failures.get(notification.id, {}))
+
+            Notification.objects.bulk_update(
+              notifications,
+              ['is_sent', 'attempts', 'next_attempt_time', 'last_error', 'retry_tokens'],
+            )
+        return len(notifications)
+
+    def record_delivery(self, notification, device_failures) -> None:
+        """ Marks the notification sent, unless devices failed for a transient reason """
+        transient_failures = {
+          token: reason for token, reason in device_failures.items()
+          if reason not in Notification.PERMANENT_FAILURES
+        }
+        if transient_failures:
+            self.schedule_retry(notification, transient_failures)
+            notification.retry_tokens = list(transient_failures)
+        else:
+            self.mark_sent(notification, device_failures)
+
+    def mark_sent(self, notification, device_failures=None) -> None:
+        """ Records delivery, keeping the reasons any device was not reached """
+        notification.is_sent = True
+        notification.last_error = repr(device_failures) if device_failures else None
+        notification.retry_tokens = None
+
+    def schedule_retry(self, notification, error) -> None:
+        """ Records a failed attempt and backs off before the next one """
+        notification.attempts += 1
+        notification.next_attempt_time = timezone.now() + self.backoff(notification.attempts)
+        notification.last_error = repr(error)
+
+    def run(self, poll_interval=1) -> None:
+        """ Drains the outbox forever, sleeping whenever it is empty or failed """
+        while True:
+            try:
+                drained = self.dispatch_pending() < self.BATCH_SIZE
+            except Exception:
+                logger.exception('notification dispatch failed')
+                drained = True
+            finally:
+                close_old_connections()
+            if drained:
+                time.sleep(poll_interval)
@@ -0,0 +1,243 @@
+""" Server-sent events pushing new messages and notifications to users """
+import asyncio
+import json
+import logging
+import select
+import threading
+import psycopg2
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.http.request import split_domain_port, validate_host
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+logger = logging.getLogger(__name__)
+
+
+class EventListener:
+    """
+    Fans database notifications out to the streams of this process.
+
+    Inserting a Message or Notification fires a trigger that NOTIFYs
+    CHANNEL with the row's id and the ids of the users it concerns, once
+    the inserting transaction commits. A single thread per process
+    LISTENs on its own connection and hands each event to the queues of
+    the users' open streams, reconnecting after RETRY_INTERVAL when the
+    connection drops.
+    """
+    CHANNEL = 'user_events'
+    POLL_INTERVAL = 1
+    RETRY_INTERVAL = 5
+    START_TIMEOUT = 5
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._thread = None
+        self._listening = threading.Event()
+        self._stopping = threading.Event()
+
+    def subscribe(self, user_id) -> asyncio.Queue:
+        """ Queue of the events of the user, delivered on the running loop """
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(
+              (asyncio.get_running_loop(), queue)
+            )
+        return queue
+
+    def unsubscribe(self, user_id, queue) -> None:
+        """ Stops delivering events to the queue """
+        with self._lock:
+            subscribers = self._subscribers.get(user_id, set())
+            subscribers.difference_update({
+              subscriber for subscriber in subscribers if subscriber[1] is queue
+            })
+            if not subscribers:
+                self._subscribers.pop(user_id, None)
+
+    def dispatch(self, event) -> None:
+        """ Hands the event to every stream of the users it concerns """
+        with self._lock:
+            subscribers = [
+              subscriber
+              for user_id in event['users']
+              for subscriber in self._subscribers.get(user_id, ())
+            ]
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    def start(self) -> bool:
+        """ Starts listening, once per process, and waits until it is """
+        with self._lock:
+            if not self._thread:
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return self._listening.wait(self.START_TIMEOUT)
+
+    def stop(self) -> None:
+        """ Stops listening and closes the connection """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if not thread: return
+        self._stopping.set()
+        thread.join()
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+            except Exception:
+                logger.exception('event listener failed')
+                self._stopping.wait(self.RETRY_INTERVAL)
+            finally:
+                self._listening.clear()
+
+    def _listen(self) -> None:
+        listen_connection = psycopg2.connect(**connections['default'].get_connection_params())
+        try:
+            listen_connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with listen_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {self.CHANNEL}')
+            self._listening.set()
+
+            while not self._stopping.is_set():
+                if not select.select([listen_connection], [], [], self.POLL_INTERVAL)[0]:
+                    continue
+                listen_connection.poll()
+                while listen_connection.notifies:
+                    self.dispatch(json.loads(listen_connection.notifies.pop(0).payload))
+        finally:
+            listen_connection.close()
+
+
+event_listener = EventListener()
+
+
+class EventStream:
+    """
+    ASGI application streaming a user's events as server-sent events.
+
+    GET /events/ with an "Authorization: Token <key>" header holds the
+    connection open and writes every new message sent to or by the
+    token's user and every notification queued for them as it is
+    committed, with a comment every HEARTBEAT seconds so proxies keep
+    the connection and closed clients are noticed. Clients that
+    reconnect fetch what they missed with the messages endpoint's
+    since= parameter. The stream is served outside of Django, so it
+    checks the Host header against ALLOWED_HOSTS and authenticates the
+    token itself, as DRF's TokenAuthentication would.
+    """
+    HEARTBEAT = 15
+
+    def __init__(self, listener=event_listener) -> None:
+        self.listener = listener
+
+    async def __call__(self, scope, receive, send) -> None:
+        headers = dict(scope.get('headers', []))
+        if not self.is_allowed_host(headers.get(b'host', b'').decode('latin-1')):
+            await self.reject(send, 400, b'Invalid host')
+            return
+        try:
+            user_id = await sync_to_async(self.authenticate)(
+              headers.get(b'authorization', b'').decode('latin-1'),
+            )
+        except AuthenticationFailed as error:
+            await self.reject(send, 401, str(error.detail).encode(), [(b'www-authenticate', b'Token')])
+            return
+
+        await sync_to_async(self.listener.start, thread_sensitive=False)()
+        queue = self.listener.subscribe(user_id)
+        try:
+            await send({
+              'type': 'http.response.start',
+              'status': 200,
+              'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+              ],
+            })
+            await self.write(send, ': connected\n\n')
+            await self.stream(queue, receive, send)
+        finally:
+            self.listener.unsubscribe(user_id, queue)
+
+    async def stream(self, queue, receive, send) -> None:
+        """ Writes events until the client disconnects """
+        disconnect = asyncio.ensure_future(self.wait_for_disconnect(receive))
+        try:
+            while True:
+                next_event = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait(
+                  {next_event, disconnect},
+                  timeout=self.HEARTBEAT,
+                  return_when=asyncio.FIRST_COMPLETED,
+                )
+                if disconnect in done:
+                    next_event.cancel()
+                    return
+                if next_event not in done:
+                    next_event.cancel()
+                    await self.write(send, ': keepalive\n\n')
+                    continue
+
+                data = await sync_to_async(self.render)(next_event.result())
+                if data is not None:
+                    await self.write(send, data)
+        finally:
+            disconnect.cancel()
+
+    def is_allowed_host(self, host) -> bool:
+        """ Whether Django would accept the Host header """
+        allowed_hosts = settings.ALLOWED_HOSTS
+        if settings.DEBUG and not allowed_hosts:
+            allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+        domain, _ = split_domain_port(host)
+        return bool(domain) and validate_host(domain, allowed_hosts)
+
+    def authenticate(self, authorization) -> int:
+        """ Id of the user the "Token <key>" authorization belongs to """
+        close_old_connections()
+        keyword, _, key = authorization.partition(' ')
+        if keyword != TokenAuthentication.keyword or not key or ' ' in key:
+            raise AuthenticationFailed('Authentication credentials were not provided.')
+        user, _ = TokenAuthentication().authenticate_credentials(key)
+        return user.pk
+
+    async def wait_for_disconnect(self, receive) -> None:
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    def render(self, event) -> str:
+        """ The event as a server-sent event, or None if its row is gone """
+        from users.models import Message, Notification
+        from users.viewsets import MessageSerializer, NotificationSerializer
+
+        close_old_connections()
+        if event['type'] == 'message':
+            message = Message.objects.unexpired().filter(id=event['id']).first()
+            data = MessageSerializer(message).data if message else None
+        else:
+            notification = Notification.objects.filter(id=event['id']).first()
+            data = NotificationSerializer(notification).data if notification else None
+        if data is None: return None
+
+        return (
+          f"event: {event['type']}\n"
+          f"id: {event['type']}-{event['id']}\n"
+          f"data: {json.dumps(data, default=str)}\n\n"
+        )
+
+    async def write(self, send, text) -> None:
+        await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': True})
+
+    async def reject(self, send, status, body, headers=()) -> None:
+        await send({
+          'type': 'http.response.start',
+          'status': status,
+          'headers': [(b'content-type', b'text/plain'), *headers],
+        })
+        await send({'type': 'http.response.body', 'body': body})
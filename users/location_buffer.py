@@ -0,0 +1,123 @@
+""" Write-behind buffer for location pings """
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+logger = logging.getLogger(__name__)
+
+
+class LocationBuffer:
+    """
+    Coalesces location pings before they reach the users table.
+
+    Only the latest ping per user is kept and the buffer is written in
+    batched UPDATE ... FROM (VALUES ...) statements every flush_interval
+    seconds, or as soon as MAX_PENDING users are waiting. A crash loses
+    at most flush_interval seconds of pings. A flush never overwrites a
+    location that is newer in the database. With a flush_interval of
+    zero every ping is written immediately.
+    """
+    MAX_PENDING = 1000
+    BATCH_SIZE = 500
+
+    def __init__(self, flush_interval=2) -> None:
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flusher = None
+
+    def record(self, user) -> None:
+        """ Buffers the user's current coordinates """
+        with self._lock:
+            self._merge({
+              user.pk: (user.latitude, user.longitude, user.loc_update_time),
+            })
+            is_full = len(self._pending) >= self.MAX_PENDING
+
+        if not self.flush_interval or is_full:
+            self.flush()
+        else:
+            self.start()
+
+    def pending(self, user_id) -> tuple:
+        """ Buffered (latitude, longitude, time) of the user, if any """
+        return self._pending.get(user_id)
+
+    def overlay(self, users) -> list:
+        """ Applies buffered coordinates that are newer than the users' own """
+        for user in users:
+            location = self.pending(user.pk)
+            if location and location[2] > user.loc_update_time:
+                user.latitude, user.longitude, user.loc_update_time = location
+        return users
+
+    def flush(self) -> int:
+        """ Writes every buffered location and returns how many were written """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending: return 0
+
+        locations = list(pending.items())
+        try:
+            for start in range(0, len(locations), self.BATCH_SIZE):
+                self._write(locations[start:start + self.BATCH_SIZE])
+        except Exception:
+            with self._lock:
+                self._merge(pending)
+            raise
+        return len(locations)
+
+    def start(self) -> None:
+        """ Starts flushing in the background, once per process """
+        if self._flusher: return
+        with self._lock:
+            if self._flusher: return
+            self._flusher = threading.Thread(target=self._run, daemon=True)
+            self._flusher.start()
+        atexit.register(self.flush)
+
+    def clear(self) -> None:
+        """ Drops every buffered location """
+        with self._lock:
+            self._pending = {}
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('location flush failed')
+            finally:
+                close_old_connections()
+
+    def _merge(self, locations) -> None:
+        for user_id, location in locations.items():
+            current = self._pending.get(user_id)
+            if current and current[2] >= location[2]: continue
+            self._pending[user_id] = location
+
+    def _write(self, locations) -> None:
+        values = ', '.join(['(%s, %s, %s, %s)'] * len(locations))
+        params = []
+        for user_id, (latitude, longitude, update_time) in locations:
+            params += [user_id, latitude, longitude, update_time]
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+              'UPDATE users_user AS users SET '
+              'latitude = locations.latitude, '
+              'longitude = locations.longitude, '
+              'loc_update_time = locations.loc_update_time '
+              f'FROM (VALUES {values}) AS locations (id, latitude, longitude, loc_update_time) '
+              'WHERE users.id = locations.id::bigint '
+              'AND users.loc_update_time < locations.loc_update_time::timestamptz',
+              params,
+            )
+
+
+location_buffer = LocationBuffer(settings.LOCATION_FLUSH_INTERVAL)
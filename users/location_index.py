@@ -0,0 +1,141 @@
+""" In-memory spatial index of recently located users """
+import threading
+from math import floor
+
+from django.utils import timezone
+
+from users.spatial import longitude_delta
+
+
+class LocationIndex:
+    """
+    Uniform grid of recently located, matchable users.
+
+    Users are bucketed into CELL_SIZE degree cells so a proximity lookup
+    only visits the cells overlapping its bounding box instead of scanning
+    the users table. The index is kept in step with location updates made
+    by this process and periodically refreshed from the database so that
+    pings handled by other workers become visible as well.
+    """
+    CELL_SIZE = .001
+    MAX_AGE = timezone.timedelta(minutes=15)
+    REFRESH_INTERVAL = timezone.timedelta(seconds=15)
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._cells = {}
+        self._entries = {}
+        self._last_refresh = None
+
+    def cell(self, latitude, longitude) -> tuple:
+        """ Returns the grid cell containing the coordinates """
+        return (
+          floor(latitude / self.CELL_SIZE),
+          floor(longitude / self.CELL_SIZE),
+        )
+
+    def update(self, user_id, latitude, longitude, time=None) -> None:
+        """ Moves the user to the given coordinates """
+        time = time if time else timezone.now()
+        with self._lock:
+            self._insert(user_id, latitude, longitude, time)
+
+    def remove(self, user_id) -> None:
+        """ Drops the user from the index """
+        with self._lock:
+            self._discard(user_id)
+
+    def update_user(self, user) -> None:
+        """ Indexes the user if they are matchable and recently located """
+        is_located = user.latitude is not None and user.longitude is not None
+        is_recent = timezone.now() - user.loc_update_time <= self.MAX_AGE
+        if user.is_matchable and is_located and is_recent:
+            self.update(user.pk, user.latitude, user.longitude, user.loc_update_time)
+        else:
+            self.remove(user.pk)
+
+    def nearby(self, latitude, longitude, delta=.001, exclude=None) -> list:
+        """
+        Returns ids of recently located users within delta degrees of
+        latitude of the coordinates, and the same distance in longitude.
+        """
+        self.refresh()
+
+        delta_longitude = longitude_delta(latitude, delta)
+        min_row, min_col = self.cell(latitude - delta, longitude - delta_longitude)
+        max_row, max_col = self.cell(latitude + delta, longitude + delta_longitude)
+        oldest_time = timezone.now() - self.MAX_AGE
+
+        nearby_ids = []
+        with self._lock:
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    for user_id in self._cells.get((row, col), ()):
+                        if user_id == exclude: continue
+                        user_latitude, user_longitude, time, _ = self._entries[user_id]
+                        if time < oldest_time: continue
+                        if abs(user_latitude - latitude) > delta: continue
+                        if abs(user_longitude - longitude) > delta_longitude: continue
+                        nearby_ids.append(user_id)
+        return nearby_ids
+
+    def refresh(self, force=False) -> None:
+        """ Merges recently located users from the database and evicts stale ones """
+        now = timezone.now()
+        if (not force
+            and self._last_refresh
+            and now - self._last_refresh < self.REFRESH_INTERVAL):
+            return
+        self._last_refresh = now
+
+        located_users = self.located_users(now).values_list(
+          'id', 'latitude', 'longitude', 'loc_update_time',
+        )
+
+        with self._lock:
+            for user_id, latitude, longitude, time in located_users:
+                entry = self._entries.get(user_id)
+                if entry and entry[2] >= time: continue
+                self._insert(user_id, latitude, longitude, time)
+
+            oldest_time = now - self.MAX_AGE
+            stale_ids = [
+              user_id for user_id, entry in self._entries.items()
+              if entry[2] < oldest_time
+            ]
+            for user_id in stale_ids:
+                self._discard(user_id)
+
+    def located_users(self, now):
+        """ Matchable users located within MAX_AGE of now """
+        from users.models import User
+        return User.objects.filter(
+          is_matchable=True,
+          latitude__isnull=False,
+          longitude__isnull=False,
+          loc_update_time__gte=now - self.MAX_AGE,
+        )
+
+    def clear(self) -> None:
+        """ Empties the index """
+        with self._lock:
+            self._cells = {}
+            self._entries = {}
+            self._last_refresh = None
+
+    def _insert(self, user_id, latitude, longitude, time) -> None:
+        self._discard(user_id)
+        cell = self.cell(latitude, longitude)
+        self._cells.setdefault(cell, set()).add(user_id)
+        self._entries[user_id] = (latitude, longitude, time, cell)
+
+    def _discard(self, user_id) -> None:
+        entry = self._entries.pop(user_id, None)
+        if not entry: return
+        cell = entry[3]
+        self._cells[cell].discard(user_id)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+
+location_index = LocationIndex()
@@ -0,0 +1,53 @@
+""" Compares scalar and vectorized haversine distance calculations """
+import random
+import timeit
+from math import radians, cos, sin, asin, sqrt
+
+from django.core.management.base import BaseCommand
+
+from users.models import haversine_many
+
+
+def scalar_haversine(lon1, lat1, lon2, lat2):
+    """ Pure python haversine, as computed one pair at a time """
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    return 2 * asin(sqrt(a)) * 6371 * 1000
+
+
+class Command(BaseCommand):
+    help = "Benchmarks haversine_many against a scalar haversine loop"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000])
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        latitude, longitude = 34.0224, -118.2851
+
+        for size in options['sizes']:
+            lats = [latitude + random.uniform(-.01, .01) for _ in range(size)]
+            lons = [longitude + random.uniform(-.01, .01) for _ in range(size)]
+
+            scalar_time = min(timeit.repeat(
+                lambda: [
+                    scalar_haversine(longitude, latitude, lon, lat)
+                    for lat, lon in zip(lats, lons)
+                ],
+                number=1,
+                repeat=options['repeat'],
+            ))
+            vectorized_time = min(timeit.repeat(
+                lambda: haversine_many(latitude, longitude, lats, lons),
+                number=1,
+                repeat=options['repeat'],
+            ))
+
+            self.stdout.write(
+                f'{size:>8} candidates: '
+                f'scalar {scalar_time*1000:8.2f}ms  '
+                f'vectorized {vectorized_time*1000:8.2f}ms  '
+                f'speedup {scalar_time/vectorized_time:6.1f}x'
+            )
@@ -0,0 +1,96 @@
+""" Load tests the location update endpoint of a running server """
+import json
+import statistics
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Q
+
+from users.models import Match, MatchArchive, User
+
+""" Requests per benchmark user, below the anonymous throttle rate """
+REQUESTS_PER_USER = 40
+
+
+class Command(BaseCommand):
+    help = (
+      "Sends location updates to a running server from concurrent clients and "
+      "reports throughput and latency. Deletes the users and matches it creates."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=50)
+
+    def handle(self, *args, **options):
+        first_id = (User.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+        user_count = max(2, -(-options['requests'] // REQUESTS_PER_USER))
+        try:
+            self.create_users(first_id, user_count)
+            self.benchmark(first_id, user_count, options)
+        finally:
+            self.clean_up(first_id)
+
+    def benchmark(self, first_id, user_count, options) -> None:
+        url = urlsplit(options['url'])
+        local = threading.local()
+
+        def update_location(i) -> tuple:
+            if not hasattr(local, 'connection'):
+                local.connection = HTTPConnection(url.hostname, url.port, timeout=60)
+            id = first_id + i % user_count
+            body = json.dumps({'email': f'benchmark-{id}@usc.edu', 'latitude': 0, 'longitude': 0})
+            start = time.perf_counter()
+            local.connection.request('PUT', '/update-location/', body, {
+              'Content-Type': 'application/json',
+              # Throttled per client, as a client per user would be
+              'X-Forwarded-For': f'10.{id >> 16 & 255}.{id >> 8 & 255}.{id & 255}',
+            })
+            response = local.connection.getresponse()
+            response.read()
+            return response.status, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            results = list(executor.map(update_location, range(options['requests'])))
+        elapsed = time.perf_counter() - start
+
+        latencies = sorted(latency for _, latency in results)
+        percentiles = statistics.quantiles(latencies, n=100)
+        self.stdout.write(
+          f"{options['requests']} requests, concurrency {options['concurrency']}: "
+          f"{options['requests'] / elapsed:8.1f} req/s  "
+          f"p50 {percentiles[49]*1000:7.1f}ms  "
+          f"p95 {percentiles[94]*1000:7.1f}ms  "
+          f"p99 {percentiles[98]*1000:7.1f}ms"
+        )
+        self.stdout.write(f'  statuses {dict(Counter(status for status, _ in results))}')
+
+    def create_users(self, first_id, count) -> None:
+        """ Matchable users at the same spot, half of them looking for the other half """
+        User.objects.bulk_create([
+          User(
+            id=id,
+            username=f'benchmark-{id}',
+            email=f'benchmark-{id}@usc.edu',
+            phone_number=f'+1{id:010d}',
+            sex_identity=User.SexChoices.MALE if id % 2 else User.SexChoices.FEMALE,
+            sex_preference=User.SexChoices.FEMALE if id % 2 else User.SexChoices.MALE,
+            is_matchable=True,
+            latitude=0,
+            longitude=0,
+          )
+          for id in range(first_id, first_id + count)
+        ])
+
+    def clean_up(self, first_id) -> None:
+        """ Deletes the benchmark's users, their matches and notifications """
+        for model in (MatchArchive, Match):
+            model.objects.filter(Q(user1_id__gte=first_id) | Q(user2_id__gte=first_id)).delete()
+        User.objects.filter(id__gte=first_id).delete()
@@ -0,0 +1,119 @@
+""" Measures match lookups against growing match histories, before and after sweeping """
+import timeit
+from math import ceil, sqrt
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from users.match_history import MatchHistoryCache
+from users.match_sweeper import MatchSweeper
+from users.models import Match, User
+
+""" Users in unexpired matches while measuring """
+ACTIVE_USERS = 200
+
+
+class Command(BaseCommand):
+    help = (
+      "Benchmarks active match lookups with expired matches kept in the match "
+      "table and after archiving them. Deletes the users and matches it creates."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[100000, 10000000])
+        parser.add_argument('--number', type=int, default=100)
+
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            first_id = (User.objects.aggregate(Max('id'))['id__max'] or 0) + 1
+            try:
+                self.benchmark(first_id, size, options['number'])
+            finally:
+                self.clean_up(first_id)
+
+    def benchmark(self, first_id, size, number) -> None:
+        now = timezone.now()
+        user_count = ceil(sqrt(size)) + 1
+        self.create_users(first_id, user_count + ACTIVE_USERS)
+        self.create_history(first_id, user_count, size, now)
+        active_ids = range(first_id + user_count, first_id + user_count + ACTIVE_USERS)
+        Match.objects.bulk_create([
+          Match(user1_id=user1_id, user2_id=user1_id + 1, time=now, initial_notification_sent=True)
+          for user1_id in active_ids[::2]
+        ])
+
+        lookups = {
+          'user active match': lambda: Match.objects.filter(
+            Q(user1_id=active_ids[0]) | Q(user2_id=active_ids[0]),
+            time__gte=now - Match.DURATION,
+          ).exists(),
+          'user history': lambda: MatchHistoryCache().load([first_id]),
+          'all active matches': lambda: Match.objects.filter(
+            time__gte=now - Match.DURATION,
+          ).count(),
+        }
+
+        self.vacuum()
+        before = self.measure(lookups, number)
+        sweep_time = timeit.timeit(lambda: MatchSweeper(now).run_once(), number=1)
+        self.vacuum(full=True)
+        after = self.measure(lookups, number)
+
+        self.stdout.write(f'{size:>10} expired matches: sweep {sweep_time:8.2f}s')
+        for name in lookups:
+            self.stdout.write(
+              f'  {name:<20} unswept {before[name]*1000:8.3f}ms  '
+              f'swept {after[name]*1000:8.3f}ms'
+            )
+
+    def create_users(self, first_id, count) -> None:
+        User.objects.bulk_create([
+          User(
+            id=id,
+            username=f'benchmark-{id}',
+            email=f'benchmark-{id}@usc.edu',
+            phone_number=f'+1{id:010d}',
+            sex_identity=User.SexChoices.MALE,
+            sex_preference=User.SexChoices.FEMALE,
+          )
+          for id in range(first_id, first_id + count)
+        ], batch_size=5000)
+
+    def create_history(self, first_id, user_count, size, now) -> None:
+        """ size distinct pairs matched between two days and a year ago """
+        with connection.cursor() as cursor:
+            cursor.execute(
+              'INSERT INTO users_match (user1_id, user2_id, user1_accepted, user2_accepted, '
+              'initial_notification_sent, accept_notification_sent, time) '
+              'SELECT %(first_id)s + i %% %(users)s, '
+              '%(first_id)s + (i %% %(users)s + i / %(users)s + 1) %% %(users)s, '
+              'false, false, true, false, '
+              "%(now)s - interval '2 days' - random() * interval '363 days' "
+              'FROM generate_series(0, %(size)s - 1) AS i',
+              {'first_id': first_id, 'users': user_count, 'size': size, 'now': now},
+            )
+
+    def clean_up(self, first_id) -> None:
+        """ Deletes the benchmark's users and their matches """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('DELETE FROM users_matcharchive WHERE user1_id >= %s', [first_id])
+            cursor.execute('DELETE FROM users_match WHERE user1_id >= %s', [first_id])
+            cursor.execute('DELETE FROM users_user WHERE id >= %s', [first_id])
+
+    def vacuum(self, full=False) -> None:
+        """
+        Clears dead rows and refreshes statistics, as autovacuum would. A
+        full vacuum also compacts the match table to the size a sweeper
+        running all along would have kept it at.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(f'VACUUM {"FULL " if full else ""}ANALYZE users_match')
+            cursor.execute('VACUUM ANALYZE users_matcharchive')
+
+    def measure(self, lookups, number) -> dict:
+        return {
+          name: min(timeit.repeat(lookup, number=number, repeat=3)) / number
+          for name, lookup in lookups.items()
+        }
@@ -0,0 +1,65 @@
+""" Measures match candidate ranking at increasing candidate counts """
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from users.compatibility import encode_numerical, encode_text, to_bytes
+from users.matching import MatchScorer
+from users.models import User
+
+
+def random_candidate(id, latitude, longitude, now, questions=40) -> User:
+    """ Unsaved user near the location with random survey answers """
+    numerical_answered, numerical_above = encode_numerical([
+        (question_id, random.randint(0, 6), 3)
+        for question_id in range(questions)
+    ])
+    text_answers = encode_text([
+        (question_id, random.choice('abcd'))
+        for question_id in range(questions)
+    ])
+    return User(
+        id=id,
+        latitude=latitude + random.uniform(-.001, .001),
+        longitude=longitude + random.uniform(-.001, .001),
+        loc_update_time=now - timezone.timedelta(seconds=random.randint(0, 900)),
+        numerical_answered=to_bytes(numerical_answered),
+        numerical_above=to_bytes(numerical_above),
+        text_answers=to_bytes(text_answers),
+    )
+
+
+class Command(BaseCommand):
+    help = "Benchmarks MatchScorer.rank over in-memory candidate sets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 10000])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        latitude, longitude = 34.0224, -118.2851
+        now = timezone.now()
+        user = random_candidate(0, latitude, longitude, now)
+
+        for size in options['sizes']:
+            candidates = [
+                random_candidate(id, latitude, longitude, now)
+                for id in range(1, size + 1)
+            ]
+            scorer = MatchScorer(user, latitude, longitude, now=now)
+
+            rank_time = min(timeit.repeat(
+                lambda: scorer.rank(candidates, k=10),
+                number=1,
+                repeat=options['repeat'],
+            ))
+
+            self.stdout.write(
+                f'{size:>8} candidates: '
+                f'rank {rank_time*1000:8.2f}ms  '
+                f'per candidate {rank_time/size*1e6:6.2f}us'
+            )
@@ -0,0 +1,34 @@
+""" Deletes expired chat messages periodically """
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from users.models import Message
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Deletes messages older than the retention period, repeating every interval"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Purge once and exit")
+        parser.add_argument('--interval', type=float, default=60)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['once']:
+            purged = Message.objects.purge_expired(batch_size=options['batch_size'])
+            self.stdout.write(f'purged {purged} messages')
+            return
+
+        while True:
+            try:
+                Message.objects.purge_expired(batch_size=options['batch_size'])
+            except Exception:
+                logger.exception('message purge failed')
+            finally:
+                close_old_connections()
+            time.sleep(options['interval'])
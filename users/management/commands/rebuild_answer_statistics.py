@@ -0,0 +1,19 @@
+""" Recomputes numerical question statistics """
+from django.core.management.base import BaseCommand
+
+from users.models import NumericalQuestion, User
+from users.survey_catalog import survey_catalog
+
+
+class Command(BaseCommand):
+    help = (
+      "Rebuilds the answer count, sum, average and variance of every numerical "
+      "question, then re-encodes users' compatibility vectors against the new averages"
+    )
+
+    def handle(self, *args, **options):
+        rebuilt = NumericalQuestion.rebuild_statistics()
+        survey_catalog.invalidate()
+        self.stdout.write(f'rebuilt statistics of {rebuilt} questions')
+        refreshed = User.refresh_compatibility_vectors()
+        self.stdout.write(f're-encoded compatibility vectors of {refreshed} users')
@@ -0,0 +1,36 @@
+""" Re-encodes compatibility vectors against the current question averages """
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from users.models import User
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+      "Re-encodes every user's above-average answer bits, which drift as averages "
+      "move, repeating every interval"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Refresh once and exit")
+        parser.add_argument('--interval', type=float, default=3600)
+
+    def handle(self, *args, **options):
+        if options['once']:
+            refreshed = User.refresh_compatibility_vectors()
+            self.stdout.write(f're-encoded compatibility vectors of {refreshed} users')
+            return
+
+        while True:
+            try:
+                User.refresh_compatibility_vectors()
+            except Exception:
+                logger.exception('compatibility vector refresh failed')
+            finally:
+                close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,20 @@
+""" Archives expired matches periodically """
+from django.core.management.base import BaseCommand
+
+from users.match_sweeper import MatchSweeper
+
+
+class Command(BaseCommand):
+    help = "Moves expired matches to the match archive, repeating every interval"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Sweep once and exit")
+        parser.add_argument('--interval', type=float, default=60)
+
+    def handle(self, *args, **options):
+        if options['once']:
+            archived = MatchSweeper().run_once()
+            self.stdout.write(f'archived {archived} matches')
+            return
+
+        MatchSweeper.run(interval=options['interval'])
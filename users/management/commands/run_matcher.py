@@ -0,0 +1,20 @@
+""" Pairs nearby users in periodic batches """
+from django.core.management.base import BaseCommand
+
+from users.matching import BatchMatcher
+
+
+class Command(BaseCommand):
+    help = "Matches every recently located user at once, repeating every interval"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Match one snapshot and exit")
+        parser.add_argument('--interval', type=float, default=30)
+
+    def handle(self, *args, **options):
+        if options['once']:
+            matches = BatchMatcher().run_once()
+            self.stdout.write(f'created {len(matches)} matches')
+            return
+
+        BatchMatcher.run(interval=options['interval'])
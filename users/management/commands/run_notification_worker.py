@@ -0,0 +1,26 @@
+""" Pushes queued notifications to devices """
+from django.core.management.base import BaseCommand
+
+from users.dispatch import NotificationDispatcher
+
+
+class Command(BaseCommand):
+    help = "Drains the notification outbox, retrying failed pushes with backoff"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain the outbox once and exit")
+        parser.add_argument('--poll-interval', type=float, default=1)
+
+    def handle(self, *args, **options):
+        dispatcher = NotificationDispatcher()
+
+        if options['once']:
+            sent = 0
+            while True:
+                batch_size = dispatcher.dispatch_pending()
+                sent += batch_size
+                if batch_size < dispatcher.BATCH_SIZE: break
+            self.stdout.write(f'dispatched {sent} notifications')
+            return
+
+        dispatcher.run(poll_interval=options['poll_interval'])
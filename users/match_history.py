@@ -0,0 +1,94 @@
+""" Cache of who each user has matched with """
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+
+
+class MatchHistory:
+    """ Partners a user has matched with """
+
+    def __init__(self, partner_ids=()) -> None:
+        self.partner_ids = frozenset(partner_ids)
+
+    def has_matched(self, user_id) -> bool:
+        """ Whether the user was ever matched with the given user """
+        return user_id in self.partner_ids
+
+
+class MatchHistoryCache:
+    """
+    Per-user match history, kept in Django's cache.
+
+    Entries are dropped whenever a match involving the user is saved or
+    deleted and rebuilt from the match table on the next lookup. Use a
+    shared cache backend when several processes create matches; with a
+    per-process cache an entry can lag by up to TIMEOUT, so callers
+    confirm the match they settle on against the database.
+    """
+    KEY = 'match_partners_{}'
+    TIMEOUT = 60
+
+    def get(self, user_id) -> MatchHistory:
+        """ Match history of one user """
+        return self.get_many([user_id])[user_id]
+
+    def get_many(self, user_ids) -> dict:
+        """ Match histories keyed by user id, loading misses in one query """
+        keys = {self.KEY.format(user_id): user_id for user_id in user_ids}
+        histories = {
+          keys[key]: MatchHistory(partner_ids)
+          for key, partner_ids in cache.get_many(keys).items()
+        }
+
+        missing_ids = [user_id for user_id in user_ids if user_id not in histories]
+        if missing_ids:
+            loaded = self.load(missing_ids)
+            cache.set_many({
+              self.KEY.format(user_id): tuple(history.partner_ids)
+              for user_id, history in loaded.items()
+            }, self.TIMEOUT)
+            histories.update(loaded)
+        return histories
+
+    def matches(self, user_ids):
+        """ Pairs of every match involving the users, archived ones included """
+        from users.models import Match, MatchArchive
+
+        involved = Q(user1_id__in=user_ids) | Q(user2_id__in=user_ids)
+        return Match.objects.filter(involved).values_list('user1_id', 'user2_id').union(
+          MatchArchive.objects.filter(involved).values_list('user1_id', 'user2_id'),
+          all=True,
+        )
+
+    def load(self, user_ids) -> dict:
+        """ Reads the histories of the users from the match and archive tables """
+        partner_ids = {user_id: set() for user_id in user_ids}
+
+        for user1_id, user2_id in self.matches(user_ids):
+            for user_id, partner_id in ((user1_id, user2_id), (user2_id, user1_id)):
+                if user_id in partner_ids:
+                    partner_ids[user_id].add(partner_id)
+
+        return {user_id: MatchHistory(partner_ids[user_id]) for user_id in user_ids}
+
+    def invalidate(self, *user_ids) -> None:
+        """ Drops the cached histories of the users """
+        cache.delete_many([self.KEY.format(user_id) for user_id in user_ids])
+
+
+match_history = MatchHistoryCache()
+
+
+def invalidate_match_history(sender, instance, **kwargs) -> None:
+    """ Invalidates now and again once the change is visible to other processes """
+    user_ids = (instance.user1_id, instance.user2_id)
+    match_history.invalidate(*user_ids)
+    transaction.on_commit(lambda: match_history.invalidate(*user_ids))
+
+def connect_signals() -> None:
+    """ Invalidates both users' histories whenever a match is saved or deleted """
+    from users.models import Match
+
+    post_save.connect(invalidate_match_history, sender=Match, dispatch_uid='match_history_save')
+    post_delete.connect(invalidate_match_history, sender=Match, dispatch_uid='match_history_delete')
@@ -0,0 +1,73 @@
+""" Moves expired matches out of the match table """
+import logging
+import time
+
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from users.models import Match
+
+logger = logging.getLogger(__name__)
+
+
+class MatchSweeper:
+    """
+    Archives matches once they expire.
+
+    Each batch is a single statement that deletes up to BATCH_SIZE
+    matches older than Match.DURATION, copies them into MatchArchive and
+    releases the active match pointers still referring to them. Batches
+    skip rows locked by a concurrent accept, which are picked up by the
+    next run. The match table then only holds roughly a day of matches,
+    however long the history gets; lookups of who ever matched read
+    both tables.
+    """
+    BATCH_SIZE = 1000
+
+    COLUMNS = (
+      'id, user1_id, user2_id, user1_accepted, user2_accepted, '
+      'initial_notification_sent, accept_notification_sent, time'
+    )
+
+    def __init__(self, now=None) -> None:
+        self.now = now if now else timezone.now()
+
+    def sweep_batch(self) -> int:
+        """ Archives one batch of expired matches and returns its size """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(
+              'WITH expired AS ('
+              '  DELETE FROM users_match WHERE id IN ('
+              '    SELECT id FROM users_match WHERE time <= %s '
+              '    ORDER BY time LIMIT %s FOR UPDATE SKIP LOCKED'
+              f'  ) RETURNING {self.COLUMNS}'
+              '), released AS ('
+              '  UPDATE users_user SET active_match_id = NULL, active_match_expires_at = NULL '
+              '  WHERE active_match_id IN (SELECT id FROM expired)'
+              ') '
+              f'INSERT INTO users_matcharchive ({self.COLUMNS}) '
+              f'SELECT {self.COLUMNS} FROM expired',
+              [self.now - Match.DURATION, self.BATCH_SIZE],
+            )
+            return cursor.rowcount
+
+    def run_once(self) -> int:
+        """ Archives every expired match and returns how many were archived """
+        archived = 0
+        while True:
+            batch = self.sweep_batch()
+            archived += batch
+            if batch < self.BATCH_SIZE:
+                return archived
+
+    @classmethod
+    def run(cls, interval=60) -> None:
+        """ Archives expired matches every interval seconds, forever """
+        while True:
+            try:
+                cls().run_once()
+            except Exception:
+                logger.exception('match sweep failed')
+            finally:
+                close_old_connections()
+            time.sleep(interval)
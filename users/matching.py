@@ -0,0 +1,294 @@
+""" Scores, ranks and pairs nearby users as match candidates """
+import time
+from math import floor
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from users.compatibility import CompatibilityVector
+from users.match_history import match_history
+from users.models import Match, MatchArchive, Notification, User, haversine_many
+from users.spatial import longitude_delta
+
+
+class ScoredCandidate:
+    """ A match candidate with the components of its score """
+
+    def __init__(self, user, score, distance, shared_numerical, shared_text) -> None:
+        self.user = user
+        self.score = score
+        self.distance = distance
+        self.shared_numerical = shared_numerical
+        self.shared_text = shared_text
+
+    def sort_key(self) -> tuple:
+        """ Best score first, then nearest, then lowest id """
+        return (-self.score, self.distance, self.user.pk)
+
+
+class MatchScorer:
+    """
+    Ranks candidates for a user at a location.
+
+    Candidates must be age compatible and share at least MINIMUM_SHARED_*
+    answers with the user. Each remaining candidate scores a weighted sum
+    of its shared answers, how close it is within MAX_DISTANCE meters and
+    how recently it was located within MAX_AGE. Ties are broken by
+    distance and then by id, so a ranking only depends on its inputs.
+    """
+    NUMERICAL_WEIGHT = 1
+    TEXT_WEIGHT = 2
+    DISTANCE_WEIGHT = 3
+    FRESHNESS_WEIGHT = 1
+
+    MAX_DISTANCE = 200
+    MAX_AGE = timezone.timedelta(minutes=15)
+    MINIMUM_SHARED_NUMERICAL = 1
+    MINIMUM_SHARED_TEXT = 1
+
+    """ Most recently located candidates fetched for a single ranking """
+    MAX_CANDIDATES = 500
+
+    def __init__(self, user, latitude, longitude, now=None) -> None:
+        self.user = user
+        self.latitude = latitude
+        self.longitude = longitude
+        self.now = now if now else timezone.now()
+        self.vector = CompatibilityVector.from_user(user)
+
+    def score(self, candidates) -> list:
+        """ Scores every eligible candidate, in candidate order """
+        candidates = list(candidates)
+        if not candidates: return []
+
+        distances = haversine_many(
+          self.latitude,
+          self.longitude,
+          [candidate.latitude for candidate in candidates],
+          [candidate.longitude for candidate in candidates],
+        )
+        proximities = np.clip(1 - distances / self.MAX_DISTANCE, 0, 1)
+        ages = np.array([
+          (self.now - candidate.loc_update_time).total_seconds()
+          for candidate in candidates
+        ])
+        freshnesses = np.clip(1 - ages / self.MAX_AGE.total_seconds(), 0, 1)
+
+        scored_candidates = []
+        for i, candidate in enumerate(candidates):
+            if np.isnan(distances[i]): continue
+
+            vector = CompatibilityVector.from_user(candidate)
+            if not self.vector.is_age_compatible(vector): continue
+            shared_numerical = self.vector.shared_numerical_count(vector)
+            if shared_numerical < self.MINIMUM_SHARED_NUMERICAL: continue
+            shared_text = self.vector.shared_text_count(vector)
+            if shared_text < self.MINIMUM_SHARED_TEXT: continue
+
+            score = (
+              self.NUMERICAL_WEIGHT * shared_numerical +
+              self.TEXT_WEIGHT * shared_text +
+              self.DISTANCE_WEIGHT * float(proximities[i]) +
+              self.FRESHNESS_WEIGHT * float(freshnesses[i])
+            )
+            scored_candidates.append(ScoredCandidate(
+              user=candidate,
+              score=score,
+              distance=float(distances[i]),
+              shared_numerical=shared_numerical,
+              shared_text=shared_text,
+            ))
+        return scored_candidates
+
+    def rank(self, candidates, k=1) -> list:
+        """ The k best scoring candidates, best first """
+        scored_candidates = self.score(candidates)
+        scored_candidates.sort(key=ScoredCandidate.sort_key)
+        return scored_candidates[:k]
+
+
+class BatchMatcher:
+    """
+    Pairs every recently located, matchable user at once.
+
+    Takes a snapshot of users located within MAX_AGE who are not in an
+    unexpired match and joins them on a grid of DELTA degree cells, the
+    same neighbourhood a location update searches. Every mutually
+    preferred pair that has never matched is weighted by its scores in
+    both directions, and pairs are picked greedily by weight so nobody
+    gets more than one new match per run.
+    """
+    MAX_AGE = timezone.timedelta(minutes=15)
+    DELTA = .001
+
+    def __init__(self, now=None) -> None:
+        self.now = now if now else timezone.now()
+
+    def candidates(self):
+        """ Recently located, matchable users without an unexpired match """
+        return User.objects.filter(
+          Q(is_matchable=True)&
+          Q(latitude__isnull=False)&
+          Q(longitude__isnull=False)&
+          Q(loc_update_time__gte=self.now - self.MAX_AGE)&
+          (Q(active_match_expires_at__isnull=True) | Q(active_match_expires_at__lte=self.now))
+        ).order_by('id')
+
+    def snapshot(self) -> list:
+        """ The candidates as of now """
+        return list(self.candidates())
+
+    def past_pairs(self, users) -> set:
+        """ Id pairs of users in the snapshot who have matched before """
+        user_ids = [user.id for user in users]
+        among_users = Q(user1_id__in=user_ids) & Q(user2_id__in=user_ids)
+        matches = Match.objects.filter(among_users).values_list('user1_id', 'user2_id').union(
+          MatchArchive.objects.filter(among_users).values_list('user1_id', 'user2_id'),
+          all=True,
+        )
+        return {
+          (min(user1_id, user2_id), max(user1_id, user2_id))
+          for user1_id, user2_id in matches
+        }
+
+    def cell(self, user) -> tuple:
+        """ Grid cell containing the user """
+        return floor(user.latitude / self.DELTA), floor(user.longitude / self.DELTA)
+
+    def neighbours(self, users) -> dict:
+        """ Nearby, mutually preferred users of every user, keyed by user id """
+        cells = {}
+        for user in users:
+            cells.setdefault(self.cell(user), []).append(user)
+
+        neighbours = {}
+        for user in users:
+            row, col = self.cell(user)
+            delta_longitude = longitude_delta(user.latitude, self.DELTA)
+            min_col = floor((user.longitude - delta_longitude) / self.DELTA)
+            max_col = floor((user.longitude + delta_longitude) / self.DELTA)
+            neighbours[user.id] = [
+              other
+              for other_row in (row - 1, row, row + 1)
+              for other_col in range(min_col, max_col + 1)
+              for other in cells.get((other_row, other_col), ())
+              if other.id != user.id
+              and abs(other.latitude - user.latitude) <= self.DELTA
+              and abs(other.longitude - user.longitude) <= delta_longitude
+              and other.sex_identity == user.sex_preference
+              and other.sex_preference == user.sex_identity
+            ]
+        return neighbours
+
+    def pair_weights(self, users) -> dict:
+        """ Combined score of every eligible pair, keyed by ordered id pair """
+        past_pairs = self.past_pairs(users)
+        neighbours = self.neighbours(users)
+
+        scores = {}
+        for user in users:
+            scorer = MatchScorer(user, user.latitude, user.longitude, now=self.now)
+            for candidate in scorer.score(neighbours[user.id]):
+                scores[(user.id, candidate.user.id)] = candidate.score
+
+        weights = {}
+        for (user_id, other_id), score in scores.items():
+            pair = (min(user_id, other_id), max(user_id, other_id))
+            if pair in past_pairs: continue
+            if (other_id, user_id) not in scores: continue
+            weights[pair] = score + scores[(other_id, user_id)]
+        return weights
+
+    def pair(self, weights) -> list:
+        """ Greedy maximum weight matching: heaviest pairs first, each user once """
+        paired_ids = set()
+        pairs = []
+        for (user1_id, user2_id), _ in sorted(
+            weights.items(), key=lambda item: (-item[1], item[0])):
+            if user1_id in paired_ids or user2_id in paired_ids: continue
+            paired_ids.update((user1_id, user2_id))
+            pairs.append((user1_id, user2_id))
+        return pairs
+
+    def claim(self, pairs) -> list:
+        """
+        Pairs whose users are both still free to match. Users are locked
+        with FOR NO KEY UPDATE SKIP LOCKED, like Match.objects.claim, so a
+        pair loses to an inline match made or in progress since the
+        snapshot. Must run inside the transaction creating the matches.
+        """
+        claimed_ids = set(
+          User.objects.select_for_update(skip_locked=True, no_key=True).filter(
+            Q(pk__in=[user_id for pair in pairs for user_id in pair])&
+            (Q(active_match_expires_at__isnull=True) | Q(active_match_expires_at__lte=self.now))
+          ).order_by('pk').values_list('pk', flat=True)
+        )
+        return [
+          (user1_id, user2_id) for user1_id, user2_id in pairs
+          if user1_id in claimed_ids and user2_id in claimed_ids
+        ]
+
+    def create_matches(self, pairs, users_by_id) -> list:
+        """ Creates the matches of the pairs still free to match, and their notifications, in bulk """
+        if not pairs: return []
+
+        with transaction.atomic():
+            pairs = self.claim(pairs)
+            if not pairs: return []
+
+            matches = []
+            for user1_id, user2_id in pairs:
+                user1, user2 = sorted(
+                  [users_by_id[user1_id], users_by_id[user2_id]],
+                  key=lambda user: user.email,
+                )
+                matches.append(Match(
+                  user1=user1,
+                  user2=user2,
+                  time=self.now,
+                  initial_notification_sent=True,
+                ))
+            Match.objects.bulk_create(matches)
+            matched_users = []
+            for match in matches:
+                for user in (match.user1, match.user2):
+                    user.active_match = match
+                    user.active_match_expires_at = match.expires_at()
+                    matched_users.append(user)
+            User.objects.bulk_update(matched_users, ['active_match', 'active_match_expires_at'])
+
+            matched_ids = [user_id for pair in pairs for user_id in pair]
+            match_history.invalidate(*matched_ids)
+            transaction.on_commit(lambda: match_history.invalidate(*matched_ids))
+            notifications = [
+              match.initial_match_notifications()
+              for match in matches
+            ]
+            Notification.objects.bulk_create([
+              notification
+              for match_notifications in notifications
+              for notification in match_notifications
+            ])
+
+        for match, (notification1, notification2) in zip(matches, notifications):
+            match.send_match_create_to_mixpanel(
+              notification1.data,
+              notification2.data,
+              notification1.data['compatibility'],
+            )
+        return matches
+
+    def run_once(self) -> list:
+        """ Matches the current snapshot and returns the new matches """
+        users = self.snapshot()
+        pairs = self.pair(self.pair_weights(users))
+        return self.create_matches(pairs, {user.id: user for user in users})
+
+    @classmethod
+    def run(cls, interval=30) -> None:
+        """ Matches a fresh snapshot every interval seconds, forever """
+        while True:
+            cls().run_once()
+            time.sleep(interval)
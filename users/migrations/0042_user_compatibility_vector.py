@@ -0,0 +1,63 @@
+# Generated by Django 4.1.7 on 2026-10-18 00:16
+
+from django.db import migrations, models
+
+from users.compatibility import (
+    encode_age_group,
+    encode_numerical,
+    encode_text,
+    to_bytes,
+)
+
+
+def encode_compatibility_vectors(apps, schema_editor):
+    User = apps.get_model("users", "User")
+    NumericalResponse = apps.get_model("users", "NumericalResponse")
+    TextResponse = apps.get_model("users", "TextResponse")
+
+    for user in User.objects.all():
+        numerical_responses = NumericalResponse.objects.filter(
+            user_id=user.id
+        ).values_list("question_id", "answer", "question__average")
+        text_responses = TextResponse.objects.filter(user_id=user.id).values_list(
+            "question_id", "answer"
+        )
+
+        numerical_answered, numerical_above = encode_numerical(numerical_responses)
+        User.objects.filter(id=user.id).update(
+            numerical_answered=to_bytes(numerical_answered),
+            numerical_above=to_bytes(numerical_above),
+            text_answers=to_bytes(encode_text(text_responses)),
+            age_group=encode_age_group([answer for _, answer in text_responses]),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0041_interest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="age_group",
+            field=models.TextField(blank=True, default=""),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="numerical_above",
+            field=models.BinaryField(default=bytes),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="numerical_answered",
+            field=models.BinaryField(default=bytes),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="text_answers",
+            field=models.BinaryField(default=bytes),
+        ),
+        migrations.RunPython(encode_compatibility_vectors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.1.7 on 2026-10-18 00:17
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def mark_existing_notifications_sent(apps, schema_editor):
+    """Notifications created before the outbox were pushed synchronously"""
+    Notification = apps.get_model("users", "Notification")
+    Notification.objects.update(is_sent=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0042_user_compatibility_vector"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="attempts",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="notification",
+            name="is_sent",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="notification",
+            name="last_error",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="notification",
+            name="next_attempt_time",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(
+            mark_existing_notifications_sent, migrations.RunPython.noop
+        ),
+        migrations.AddIndex(
+            model_name="notification",
+            index=models.Index(
+                condition=models.Q(("is_sent", False)),
+                fields=["next_attempt_time"],
+                name="notification_outbox_idx",
+            ),
+        ),
+    ]
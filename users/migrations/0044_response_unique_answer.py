@@ -0,0 +1,45 @@
+# Generated by Django 4.1.7 on 2026-10-18 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0043_notification_outbox"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+            DELETE FROM users_numericalresponse older
+            USING users_numericalresponse newer
+            WHERE older.user_id = newer.user_id
+            AND older.question_id = newer.question_id
+            AND older.id < newer.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            """
+            DELETE FROM users_textresponse older
+            USING users_textresponse newer
+            WHERE older.user_id = newer.user_id
+            AND older.question_id = newer.question_id
+            AND older.id < newer.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name="numericalresponse",
+            constraint=models.UniqueConstraint(
+                fields=("user", "question"), name="unique_numerical_response"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="textresponse",
+            constraint=models.UniqueConstraint(
+                fields=("user", "question"), name="unique_text_response"
+            ),
+        ),
+    ]
@@ -0,0 +1,107 @@
+# Generated by Django 4.1.7 on 2026-10-18 00:25
+
+from django.db import migrations, models
+
+CREATE_TRIGGER = """
+CREATE FUNCTION users_numericalquestion_add_answer(
+    question bigint, count_delta integer, sum_delta double precision, squares_delta double precision
+) RETURNS void AS $$
+    UPDATE users_numericalquestion SET
+      answer_count = answer_count + count_delta,
+      answer_sum = answer_sum + sum_delta,
+      answer_sum_of_squares = answer_sum_of_squares + squares_delta,
+      average = CASE WHEN answer_count + count_delta > 0
+        THEN (answer_sum + sum_delta) / (answer_count + count_delta)
+        ELSE average END,
+      variance = CASE WHEN answer_count + count_delta > 0
+        THEN GREATEST(
+          (answer_sum_of_squares + squares_delta) / (answer_count + count_delta)
+          - power((answer_sum + sum_delta) / (answer_count + count_delta), 2),
+          0
+        )
+        ELSE variance END
+    WHERE id = question;
+$$ LANGUAGE sql;
+
+CREATE FUNCTION users_numericalresponse_statistics() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.question_id = NEW.question_id THEN
+        PERFORM users_numericalquestion_add_answer(
+          NEW.question_id, 0, NEW.answer - OLD.answer, NEW.answer ^ 2 - OLD.answer ^ 2
+        );
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM users_numericalquestion_add_answer(
+          OLD.question_id, -1, -OLD.answer, -(OLD.answer ^ 2)
+        );
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') THEN
+        PERFORM users_numericalquestion_add_answer(
+          NEW.question_id, 1, NEW.answer, NEW.answer ^ 2
+        );
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_numericalresponse_statistics
+AFTER INSERT OR UPDATE OF answer, question_id OR DELETE ON users_numericalresponse
+FOR EACH ROW EXECUTE FUNCTION users_numericalresponse_statistics();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER users_numericalresponse_statistics ON users_numericalresponse;
+DROP FUNCTION users_numericalresponse_statistics();
+DROP FUNCTION users_numericalquestion_add_answer(bigint, integer, double precision, double precision);
+"""
+
+REBUILD_STATISTICS = """
+UPDATE users_numericalquestion question SET
+  answer_count = stats.answer_count,
+  answer_sum = stats.answer_sum,
+  answer_sum_of_squares = stats.answer_sum_of_squares,
+  average = stats.answer_sum / stats.answer_count,
+  variance = GREATEST(
+    stats.answer_sum_of_squares / stats.answer_count
+    - power(stats.answer_sum / stats.answer_count, 2),
+    0
+  )
+FROM (
+  SELECT
+    question_id,
+    COUNT(*) AS answer_count,
+    SUM(answer) AS answer_sum,
+    SUM(answer * answer) AS answer_sum_of_squares
+  FROM users_numericalresponse
+  GROUP BY question_id
+) stats
+WHERE question.id = stats.question_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0044_response_unique_answer"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="numericalquestion",
+            name="answer_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="numericalquestion",
+            name="answer_sum",
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name="numericalquestion",
+            name="answer_sum_of_squares",
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+        migrations.RunSQL(REBUILD_STATISTICS, migrations.RunSQL.noop),
+    ]
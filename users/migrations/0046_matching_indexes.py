@@ -0,0 +1,39 @@
+# Generated by Django 4.1.7 on 2026-10-18 00:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0045_numerical_question_statistics"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="match",
+            index=models.Index(fields=["user1", "time"], name="match_user1_time_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="match",
+            index=models.Index(fields=["user2", "time"], name="match_user2_time_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="user",
+            index=models.Index(
+                condition=models.Q(
+                    ("is_matchable", True),
+                    ("latitude__isnull", False),
+                    ("longitude__isnull", False),
+                ),
+                fields=["loc_update_time"],
+                name="user_matchable_located_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="user",
+            index=models.Index(
+                fields=["latitude", "longitude"], name="user_location_idx"
+            ),
+        ),
+    ]
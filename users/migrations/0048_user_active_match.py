@@ -0,0 +1,54 @@
+# Generated by Django 4.1.7 on 2026-10-18 00:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BACKFILL_ACTIVE_MATCHES = """
+UPDATE users_user AS users SET
+  active_match_id = active.match_id,
+  active_match_expires_at = active.time + interval '1 day'
+FROM (
+    SELECT DISTINCT ON (user_id) user_id, match_id, time
+    FROM (
+        SELECT user1_id AS user_id, id AS match_id, time FROM users_match
+        UNION ALL
+        SELECT user2_id AS user_id, id AS match_id, time FROM users_match
+    ) AS matches
+    WHERE time > now() - interval '1 day'
+    ORDER BY user_id, time DESC, match_id DESC
+) AS active
+WHERE users.id = active.user_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0046_matching_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="active_match",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="users.match",
+            ),
+        ),
+        migrations.AddField(
+            model_name="user",
+            name="active_match_expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="user",
+            index=models.Index(
+                fields=["active_match_expires_at"], name="user_active_match_idx"
+            ),
+        ),
+        migrations.RunSQL(BACKFILL_ACTIVE_MATCHES, migrations.RunSQL.noop),
+    ]
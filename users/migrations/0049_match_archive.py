@@ -0,0 +1,52 @@
+# Generated by Django 4.1.7 on 2026-10-18 00:39
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0048_user_active_match"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MatchArchive",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("user1_accepted", models.BooleanField(default=False)),
+                ("user2_accepted", models.BooleanField(default=False)),
+                ("initial_notification_sent", models.BooleanField(default=False)),
+                ("accept_notification_sent", models.BooleanField(default=False)),
+                ("time", models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="match",
+            index=models.Index(fields=["time"], name="match_time_idx"),
+        ),
+        migrations.AddField(
+            model_name="matcharchive",
+            name="user1",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="archived_match1",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddField(
+            model_name="matcharchive",
+            name="user2",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="archived_match2",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterUniqueTogether(
+            name="matcharchive",
+            unique_together={("user1", "user2")},
+        ),
+    ]
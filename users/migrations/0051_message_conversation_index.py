@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-18 01:41
+
+from django.db import migrations, models
+import django.db.models.functions.comparison
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0050_message_retention"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                django.db.models.functions.comparison.Least("sender", "receiver"),
+                django.db.models.functions.comparison.Greatest("sender", "receiver"),
+                models.F("timestamp"),
+                name="message_conversation_idx",
+            ),
+        ),
+    ]
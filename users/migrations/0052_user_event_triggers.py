@@ -0,0 +1,53 @@
+# Generated by Django 4.1.7 on 2026-10-18 01:52
+
+from django.db import migrations
+
+CREATE_TRIGGERS = """
+CREATE FUNCTION users_message_notify_event() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('user_events', json_build_object(
+      'type', 'message',
+      'id', NEW.id,
+      'users', json_build_array(NEW.sender_id, NEW.receiver_id)
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_message_notify_event
+AFTER INSERT ON users_message
+FOR EACH ROW EXECUTE FUNCTION users_message_notify_event();
+
+CREATE FUNCTION users_notification_notify_event() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('user_events', json_build_object(
+      'type', 'notification',
+      'id', NEW.id,
+      'users', json_build_array(NEW.user_id)
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_notification_notify_event
+AFTER INSERT ON users_notification
+FOR EACH ROW EXECUTE FUNCTION users_notification_notify_event();
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER users_notification_notify_event ON users_notification;
+DROP FUNCTION users_notification_notify_event();
+DROP TRIGGER users_message_notify_event ON users_message;
+DROP FUNCTION users_message_notify_event();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0051_message_conversation_index"),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
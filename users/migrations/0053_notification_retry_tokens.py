@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 02:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0052_user_event_triggers"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="retry_tokens",
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
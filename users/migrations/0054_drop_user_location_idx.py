@@ -0,0 +1,17 @@
+# Generated by Django 4.1.7 on 2026-10-18 02:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("users", "0053_notification_retry_tokens"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="user",
+            name="user_location_idx",
+        ),
+    ]
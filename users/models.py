@@ -2,19 +2,26 @@
 import copy
 import os
 import random
+from collections import defaultdict
 from uuid import uuid4
 
+import numpy as np
 from datetime import datetime, timedelta
-from django.db import models
+from django.db import connection, models, transaction
 from django.db.models import Q
+from django.db.models.functions import Greatest, Least
 from django.contrib.auth.models import AbstractUser
 from django.contrib.postgres.fields import ArrayField
 from django.utils import timezone
+from apns_config import apns_client
 from mp_config import MixpanelClient
-from math import radians, cos, sin, asin, sqrt
 from phonenumber_field.modelfields import PhoneNumberField
 from push_notifications.models import APNSDevice
 from rest_framework.authtoken.models import Token
+from users.compatibility import encode_age_group, encode_numerical, encode_text, to_bytes
+from users.location_index import location_index
+from users.match_history import match_history
+from users.survey_catalog import survey_catalog
 
 def profile_picture_filepath(instance, filename) -> str:
     """ Returns save location of profile picture """
@@ -30,6 +37,43 @@ def current_timestamp() -> float:
     """ Returns the timestamp in the current timezone """
     return timezone.now().timestamp()
 
+EARTH_RADIUS = 6371 * 1000 # Radius of earth in meters. Determines return value units.
+
+def _great_circle_distance(lat1, lon1, lat2, lon2):
+    """ Haversine formula over broadcastable arrays of radians """
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    return c * EARTH_RADIUS
+
+def _radians(degrees):
+    """ Converts decimal degrees to radians, treating None as nan """
+    return np.radians(np.asarray(degrees, dtype=float))
+
+def haversine_many(lat, lon, lats, lons):
+    """
+    Calculate the great circle distances in meters from one point
+    to each of many points (specified in decimal degrees).
+    Missing coordinates produce nan.
+    """
+    return _great_circle_distance(
+        _radians(lat), _radians(lon), _radians(lats), _radians(lons),
+    )
+
+def haversine_matrix(lats1, lons1, lats2, lons2):
+    """
+    Calculate the pairwise great circle distances in meters between
+    two lists of points. Entry [i][j] is the distance between the
+    i-th point of the first list and the j-th point of the second.
+    """
+    return _great_circle_distance(
+        _radians(lats1)[:, np.newaxis],
+        _radians(lons1)[:, np.newaxis],
+        _radians(lats2)[np.newaxis, :],
+        _radians(lons2)[np.newaxis, :],
+    )
+
 def haversine(lon1, lat1, lon2, lat2):
     """
     Calculate the great circle distance in meters between two points 
@@ -37,17 +81,7 @@ def haversine(lon1, lat1, lon2, lat2):
     """
     if not lon1 or not lat1 or not lon2 or not lat2: 
         return None
-    
-    # convert decimal degrees to radians 
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-
-    # haversine formula 
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
-    r = 6371 # Radius of earth in kilometers. Use 3956 for miles. Determines return value units.
-    return c * r * 1000
+    return float(haversine_many(lat1, lon1, [lat2], [lon2])[0])
 
 class User(AbstractUser):
     """ User class extension """
@@ -79,21 +113,158 @@ class User(AbstractUser):
     loc_update_time = models.DateTimeField(default=timezone.now)
     is_matchable = models.BooleanField(default=False)
 
+    numerical_answered = models.BinaryField(default=bytes)
+    numerical_above = models.BinaryField(default=bytes)
+    text_answers = models.BinaryField(default=bytes)
+    age_group = models.TextField(default='', blank=True)
+
+    """ Latest unexpired match, maintained whenever matches are created or deleted """
+    active_match = models.ForeignKey(
+        'Match',
+        related_name='+',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
+    active_match_expires_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta(AbstractUser.Meta):
+        """ Index the users that can be matched by location """
+        indexes = [
+            models.Index(
+                fields=['loc_update_time'],
+                condition=Q(is_matchable=True, latitude__isnull=False, longitude__isnull=False),
+                name='user_matchable_located_idx',
+            ),
+            models.Index(
+                fields=['active_match_expires_at'],
+                name='user_active_match_idx',
+            ),
+        ]
+
     def save(self, *args, **kwargs) -> None:
         """ Overrides username and password generation """
         self.username = self.email
         self.password = self.password if self.password else uuid4()
         self.first_name = self.first_name.lower()
         self.last_name = self.last_name.lower()
+        is_new = self._state.adding
         user = super().save(*args, **kwargs)
         if not Token.objects.filter(user_id=self.id).exists():
             Token.objects.create(user_id=self.id)
+        if is_new:
+            match_history.invalidate(self.id)
+        location_index.update_user(self)
         return user
 
+    def has_active_match(self, now=None) -> bool:
+        """ Whether the user's latest match has not expired yet """
+        now = now if now else timezone.now()
+        return bool(self.active_match_expires_at and self.active_match_expires_at > now)
+
+    def refresh_compatibility_vector(self) -> None:
+        """ Re-encodes survey responses into the compatibility vector """
+        numerical_responses = list(
+          NumericalResponse.objects.filter(user_id=self.id)
+            .values_list('question_id', 'answer')
+        )
+        text_responses = list(
+          TextResponse.objects.filter(user_id=self.id)
+            .values_list('question_id', 'answer')
+        )
+        catalog = survey_catalog.get(
+          numerical_question_ids=[question_id for question_id, _ in numerical_responses],
+        )
+
+        numerical_answered, numerical_above = encode_numerical([
+          (question_id, answer, catalog.average(question_id))
+          for question_id, answer in numerical_responses
+        ])
+        text_answers = encode_text(text_responses)
+
+        self.numerical_answered = to_bytes(numerical_answered)
+        self.numerical_above = to_bytes(numerical_above)
+        self.text_answers = to_bytes(text_answers)
+        self.age_group = encode_age_group([answer for _, answer in text_responses])
+
+        User.objects.filter(id=self.id).update(
+          numerical_answered=self.numerical_answered,
+          numerical_above=self.numerical_above,
+          text_answers=self.text_answers,
+          age_group=self.age_group,
+        )
+
+    @classmethod
+    def refresh_compatibility_vectors(cls, batch_size=1000) -> int:
+        """
+        Re-encodes every user's above-average bits against the current
+        question averages, which answers move over time, and returns how
+        many users changed. Users are locked a batch at a time, so a
+        concurrent survey post waits for its batch instead of being
+        overwritten by it.
+        """
+        averages = dict(NumericalQuestion.objects.values_list('id', 'average'))
+        refreshed = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                users = list(
+                  cls.objects.select_for_update(no_key=True).filter(id__gt=last_id)
+                    .order_by('id').only('id', 'numerical_above')[:batch_size]
+                )
+                if not users: return refreshed
+                last_id = users[-1].id
+
+                responses = defaultdict(list)
+                for user_id, question_id, answer in NumericalResponse.objects.filter(
+                  user_id__in=[user.id for user in users],
+                ).values_list('user_id', 'question_id', 'answer'):
+                    responses[user_id].append((question_id, answer, averages[question_id]))
+
+                changed_users = []
+                for user in users:
+                    _, numerical_above = encode_numerical(responses[user.id])
+                    numerical_above = to_bytes(numerical_above)
+                    if bytes(user.numerical_above or b'') != numerical_above:
+                        user.numerical_above = numerical_above
+                        changed_users.append(user)
+                cls.objects.bulk_update(changed_users, ['numerical_above'])
+                refreshed += len(changed_users)
+
 class Interest(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="interest")
     category = models.TextField()
 
+class MatchManager(models.Manager):
+    """ Creates matches between users who are free to match """
+
+    def claim(self, user, partner, now=None):
+        """
+        Matches the two users if neither is in an unexpired match and they
+        never matched before, archived matches included, otherwise returns None. Both user rows are
+        locked with FOR NO KEY UPDATE SKIP LOCKED, so a concurrent claim on
+        either user makes this one give up instead of waiting.
+        """
+        now = now if now else timezone.now()
+        user_ids = [user.pk, partner.pk]
+
+        with transaction.atomic():
+            claimed_ids = list(
+              User.objects.select_for_update(skip_locked=True, no_key=True).filter(
+                Q(pk__in=user_ids)&
+                (Q(active_match_expires_at__isnull=True) | Q(active_match_expires_at__lte=now))
+              ).order_by('pk').values_list('pk', flat=True)
+            )
+            if len(claimed_ids) < 2: return None
+            previous_pair = Q(user1=user, user2=partner) | Q(user1=partner, user2=user)
+            if self.filter(previous_pair).exists(): return None
+            if MatchArchive.objects.filter(previous_pair).exists(): return None
+
+            match = self.model(user1=user, user2=partner, time=now)
+            match.save()
+        return match
+
+
 class Match(models.Model):
     """ Match between two users """
     user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name="match1")
@@ -105,33 +276,75 @@ class Match(models.Model):
     time = models.DateTimeField(default=timezone.now)
 
     MATCH_SOUND = "matchsound.wav"
+    DURATION = timedelta(days=1)
+
+    objects = MatchManager()
 
     class Meta:
         """ Two users cannot match more than once """
         unique_together = ('user1', 'user2', )
+        indexes = [
+            models.Index(fields=['user1', 'time'], name='match_user1_time_idx'),
+            models.Index(fields=['user2', 'time'], name='match_user2_time_idx'),
+            models.Index(fields=['time'], name='match_time_idx'),
+        ]
 
-    def save(self, setting_notification=False, *args, **kwargs) -> None:
-        """ Order the users and notify each of them """
-        super().save(*args, **kwargs)
-
-        if setting_notification: return
-
-        self.user1, self.user2 = sorted([self.user1, self.user2], key=lambda user: user.email)
+    def save(self, *args, **kwargs) -> None:
+        """
+        Saves the match in a single write. Notifications the save makes due
+        are flagged as sent before the write and queued right after it, in
+        the same transaction, so their payloads carry the match's id. They
+        are tracked in mixpanel once it commits, so each transition notifies once.
+        """
+        is_new = self._state.adding
+        if is_new:
+            self.user1, self.user2 = sorted([self.user1, self.user2], key=lambda user: user.email)
+
+        initial_due = not self.initial_notification_sent
+        accept_due = (
+          not self.accept_notification_sent
+          and self.user1_accepted
+          and self.user2_accepted
+        )
+        self.initial_notification_sent = True
+        self.accept_notification_sent = self.accept_notification_sent or accept_due
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if is_new:
+                self.activate()
+
+            notifications = []
+            if initial_due:
+                initial_notifications = self.initial_match_notifications()
+                notifications += initial_notifications
+                transaction.on_commit(lambda: self.send_match_create_to_mixpanel(
+                  initial_notifications[0].data,
+                  initial_notifications[1].data,
+                  initial_notifications[0].data['compatibility'],
+                ))
+            if accept_due:
+                notifications += self.accept_match_notifications()
+                transaction.on_commit(self.send_match_accept_to_mixpanel)
+            if notifications:
+                Notification.objects.bulk_create(notifications)
 
-        if not self.initial_notification_sent:
-            self.send_initial_match_notifications()
-            self.initial_notification_sent = True
-            self.save(setting_notification=True)
+    def has_expired(self) -> bool:
+        return (timezone.now() - self.time) > self.DURATION
 
-        if (not self.accept_notification_sent
-            and self.user1_accepted
-            and self.user2_accepted):
-            self.send_accept_match_notifications()
-            self.accept_notification_sent = True
-            self.save(setting_notification=True)
+    def expires_at(self):
+        """ When the match stops counting as active """
+        return self.time + self.DURATION
 
-    def has_expired(self) -> bool:
-        return (timezone.now() - self.time) > timedelta(days=1)
+    def activate(self) -> None:
+        """ Points both users at this match until it expires """
+        User.objects.filter(pk__in=[self.user1_id, self.user2_id]).update(
+            active_match=self,
+            active_match_expires_at=self.expires_at(),
+        )
+        for user in (self.user1, self.user2):
+            user.active_match_id = self.id
+            user.active_match_expires_at = self.expires_at()
 
     def send_match_create_to_mixpanel(self, payload1, payload2, compatibility) -> None:
         MixpanelClient.track(self.user1.id, 'Match Create', {
@@ -170,14 +383,14 @@ class Match(models.Model):
         MixpanelClient.track(self.user1.id, 'Match Success')
         MixpanelClient.track(self.user2.id, 'Match Success')
     
-    def send_initial_match_notifications(self) -> None:
-        """ Notifies users that they've been matched """
+    def initial_match_notifications(self) -> list:
+        """ Unsaved match notifications for both users """
         payload1 = self.initial_match_payload(self.user2, self.user1)
         payload2 = self.flip_match_payload(self.user1, payload1)
 
         compatibility = payload1['compatibility']
 
-        Notification.objects.bulk_create([
+        return [
           Notification(
             user=self.user1,
             type=Notification.Choices.MATCH,
@@ -192,16 +405,14 @@ class Match(models.Model):
             data=payload2,
             sound=self.MATCH_SOUND,
           ),
-        ])
-
-        self.send_match_create_to_mixpanel(payload1, payload2, compatibility)
+        ]
     
-    def send_accept_match_notifications(self) -> None:
-        """ Notifies users that their match was accepted """
+    def accept_match_notifications(self) -> list:
+        """ Unsaved accept notifications for both users """
         payload1 = self.initial_match_payload(self.user2, self.user1)
         payload2 = self.initial_match_payload(self.user1, self.user2)
-        
-        Notification.objects.bulk_create([
+
+        return [
           Notification(
             user=self.user1,
             message=self.accept_message(self.user2.first_name),
@@ -214,9 +425,7 @@ class Match(models.Model):
             type=Notification.Choices.ACCEPT,
             data=payload2,
           ),
-        ])
-
-        self.send_match_accept_to_mixpanel()
+        ]
 
     def match_message(self, sender_name, comptability) -> str:
         return f'{sender_name} is nearby and {comptability}% compatible with you. you have 5 minutes to respond'
@@ -243,50 +452,83 @@ class Match(models.Model):
     def is_excluded_response(self, response) -> bool:
         return response in ["none/other", "other", "none"]
 
-    def initial_match_payload(self, partner, user) -> dict:
-        try:
-            user.numerical_responses
-            user.text_responses
-        except:
-            user.numerical_responses = NumericalResponse.objects.filter(user=user)
-            user.text_responses = TextResponse.objects.filter(user=user)
-        
-        compatible_numerical_responses = Q()
-        for response in user.numerical_responses.all():
-            compatible_numerical_responses |= (
-              (
-                Q(question_id=response.question_id)&
-                Q(question__average__lte=response.answer)&
-                Q(answer__lte=response.answer)
-              ) | (
-                Q(question_id=response.question_id)&
-                Q(question__average__gte=response.answer)&
-                Q(answer__gte=response.answer)
-              )
-            )
-        
-        compatible_text_responses = Q()
-        for response in user.text_responses.all():
-            compatible_text_responses |= (
-              Q(question_id=response.question_id)&
-              Q(answer=response.answer)
-            )
-        
-        similar_numerical_responses = NumericalResponse.objects.filter(
-           Q(user=partner)&
-           compatible_numerical_responses
+    def survey_responses(self, *users) -> dict:
+        """
+        Numerical and text responses of the users, keyed by user id, with
+        their questions attached from the survey catalog. Each user's
+        responses are fetched once per match, in a fixed number of
+        queries regardless of survey length.
+        """
+        responses = self.__dict__.setdefault('_survey_responses', {})
+        user_ids = [user.id for user in users if user.id not in responses]
+        if not user_ids: return responses
+
+        for user_id in user_ids:
+            responses[user_id] = ([], [])
+
+        numerical_responses = list(NumericalResponse.objects.filter(user_id__in=user_ids))
+        text_responses = list(TextResponse.objects.filter(user_id__in=user_ids))
+        catalog = survey_catalog.get(
+          numerical_question_ids=[response.question_id for response in numerical_responses],
+          text_question_ids=[response.question_id for response in text_responses],
         )
-        similar_text_responses = TextResponse.objects.filter(
-           Q(user=partner)&
-           compatible_text_responses
+
+        for response in numerical_responses:
+            response.question = catalog.numerical_questions[response.question_id]
+            responses[response.user_id][0].append(response)
+
+        for response in text_responses:
+            response.question = catalog.text_questions[response.question_id]
+            responses[response.user_id][1].append(response)
+
+        return responses
+
+    def is_similar_numerical_response(self, response, partner_response) -> bool:
+        """ Both answers are on the same side of the user's answer as the average """
+        answer = response.answer
+        average = response.question.average
+        return (
+          (average <= answer and partner_response.answer <= answer) or
+          (average >= answer and partner_response.answer >= answer)
         )
 
+    def answer_emoji(self, response) -> str:
+        """ Emoji of the answer choice matching a text response """
+        emoji = survey_catalog.get().emoji(response.question_id, response.answer)
+        return emoji if emoji else '❤️'
+
+    def initial_match_payload(self, partner, user) -> dict:
+        responses = self.survey_responses(user, partner)
+        user_numerical_responses, user_text_responses = responses[user.id]
+        partner_numerical_responses, partner_text_responses = responses[partner.id]
+
+        user_numerical_answers = {
+          response.question_id: response
+          for response in user_numerical_responses
+        }
+        user_text_answers = {
+          (response.question_id, response.answer)
+          for response in user_text_responses
+        }
+
+        similar_numerical_responses = [
+          response for response in partner_numerical_responses
+          if response.question_id in user_numerical_answers
+          and self.is_similar_numerical_response(
+            user_numerical_answers[response.question_id], response,
+          )
+        ]
+        similar_text_responses = [
+          response for response in partner_text_responses
+          if (response.question_id, response.answer) in user_text_answers
+        ]
+
         serialized_numerical_similarities = []
         serialized_text_similarities = []
 
         similar_traits = set()
 
-        for response in similar_numerical_responses.all():
+        for response in similar_numerical_responses:
             category = response.question.base_question.category
             if not category: continue
             if not category.trait1 or not category.trait2: continue
@@ -309,26 +551,21 @@ class Match(models.Model):
                 'partner_percent': partner_percent,
             })
 
-        for response in similar_text_responses.all():
+        for response in similar_text_responses:
             category = response.question.base_question.category
 
             if self.is_excluded_response(response.answer): continue
 
             if not category: continue
-            trait = response.question.base_question.category.trait1
+            trait = category.trait1
 
             if trait in similar_traits: continue
             similar_traits.add(trait)
 
-            answer_choices = TextAnswerChoice.objects.filter(
-                question_id=response.question.id,
-                answer=response.answer,
-            )
-            emoji = answer_choices[0].emoji if answer_choices.exists() else '❤️'
             serialized_text_similarities.append({
                 'trait': trait,
                 'shared_response': response.answer,
-                'emoji': emoji,
+                'emoji': self.answer_emoji(response),
             })
 
         serialized_numerical_similarities = self.prune_identical_similarities(
@@ -415,6 +652,27 @@ class Match(models.Model):
         return defaults
     
 
+class MatchArchive(models.Model):
+    """ Expired match, moved out of the match table by the match sweeper """
+    id = models.BigIntegerField(primary_key=True)
+    user1 = models.ForeignKey(User, on_delete=models.CASCADE, related_name="archived_match1")
+    user2 = models.ForeignKey(User, on_delete=models.CASCADE, related_name="archived_match2")
+    user1_accepted = models.BooleanField(default=False)
+    user2_accepted = models.BooleanField(default=False)
+    initial_notification_sent = models.BooleanField(default=False)
+    accept_notification_sent = models.BooleanField(default=False)
+    time = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user1', 'user2', )
+
+def clear_active_match(sender, instance, **kwargs) -> None:
+    """ Releases both users before their match is deleted """
+    User.objects.filter(active_match_id=instance.id).update(
+        active_match=None,
+        active_match_expires_at=None,
+    )
+
 class Category(models.Model):
     trait1 = models.TextField()
     trait2 = models.TextField(null=True, blank=True)
@@ -454,12 +712,67 @@ class NumericalQuestion(models.Model):
     minimum = models.FloatField(default=0)
     maximum = models.FloatField(default=6)
 
+    """ Running aggregates of the answers, maintained by a database trigger """
+    answer_count = models.IntegerField(default=0)
+    answer_sum = models.FloatField(default=0)
+    answer_sum_of_squares = models.FloatField(default=0)
+
+    STATISTICS_FIELDS = (
+        'average',
+        'variance',
+        'answer_count',
+        'answer_sum',
+        'answer_sum_of_squares',
+    )
+
     def __str__(self):
         return str(self.base_question.prompt) 
 
+    def save(self, *args, **kwargs):
+        # Statistics are written by the trigger, so never overwrite them with stale values
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.STATISTICS_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
     def calculate_average(self):
-        numerical_responses = self.numerical_responses.all()
-        return sum([response.answer for response in numerical_responses])/len(numerical_responses)
+        if not self.answer_count:
+            return self.average
+        return self.answer_sum / self.answer_count
+
+    @classmethod
+    def rebuild_statistics(cls) -> int:
+        """ Recomputes every question's statistics from its responses in one pass """
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                UPDATE users_numericalquestion question SET
+                  answer_count = COALESCE(stats.answer_count, 0),
+                  answer_sum = COALESCE(stats.answer_sum, 0),
+                  answer_sum_of_squares = COALESCE(stats.answer_sum_of_squares, 0),
+                  average = COALESCE(stats.answer_sum / stats.answer_count, question.average),
+                  variance = COALESCE(
+                    GREATEST(
+                      stats.answer_sum_of_squares / stats.answer_count
+                      - power(stats.answer_sum / stats.answer_count, 2),
+                      0
+                    ),
+                    question.variance
+                  )
+                FROM users_numericalquestion base
+                LEFT JOIN (
+                  SELECT
+                    question_id,
+                    COUNT(*) AS answer_count,
+                    SUM(answer) AS answer_sum,
+                    SUM(answer * answer) AS answer_sum_of_squares
+                  FROM users_numericalresponse
+                  GROUP BY question_id
+                ) stats ON stats.question_id = base.id
+                WHERE question.id = base.id
+            ''')
+            return cursor.rowcount
 
 class TextQuestion(models.Model):
     base_question = models.OneToOneField(BaseQuestion, related_name="text_question", on_delete=models.CASCADE)
@@ -473,31 +786,110 @@ class TextAnswerChoice(models.Model):
     answer = models.TextField()
     question = models.ForeignKey(TextQuestion, related_name="text_answer_choices", on_delete=models.CASCADE)
 
+class ResponseManager(models.Manager):
+    """ Keeps one answer per question per user """
+
+    def upsert_many(self, responses) -> list:
+        """
+        Saves the responses in a single INSERT ... ON CONFLICT DO UPDATE,
+        replacing any previous answer to the same question. The last
+        response to a question wins within the batch as well. Rows are
+        written in question order, so concurrent batches lock the question
+        rows their statistics trigger updates in the same order and
+        cannot deadlock.
+        """
+        latest_responses = {}
+        for response in responses:
+            latest_responses[(response.user_id, response.question_id)] = response
+        responses = [latest_responses[key] for key in sorted(latest_responses, key=lambda key: (key[1], key[0]))]
+        if not responses: return []
+
+        answer_field = self.model._meta.get_field('answer')
+        params = []
+        for response in responses:
+            params += [
+              response.user_id,
+              response.question_id,
+              answer_field.get_db_prep_save(response.answer, connection),
+            ]
+
+        table = connection.ops.quote_name(self.model._meta.db_table)
+        values = ', '.join(['(%s, %s, %s)'] * len(responses))
+        with connection.cursor() as cursor:
+            cursor.execute(
+              f'INSERT INTO {table} (user_id, question_id, answer) VALUES {values} '
+              'ON CONFLICT (user_id, question_id) DO UPDATE SET answer = EXCLUDED.answer '
+              'RETURNING id, user_id, question_id',
+              params,
+            )
+            for id, user_id, question_id in cursor.fetchall():
+                response = latest_responses[(user_id, question_id)]
+                response.pk = id
+                response._state.adding = False
+                response._state.db = self.db
+        return responses
+
 class NumericalResponse(models.Model):
     question = models.ForeignKey(NumericalQuestion, related_name="numerical_responses", on_delete=models.CASCADE)
     user = models.ForeignKey(User, related_name="numerical_responses", on_delete=models.CASCADE)
     answer = models.FloatField()
 
+    objects = ResponseManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'question'],
+                name='unique_numerical_response',
+            ),
+        ]
+
     def save(self, *args, **kwargs):
-        NumericalResponse.objects.filter(
-            question=self.question,
-            user=self.user,
-        ).delete()
-        super().save(*args, **kwargs)
-        # self.question.calculate_average()
-        # self.question.save()
+        if self._state.adding:
+            NumericalResponse.objects.upsert_many([self])
+        else:
+            NumericalResponse.objects.filter(
+                question=self.question,
+                user=self.user,
+            ).exclude(pk=self.pk).delete()
+            super().save(*args, **kwargs)
+        self.user.refresh_compatibility_vector()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        self.user.refresh_compatibility_vector()
+        return deleted
 
 class TextResponse(models.Model):
     question = models.ForeignKey(TextQuestion, related_name="text_responses", on_delete=models.CASCADE)
     user = models.ForeignKey(User, related_name="text_responses", on_delete=models.CASCADE)
     answer = models.TextField()
 
+    objects = ResponseManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'question'],
+                name='unique_text_response',
+            ),
+        ]
+
     def save(self, *args, **kwargs):
-        TextResponse.objects.filter(
-            question=self.question,
-            user=self.user,
-        ).delete()
-        super().save(*args, **kwargs)
+        if self._state.adding:
+            TextResponse.objects.upsert_many([self])
+        else:
+            TextResponse.objects.filter(
+                question=self.question,
+                user=self.user,
+            ).exclude(pk=self.pk).delete()
+            super().save(*args, **kwargs)
+        self.user.refresh_compatibility_vector()
+
+    def delete(self, *args, **kwargs):
+        deleted = super().delete(*args, **kwargs)
+        self.user.refresh_compatibility_vector()
+        return deleted
 
 class EmailAuthentication(models.Model):
     """ Authenticate email with verification code """
@@ -521,15 +913,11 @@ class BannedEmail(models.Model):
     """ Email on banned list """
     email = models.EmailField()
 
-class NotificationManager(models.Manager):
-    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False):
-        notifications = super().bulk_create(objs, batch_size, ignore_conflicts)
-        for notification in notifications:
-            notification.send_to_device()
-        return notifications
-
 class Notification(models.Model):
-    """ Wrapper for APNS Notifications """
+    """ 
+    Wrapper for APNS Notifications.
+    Rows are queued on creation and pushed by the notification worker.
+    """
     class Choices:
         MATCH = "match"
         ACCEPT = "accept"
@@ -541,8 +929,6 @@ class Notification(models.Model):
         (Choices.STOP_SHARE, Choices.STOP_SHARE),
     )
 
-    objects = NotificationManager()
-
     user = models.ForeignKey(User, related_name="notifications", on_delete=models.CASCADE)
     type = models.CharField(max_length=15, choices=NOTIFICATION_OPTIONS,)
     message = models.TextField(null=True, blank=True)
@@ -550,25 +936,145 @@ class Notification(models.Model):
     time = models.DateTimeField(default=timezone.now)
     sound = models.TextField(null=True)
 
-    def send_to_device(self) -> None:
-        APNSDevice.objects.filter(user=self.user).send_message(
-            message=self.message,
-            sound=self.sound,
-            extra={
-                "type": self.type,
-                "data": self.data,
+    # Delivery state, maintained by users.dispatch.NotificationDispatcher
+    is_sent = models.BooleanField(default=False)
+    attempts = models.IntegerField(default=0)
+    next_attempt_time = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(null=True, blank=True)
+    """ Devices still to reach after a transient failure, every active device when null """
+    retry_tokens = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        """ Index the outbox of unsent notifications """
+        indexes = [
+            models.Index(
+                fields=['next_attempt_time'],
+                condition=Q(is_sent=False),
+                name='notification_outbox_idx',
+            ),
+        ]
+
+    """ APNS failures after which a device token will never succeed """
+    PERMANENT_FAILURES = ('BadDeviceToken', 'DeviceTokenNotForTopic', 'Unregistered')
+
+    @classmethod
+    def send_to_devices(cls, notifications, client=apns_client) -> dict:
+        """
+        Pushes each notification to every active device of its user, or
+        only to its retry_tokens when a previous attempt reached the rest.
+        Devices are resolved with one query and every payload is sent in
+        one pass over the client's connection. Returns the failure reason
+        of each failed device, keyed by notification id and device token.
+        """
+        user_ids = {notification.user_id for notification in notifications}
+        devices = APNSDevice.objects.filter(user_id__in=user_ids, active=True)\
+          .values_list('user_id', 'registration_id')
+        user_tokens = defaultdict(list)
+        for user_id, token in devices:
+            user_tokens[user_id].append(token)
+
+        recipients = []
+        messages = []
+        for notification in notifications:
+            extra = {
+                "type": notification.type,
+                "data": notification.data,
             }
+            for token in user_tokens[notification.user_id]:
+                if notification.retry_tokens is not None and token not in notification.retry_tokens:
+                    continue
+                recipients.append((notification.id, token))
+                messages.append((token, notification.message, notification.sound, extra))
+
+        if not messages: return {}
+
+        failures = defaultdict(dict)
+        for (notification_id, token), result in zip(recipients, client.push(messages)):
+            if result != 'Success':
+                failures[notification_id][token] = result
+
+        inactive_tokens = [
+            token
+            for device_failures in failures.values()
+            for token, reason in device_failures.items()
+            if reason in cls.PERMANENT_FAILURES
+        ]
+        if inactive_tokens:
+            APNSDevice.objects.filter(registration_id__in=inactive_tokens).update(active=False)
+
+        return dict(failures)
+
+    def send_to_device(self) -> dict:
+        """ Pushes the notification to every device of its user """
+        return Notification.send_to_devices([self]).get(self.id, {})
+
+class MessageManager(models.Manager):
+    """ Hides and purges messages older than Message.RETENTION """
+
+    def cutoff(self, now=None) -> float:
+        """ Timestamp at and before which messages have expired """
+        now = now if now else current_timestamp()
+        return now - Message.RETENTION.total_seconds()
+
+    def unexpired(self, now=None):
+        """ Messages that have not expired yet """
+        return self.filter(timestamp__gt=self.cutoff(now))
+
+    def conversation(self, user1_id, user2_id, now=None):
+        """
+        Unexpired messages between the two users in either direction,
+        looked up by the conversation key the conversation index covers.
+        """
+        low_user_id, high_user_id = sorted([user1_id, user2_id])
+        return self.unexpired(now).alias(
+          low_user_id=Least('sender_id', 'receiver_id'),
+          high_user_id=Greatest('sender_id', 'receiver_id'),
+        ).filter(
+          low_user_id=low_user_id,
+          high_user_id=high_user_id,
         )
 
+    def purge_expired(self, now=None, batch_size=1000) -> int:
+        """
+        Deletes expired messages in batches of batch_size, each its own
+        short DELETE, and returns how many were deleted.
+        """
+        cutoff = self.cutoff(now)
+        purged = 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                  'DELETE FROM users_message WHERE id IN ('
+                  '  SELECT id FROM users_message WHERE timestamp <= %s '
+                  '  ORDER BY timestamp LIMIT %s FOR UPDATE SKIP LOCKED'
+                  ')',
+                  [cutoff, batch_size],
+                )
+                purged += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    return purged
+
+
 class Message(models.Model):
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name="sent_messages")
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name="received_messages")
     body = models.TextField()
     timestamp = models.FloatField(default=current_timestamp)
 
-    def save(self, *args, **kwargs) -> None:
-        Message.objects.filter(
-            (Q(sender=self.sender)|Q(receiver=self.sender))&
-            Q(timestamp__lte=current_timestamp()-timedelta(minutes=10).total_seconds())
-        ).delete()
-        super().save(*args, **kwargs)
+    """ How long messages are kept """
+    RETENTION = timedelta(minutes=10)
+
+    objects = MessageManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', 'timestamp'], name='message_sender_time_idx'),
+            models.Index(fields=['receiver', 'timestamp'], name='message_receiver_time_idx'),
+            models.Index(fields=['timestamp'], name='message_time_idx'),
+            models.Index(
+                Least('sender', 'receiver'),
+                Greatest('sender', 'receiver'),
+                'timestamp',
+                name='message_conversation_idx',
+            ),
+        ]
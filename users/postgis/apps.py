@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+
+
+class PostgisConfig(AppConfig):
+    """
+    PostGIS location column of users, installed with USE_POSTGIS. Its
+    migrations are only recorded while it is installed, so enabling
+    PostGIS on an existing database is a plain migrate forward.
+    """
+    name = "users.postgis"
+    label = "users_postgis"
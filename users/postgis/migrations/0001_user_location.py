@@ -0,0 +1,55 @@
+from django.db import migrations
+
+CREATE_EXTENSION = "CREATE EXTENSION IF NOT EXISTS postgis"
+
+ADD_LOCATION = """
+ALTER TABLE users_user ADD COLUMN location geography(Point, 4326);
+CREATE INDEX users_user_location_gist ON users_user USING GIST (location);
+"""
+
+DROP_LOCATION = """
+ALTER TABLE users_user DROP COLUMN location;
+"""
+
+CREATE_TRIGGER = """
+CREATE FUNCTION users_user_location() RETURNS trigger AS $$
+BEGIN
+    IF NEW.latitude IS NULL OR NEW.longitude IS NULL THEN
+        NEW.location := NULL;
+    ELSE
+        NEW.location := ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326)::geography;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER users_user_location
+BEFORE INSERT OR UPDATE ON users_user
+FOR EACH ROW EXECUTE FUNCTION users_user_location();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER users_user_location ON users_user;
+DROP FUNCTION users_user_location();
+"""
+
+BACKFILL_LOCATIONS = """
+UPDATE users_user SET latitude = latitude
+WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+"""
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ("users", "0046_matching_indexes"),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_EXTENSION, migrations.RunSQL.noop),
+        migrations.RunSQL(ADD_LOCATION, DROP_LOCATION),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+        migrations.RunSQL(BACKFILL_LOCATIONS, migrations.RunSQL.noop),
+    ]
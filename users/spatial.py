@@ -0,0 +1,43 @@
+""" Distance-aware location queries, backed by PostGIS when it is enabled """
+from math import cos, radians
+
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+
+""" Meters in .001 degrees of latitude, the radius of a nearby search """
+NEARBY_DISTANCE = 111
+
+""" Floor on the longitude scale so boxes near the poles stay bounded """
+MIN_LONGITUDE_SCALE = .01
+
+
+def longitude_delta(latitude, delta) -> float:
+    """ Longitude degrees spanning the same distance as delta degrees of latitude """
+    return delta / max(cos(radians(latitude)), MIN_LONGITUDE_SCALE)
+
+def point(latitude, longitude) -> str:
+    """ WGS 84 point of the coordinates, as EWKT """
+    return f'SRID=4326;POINT({longitude} {latitude})'
+
+def within(queryset, latitude, longitude, distance=NEARBY_DISTANCE):
+    """
+    Users of the queryset within distance meters, nearest first. The
+    location column is not part of the User model, it is added by the
+    users_postgis app, so it is queried with raw SQL. Ordering by the <->
+    operator lets the GiST index on location return users in distance order.
+    """
+    origin = point(latitude, longitude)
+    return queryset.filter(
+      RawSQL(
+        'ST_DWithin("users_user"."location", ST_GeogFromText(%s), %s)',
+        (origin, distance),
+        output_field=BooleanField(),
+      ),
+    ).order_by(
+      RawSQL('"users_user"."location" <-> ST_GeogFromText(%s)', (origin,)),
+    )
+
+def nearest(queryset, latitude, longitude, distance=NEARBY_DISTANCE, limit=None) -> list:
+    """ Users of the queryset within distance meters, nearest first """
+    nearest_users = within(queryset, latitude, longitude, distance)
+    return list(nearest_users[:limit] if limit else nearest_users)
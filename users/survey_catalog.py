@@ -0,0 +1,147 @@
+""" In-process cache of survey questions, categories and answer choices """
+import threading
+import time
+from collections import defaultdict
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+
+class SurveyCatalog:
+    """
+    Snapshot of every survey question with its category, answer choices
+    and average. Instances are shared between threads and must be
+    treated as read-only.
+    """
+
+    def __init__(self, version) -> None:
+        from users.models import BaseQuestion, Category, NumericalQuestion, TextAnswerChoice, TextQuestion
+
+        self.version = version
+        self.categories = {
+          category.id: category
+          for category in Category.objects.all()
+        }
+
+        self.base_questions = {}
+        for base_question in BaseQuestion.objects.order_by('id'):
+            if base_question.category_id:
+                base_question.category = self.categories[base_question.category_id]
+            self.base_questions[base_question.id] = base_question
+
+        self.numerical_questions = {}
+        for question in NumericalQuestion.objects.order_by('id'):
+            question.base_question = self.base_questions[question.base_question_id]
+            self.numerical_questions[question.id] = question
+
+        self.text_questions = {}
+        for question in TextQuestion.objects.order_by('id'):
+            question.base_question = self.base_questions[question.base_question_id]
+            self.text_questions[question.id] = question
+
+        self.answer_choices = defaultdict(list)
+        for answer_choice in TextAnswerChoice.objects.order_by('id'):
+            self.answer_choices[answer_choice.question_id].append(answer_choice)
+
+        self.numerical_questions_by_base = {
+          question.base_question_id: question
+          for question in self.numerical_questions.values()
+        }
+        self.text_questions_by_base = {
+          question.base_question_id: question
+          for question in self.text_questions.values()
+        }
+
+    def has_questions(self, numerical_question_ids=(), text_question_ids=()) -> bool:
+        """ Whether every given question is part of the snapshot """
+        return (
+          all(id in self.numerical_questions for id in numerical_question_ids) and
+          all(id in self.text_questions for id in text_question_ids)
+        )
+
+    def average(self, numerical_question_id) -> float:
+        """ Average answer to a numerical question """
+        return self.numerical_questions[numerical_question_id].average
+
+    def emoji(self, text_question_id, answer) -> str:
+        """ Emoji of the answer choice, if the answer is one of the choices """
+        for answer_choice in self.answer_choices[text_question_id]:
+            if answer_choice.answer == answer:
+                return answer_choice.emoji
+        return None
+
+
+class SurveyCatalogCache:
+    """
+    Process-wide survey catalog, built on first use.
+
+    The catalog's version token lives in Django's cache so that, with a
+    shared cache backend, saving a question in one process invalidates the
+    catalog of every process. The token expires after TIMEOUT, which also
+    bounds how stale question averages can get.
+    """
+    VERSION_KEY = 'survey_catalog_version'
+    TIMEOUT = 5 * 60
+    CHECK_INTERVAL = 1
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._catalog = None
+        self._checked_at = 0
+
+    def version(self) -> str:
+        """ Current version token, shared through Django's cache """
+        return cache.get_or_set(self.VERSION_KEY, uuid4().hex, self.TIMEOUT)
+
+    def is_current(self, catalog) -> bool:
+        """ Whether the catalog matches the shared version, checked at most every CHECK_INTERVAL """
+        now = time.monotonic()
+        if now - self._checked_at < self.CHECK_INTERVAL:
+            return True
+        self._checked_at = now
+        return catalog.version == self.version()
+
+    def get(self, numerical_question_ids=(), text_question_ids=()) -> SurveyCatalog:
+        """
+        Returns the current catalog, rebuilding it when it has been
+        invalidated or is missing any of the given questions.
+        """
+        catalog = self._catalog
+        if catalog and not self.is_current(catalog):
+            catalog = None
+        if catalog and not catalog.has_questions(numerical_question_ids, text_question_ids):
+            self.invalidate()
+            catalog = None
+        if catalog:
+            return catalog
+
+        with self._lock:
+            version = self.version()
+            if not self._catalog or self._catalog.version != version:
+                self._catalog = SurveyCatalog(version)
+                self._checked_at = time.monotonic()
+            return self._catalog
+
+    def invalidate(self) -> None:
+        """ Drops the catalog in every process sharing the cache """
+        cache.set(self.VERSION_KEY, uuid4().hex, self.TIMEOUT)
+        self._catalog = None
+
+
+survey_catalog = SurveyCatalogCache()
+
+
+def invalidate_survey_catalog(sender, **kwargs) -> None:
+    """ Invalidates now for this process and again once the change is visible to others """
+    survey_catalog.invalidate()
+    transaction.on_commit(survey_catalog.invalidate)
+
+def connect_signals() -> None:
+    """ Invalidates the catalog whenever survey metadata is saved or deleted """
+    from users.models import BaseQuestion, Category, NumericalQuestion, TextAnswerChoice, TextQuestion
+
+    for model in (BaseQuestion, Category, NumericalQuestion, TextAnswerChoice, TextQuestion):
+        post_save.connect(invalidate_survey_catalog, sender=model, dispatch_uid=f'survey_catalog_save_{model.__name__}')
+        post_delete.connect(invalidate_survey_catalog, sender=model, dispatch_uid=f'survey_catalog_delete_{model.__name__}')
@@ -1,23 +1,54 @@
 """ Tests for User APIs """
+import asyncio
+import json
 import os
 import random
+import threading
+import timeit
+from io import StringIO
+
+import numpy as np
+
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
 
 from cryptography.fernet import Fernet
+from django.conf import settings
 from django.core import mail
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections
+from django.db.models import Q
+from django.test import TestCase, TransactionTestCase
+from unittest import mock, skipUnless
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from push_notifications.models import APNSDevice
 from rest_framework import status
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APIRequestFactory
 from uuid import uuid4
 
-from users.models import Category, EmailAuthentication, Match, Notification, NumericalQuestion, NumericalResponse, PhoneAuthentication, BaseQuestion, TextQuestion, TextResponse, User, Message
+from users.compatibility import CompatibilityVector, encode_numerical, encode_text, from_bytes, to_bytes
+from users.dispatch import NotificationDispatcher
+from users.events import EventListener, EventStream
+from users.location_buffer import LocationBuffer
+from users.location_index import LocationIndex, location_index
+from users.match_history import match_history
+from users.match_sweeper import MatchSweeper
+from users import spatial
+from users.matching import BatchMatcher, MatchScorer
+from users.management.commands.benchmark_haversine import scalar_haversine
+from users.survey_catalog import survey_catalog
+from users.models import Category, EmailAuthentication, Match, MatchArchive, Notification, NumericalQuestion, NumericalResponse, PhoneAuthentication, BaseQuestion, TextAnswerChoice, TextQuestion, TextResponse, User, Message, haversine, haversine_many, haversine_matrix
 from users.views import CompleteUserSerializer, DeleteAccount, ForceCreateMatch, PostSurveyAnswers, RegisterUser, SendEmailCode, SendPhoneCode, StopLocationSharing, UpdateLocation, AcceptMatch, UpdateMatchableStatus, VerifyEmailCode, VerifyPhoneCode
 
 import sys
 
-from users.viewsets import MessageViewset, QuestionViewset
+from users.viewsets import MatchViewset, MessageViewset, NumericalResponseViewset, QuestionViewset
 sys.path.append(".")
 from twilio_config import TwilioTestClientMessages
+from apns_config import APNSTestClient
 
 class APIRequestFactoryWithToken(APIRequestFactory):
     token = None
@@ -298,7 +329,7 @@ class UpdateLocationTest(TestCase):
             'longitude': 0,
           }
         )
-        response = UpdateLocation.as_view()(request)
+        response = async_to_sync(UpdateLocation.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(
@@ -329,7 +360,7 @@ class UpdateLocationTest(TestCase):
             'longitude': 0,
           }
         )
-        response = UpdateLocation.as_view()(request)
+        response = async_to_sync(UpdateLocation.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertFalse(
@@ -365,7 +396,7 @@ class UpdateLocationTest(TestCase):
             'longitude': 0,
           }
         )
-        response = UpdateLocation.as_view()(request)
+        response = async_to_sync(UpdateLocation.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertFalse(
@@ -391,7 +422,7 @@ class UpdateLocationTest(TestCase):
             'longitude': 0,
           }
         )
-        response = UpdateLocation.as_view()(request)
+        response = async_to_sync(UpdateLocation.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertFalse(
@@ -432,7 +463,7 @@ class UpdateLocationTest(TestCase):
             'is_encrypted': True,
           }
         )
-        response = UpdateLocation.as_view()(request)
+        response = async_to_sync(UpdateLocation.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(
@@ -442,6 +473,46 @@ class UpdateLocationTest(TestCase):
         self.assertTrue(Notification.objects.filter(user=self.user1))
         self.assertTrue(Notification.objects.filter(user=self.user2))
 
+    def test_location_update_near_compatible_users_matches_nearest_user(self):
+        """ Two compatible users are nearby, but one is closer """
+        self.user3 = random_user(3, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        self.user3.is_matchable = True
+
+        self.user1.latitude = .0009
+        self.user1.longitude = .0009
+        self.user3.latitude = .0001
+        self.user3.longitude = .0001
+        self.user1.save()
+        self.user3.save()
+
+        BaseQuestion.objects.create(id=1)
+        NumericalQuestion.objects.create(id=1, base_question_id=1)
+        BaseQuestion.objects.create(id=2)
+        TextQuestion.objects.create(id=2, base_question_id=2)
+        for user in [self.user1, self.user2, self.user3]:
+            NumericalResponse.objects.create(question_id=1, answer=1, user=user)
+            TextResponse.objects.create(question_id=2, answer='hello', user=user)
+
+        request = APIRequestFactory().put(
+          path='update-location/',
+          data={
+            'email': self.user2.email,
+            'latitude': 0,
+            'longitude': 0,
+          }
+        )
+        response = async_to_sync(UpdateLocation.as_view())(request)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(
+          Match.objects.filter(user1=self.user2, user2=self.user3) or
+          Match.objects.filter(user1=self.user3, user2=self.user2)
+        )
+        self.assertFalse(
+          Match.objects.filter(user1=self.user1, user2=self.user2) or
+          Match.objects.filter(user1=self.user2, user2=self.user1)
+        )
+
     def test_freshman_should_match_with_freshman(self):
         """" 
         Both people are:
@@ -479,7 +550,7 @@ class UpdateLocationTest(TestCase):
             'is_encrypted': True,
           }
         )
-        response = UpdateLocation.as_view()(request)
+        response = async_to_sync(UpdateLocation.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(
@@ -527,7 +598,7 @@ class UpdateLocationTest(TestCase):
             'is_encrypted': True,
           }
         )
-        response = UpdateLocation.as_view()(request)
+        response = async_to_sync(UpdateLocation.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertFalse(
@@ -574,7 +645,7 @@ class UpdateLocationTest(TestCase):
             'is_encrypted': True,
           }
         )
-        response = UpdateLocation.as_view()(request)
+        response = async_to_sync(UpdateLocation.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(
@@ -587,6 +658,861 @@ class UpdateLocationTest(TestCase):
     def test_sophomores_juniors_and_seniors_can_only_match_with_each_other(self):
         pass
 
+    def test_unknown_email_should_return_bad_request(self):
+        request = APIRequestFactory().put(
+          path='update-location/',
+          data={'email': 'nobody@usc.edu', 'latitude': 0, 'longitude': 0},
+        )
+        response = async_to_sync(UpdateLocation.as_view())(request)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(response.content), {'email': ['email not found']})
+
+    def test_invalid_parameters_should_return_bad_request(self):
+        request = APIRequestFactory().put(
+          path='update-location/',
+          data={'email': 'not an email', 'latitude': 0, 'longitude': 0},
+        )
+        response = async_to_sync(UpdateLocation.as_view())(request)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('email', json.loads(response.content))
+
+    def test_malformed_json_should_return_bad_request(self):
+        request = APIRequestFactory().generic(
+          'PUT', 'update-location/', '{', content_type='application/json',
+        )
+        response = async_to_sync(UpdateLocation.as_view())(request)
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_update_should_be_served_asynchronously_under_asgi(self):
+        data = {'email': self.user2.email, 'latitude': 0.0, 'longitude': 0.0, 'is_encrypted': False}
+        response = await self.async_client.put(
+          '/update-location/',
+          data,
+          content_type='application/json',
+        )
+
+        self.assertTrue(asyncio.iscoroutinefunction(UpdateLocation.as_view()))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), data)
+
+
+class LocationBufferTest(TestCase):
+    def setUp(self):
+        self.buffer = LocationBuffer(flush_interval=60)
+        self.user1 = random_user(1)
+        self.user1.latitude = 0
+        self.user1.longitude = 0
+        self.user1.save()
+        self.user1 = User.objects.get(id=self.user1.id)
+
+    def tearDown(self):
+        self.buffer.clear()
+
+    def ping(self, latitude, longitude, age=0):
+        user = User(
+          id=self.user1.id,
+          latitude=latitude,
+          longitude=longitude,
+          loc_update_time=timezone.now() - timezone.timedelta(seconds=age),
+        )
+        self.buffer.record(user)
+        return user
+
+    def test_pings_are_coalesced_until_flush(self):
+        self.ping(1, 1)
+        self.ping(2, 2)
+
+        self.assertEqual(User.objects.get(id=self.user1.id).latitude, 0)
+        self.assertEqual(self.buffer.pending(self.user1.id)[:2], (2, 2))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.buffer.flush(), 1)
+        user = User.objects.get(id=self.user1.id)
+        self.assertEqual((user.latitude, user.longitude), (2, 2))
+        self.assertIsNone(self.buffer.pending(self.user1.id))
+
+    def test_flush_does_not_overwrite_newer_locations(self):
+        User.objects.filter(id=self.user1.id).update(latitude=5, loc_update_time=timezone.now())
+        self.ping(1, 1, age=60)
+        self.buffer.flush()
+
+        self.assertEqual(User.objects.get(id=self.user1.id).latitude, 5)
+
+    def test_older_ping_does_not_replace_buffered_ping(self):
+        self.ping(2, 2)
+        self.ping(1, 1, age=60)
+
+        self.assertEqual(self.buffer.pending(self.user1.id)[:2], (2, 2))
+
+    def test_overlay_applies_buffered_location(self):
+        self.ping(3, 4)
+        user = self.buffer.overlay([User.objects.get(id=self.user1.id)])[0]
+
+        self.assertEqual((user.latitude, user.longitude), (3, 4))
+
+
+class MatchingQueryPlanTest(TestCase):
+    USERS = 2000
+
+    def setUp(self):
+        """ Long located users matched in pairs, analyzed so plans do not hinge on autovacuum """
+        located_time = timezone.now() - timezone.timedelta(days=1)
+        users = User.objects.bulk_create([
+          User(
+            id=id,
+            username=f'plan-{id}',
+            email=f'plan-{id}@usc.edu',
+            phone_number=f'+1{id:010d}',
+            is_matchable=True,
+            latitude=0,
+            longitude=0,
+            loc_update_time=located_time,
+          )
+          for id in range(1, self.USERS + 1)
+        ])
+        self.user1 = users[0]
+        Match.objects.bulk_create([
+          Match(user1=user1, user2=user2, time=located_time)
+          for user1, user2 in zip(users[::2], users[1::2])
+        ])
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE users_user, users_match')
+
+    def assertUsesIndexes(self, queryset, *index_names):
+        plan = queryset.explain()
+        for index_name in index_names:
+            self.assertIn(index_name, plan, plan)
+
+    def test_location_index_refresh_uses_index(self):
+        self.assertUsesIndexes(
+          location_index.located_users(timezone.now()),
+          'user_matchable_located_idx',
+        )
+
+    def test_batch_matcher_candidates_use_index(self):
+        self.assertUsesIndexes(
+          BatchMatcher().candidates(),
+          'user_matchable_located_idx',
+        )
+
+    def test_match_history_query_uses_indexes(self):
+        self.assertUsesIndexes(
+          match_history.matches([self.user1.id]),
+          'match_user1_time_idx',
+          'match_user2_time_idx',
+        )
+
+
+class MatchHistoryTest(TestCase):
+    """ Test cached match histories """
+
+    def setUp(self):
+        self.user1 = random_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        self.user2 = random_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        self.user3 = random_user(3, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        self.user1.save()
+        self.user2.save()
+        self.user3.save()
+
+    def test_saving_match_updates_both_histories(self):
+        self.assertFalse(match_history.get(self.user1.id).has_matched(self.user2.id))
+
+        Match.objects.create(user1=self.user1, user2=self.user2)
+
+        history1, history2 = match_history.get_many([self.user1.id, self.user2.id]).values()
+        self.assertTrue(history1.has_matched(self.user2.id))
+        self.assertTrue(history2.has_matched(self.user1.id))
+
+    def test_cached_histories_are_read_without_queries(self):
+        with self.assertNumQueries(1):
+            match_history.get_many([self.user1.id, self.user2.id, self.user3.id])
+        with self.assertNumQueries(0):
+            match_history.get_many([self.user1.id, self.user2.id, self.user3.id])
+
+    def test_deleting_partner_clears_history(self):
+        Match.objects.create(user1=self.user1, user2=self.user2)
+        self.assertTrue(match_history.get(self.user1.id).has_matched(self.user2.id))
+
+        self.user2.delete()
+
+        self.assertFalse(match_history.get(self.user1.id).has_matched(self.user2.id))
+
+    def test_stale_history_does_not_create_second_match(self):
+        for user, latitude in ((self.user1, 0), (self.user2, 0)):
+            user.is_matchable = True
+            user.latitude = latitude
+            user.longitude = 0
+            user.numerical_answered = to_bytes(1 << 1)
+            user.text_answers = to_bytes(encode_text([(1, 'a')]))
+            user.save()
+        match_history.get_many([self.user1.id, self.user2.id])
+        match, = Match.objects.bulk_create([Match(user1=self.user2, user2=self.user3)])
+        match.activate()
+
+        UpdateLocation().match_with_nearby_users(self.user1, 0, 0)
+
+        self.assertEqual(Match.objects.count(), 1)
+        self.user1.refresh_from_db()
+        self.assertFalse(self.user1.has_active_match())
+
+    def test_failed_claim_falls_back_to_next_ranked_candidate(self):
+        for user in (self.user1, self.user2, self.user3):
+            user.is_matchable = True
+            user.latitude = 0
+            user.longitude = 0
+            user.numerical_answered = to_bytes(1 << 1)
+            user.text_answers = to_bytes(encode_text([(1, 'a')]))
+            user.save()
+        best, runner_up = MatchScorer(self.user1, 0, 0).rank([self.user2, self.user3], k=2)
+        match_history.get(self.user1.id)
+        Match.objects.bulk_create([
+          Match(user1=self.user1, user2=best.user, time=timezone.now() - timezone.timedelta(days=2)),
+        ])
+
+        UpdateLocation().match_with_nearby_users(self.user1, 0, 0)
+
+        self.user1.refresh_from_db()
+        self.assertEqual(self.user1.active_match.user2_id, runner_up.user.id)
+        self.assertTrue(match_history.get(self.user1.id).has_matched(best.user.id))
+
+
+class ActiveMatchTest(TestCase):
+    """ Test the active match pointer kept on users """
+
+    def setUp(self):
+        self.user1 = random_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        self.user2 = random_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        self.user3 = random_user(3, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        self.user1.save()
+        self.user2.save()
+        self.user3.save()
+
+    def test_creating_match_sets_both_pointers(self):
+        match = Match.objects.create(user1=self.user1, user2=self.user2)
+
+        for user in (self.user1, self.user2):
+            user.refresh_from_db()
+            self.assertEqual(user.active_match_id, match.id)
+            self.assertEqual(user.active_match_expires_at, match.expires_at())
+            self.assertTrue(user.has_active_match())
+        self.user3.refresh_from_db()
+        self.assertFalse(self.user3.has_active_match())
+
+    def test_expired_pointer_is_not_active(self):
+        Match.objects.create(
+          user1=self.user1,
+          user2=self.user2,
+          time=timezone.now() - timezone.timedelta(days=2),
+        )
+        self.user1.refresh_from_db()
+
+        self.assertFalse(self.user1.has_active_match())
+
+    def test_deleting_match_clears_pointers(self):
+        match = Match.objects.create(user1=self.user1, user2=self.user2)
+
+        match.delete()
+
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.assertIsNone(self.user1.active_match_id)
+        self.assertIsNone(self.user2.active_match_expires_at)
+
+    def test_deleting_partner_clears_pointer(self):
+        Match.objects.create(user1=self.user1, user2=self.user2)
+
+        self.user2.delete()
+
+        self.user1.refresh_from_db()
+        self.assertFalse(self.user1.has_active_match())
+
+    def test_force_create_match_moves_pointers(self):
+        Match.objects.create(user1=self.user1, user2=self.user2)
+        request = APIRequestFactory().post(
+          path='force-create-match/',
+          data={
+            'user1_id': self.user1.id,
+            'user2_id': self.user2.id,
+          },
+        )
+
+        ForceCreateMatch.as_view()(request)
+
+        match = Match.objects.get()
+        self.user1.refresh_from_db()
+        self.user2.refresh_from_db()
+        self.assertEqual(self.user1.active_match_id, match.id)
+        self.assertEqual(self.user2.active_match_id, match.id)
+
+    def test_claim_matches_free_users_once(self):
+        match = Match.objects.claim(self.user1, self.user2)
+
+        self.assertTrue(match.initial_notification_sent)
+        self.assertEqual(Notification.objects.filter(type=Notification.Choices.MATCH).count(), 2)
+        self.assertIsNone(Match.objects.claim(self.user1, self.user3))
+        self.assertEqual(Match.objects.count(), 1)
+
+    def test_claim_refuses_previous_partners(self):
+        Match.objects.create(
+          user1=self.user2,
+          user2=self.user1,
+          time=timezone.now() - timezone.timedelta(days=2),
+        )
+
+        self.assertIsNone(Match.objects.claim(self.user1, self.user2))
+
+    def test_active_user_is_skipped_without_queries(self):
+        Match.objects.create(user1=self.user1, user2=self.user3)
+        self.user1.refresh_from_db()
+
+        with self.assertNumQueries(0):
+            UpdateLocation().match_with_nearby_users(self.user1, 0, 0)
+
+
+class MatchSweeperTest(TestCase):
+    """ Test archiving expired matches """
+
+    def setUp(self):
+        self.user1 = random_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        self.user2 = random_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        self.user3 = random_user(3, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        self.user1.save()
+        self.user2.save()
+        self.user3.save()
+
+    def test_run_once_archives_only_expired_matches(self):
+        now = timezone.now()
+        expired = Match.objects.create(
+          user1=self.user1,
+          user2=self.user2,
+          time=now - timezone.timedelta(days=2),
+        )
+        active = Match.objects.create(user1=self.user3, user2=self.user1, time=now)
+
+        self.assertEqual(MatchSweeper(now).run_once(), 1)
+
+        self.assertEqual(list(Match.objects.values_list('id', flat=True)), [active.id])
+        archived = MatchArchive.objects.get()
+        self.assertEqual((archived.id, archived.user1_id, archived.time), (expired.id, expired.user1_id, expired.time))
+        self.user1.refresh_from_db()
+        self.assertEqual(self.user1.active_match_id, active.id)
+
+    def test_run_once_archives_in_batches_and_releases_pointers(self):
+        now = timezone.now()
+        Match.objects.create(user1=self.user1, user2=self.user2, time=now)
+        Match.objects.create(user1=self.user1, user2=self.user3, time=now)
+        sweeper = MatchSweeper(now + Match.DURATION + timezone.timedelta(seconds=1))
+        sweeper.BATCH_SIZE = 1
+
+        self.assertEqual(sweeper.run_once(), 2)
+
+        self.assertFalse(Match.objects.exists())
+        self.assertFalse(User.objects.filter(active_match__isnull=False).exists())
+
+    def test_archived_matches_are_still_history(self):
+        Match.objects.create(
+          user1=self.user1,
+          user2=self.user2,
+          time=timezone.now() - timezone.timedelta(days=2),
+        )
+        MatchSweeper().run_once()
+        match_history.invalidate(self.user1.id, self.user2.id)
+
+        self.assertTrue(match_history.get(self.user1.id).has_matched(self.user2.id))
+        self.assertIsNone(Match.objects.claim(self.user2, self.user1))
+        self.assertEqual(BatchMatcher().past_pairs([self.user1, self.user2]), {(1, 2)})
+
+    def test_match_viewset_lists_and_retrieves_archived_matches(self):
+        now = timezone.now()
+        expired = Match.objects.create(user1=self.user1, user2=self.user2, time=now - timezone.timedelta(days=2))
+        active = Match.objects.create(user1=self.user3, user2=self.user1, time=now)
+        MatchSweeper(now).run_once()
+
+        response = MatchViewset.as_view({'get': 'list'})(APIRequestFactory().get('matches/'))
+        self.assertEqual([match['id'] for match in response.data], [expired.id, active.id])
+        self.assertEqual(response.data[0]['user2'], self.user2.id)
+
+        response = MatchViewset.as_view({'get': 'retrieve'})(
+          APIRequestFactory().get(f'matches/{expired.id}/'),
+          pk=expired.id,
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['user1'], self.user1.id)
+
+    @mock.patch('users.match_sweeper.close_old_connections')
+    @mock.patch('users.match_sweeper.time.sleep')
+    @mock.patch.object(MatchSweeper, 'run_once')
+    def test_run_keeps_sweeping_after_a_failure(self, run_once, sleep, _):
+        run_once.side_effect = [DatabaseError('connection lost'), 0]
+        sleep.side_effect = [None, KeyboardInterrupt]
+
+        with self.assertLogs('users.match_sweeper'):
+            with self.assertRaises(KeyboardInterrupt):
+                MatchSweeper.run(interval=0)
+
+        self.assertEqual(run_once.call_count, 2)
+
+
+class ConcurrentMatchTest(TransactionTestCase):
+    """ Test match creation under concurrent location pings """
+    THREADS = 8
+
+    def located_user(self, id, sex_identity, sex_preference) -> User:
+        user = random_user(id, sex_identity, sex_preference)
+        user.is_matchable = True
+        user.latitude = 0
+        user.longitude = 0
+        user.numerical_answered = to_bytes(1 << 1)
+        user.text_answers = to_bytes(encode_text([(1, 'a')]))
+        user.save()
+        return user
+
+    def ping_concurrently(self, users) -> list:
+        barrier = threading.Barrier(len(users))
+        errors = []
+
+        def ping(user):
+            try:
+                barrier.wait()
+                UpdateLocation().match_with_nearby_users(user, 0, 0)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=ping, args=(user,)) for user in users]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        return errors
+
+    def test_concurrent_pings_match_shared_neighbour_once(self):
+        self.located_user(0, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        users = [
+          self.located_user(id, User.SexChoices.MALE, User.SexChoices.FEMALE)
+          for id in range(1, self.THREADS + 1)
+        ]
+
+        self.assertEqual(self.ping_concurrently(users), [])
+
+        self.assertEqual(Match.objects.count(), 1)
+        self.assertEqual(Notification.objects.filter(type=Notification.Choices.MATCH).count(), 2)
+        self.assertEqual(User.objects.filter(active_match__isnull=False).count(), 2)
+
+    def test_concurrent_pings_never_double_match(self):
+        users = [
+          self.located_user(id, sex, sex)
+          for id, sex in enumerate(
+            [User.SexChoices.MALE] * (self.THREADS // 2) + [User.SexChoices.FEMALE] * (self.THREADS // 2)
+          )
+        ]
+
+        self.assertEqual(self.ping_concurrently(users), [])
+
+        matched_ids = [
+          user_id
+          for pair in Match.objects.values_list('user1_id', 'user2_id')
+          for user_id in pair
+        ]
+        self.assertEqual(len(matched_ids), len(set(matched_ids)))
+        self.assertTrue(matched_ids)
+
+
+class HaversineTest(TestCase):
+    """ Test great circle distance helpers """
+
+    def setUp(self):
+        self.lats = [34.0224 + random.uniform(-.01, .01) for _ in range(10000)]
+        self.lons = [-118.2851 + random.uniform(-.01, .01) for _ in range(10000)]
+
+    def test_haversine_many_agrees_with_scalar_haversine(self):
+        distances = haversine_many(34.0224, -118.2851, self.lats, self.lons)
+
+        for distance, lat, lon in zip(distances[:100], self.lats, self.lons):
+            self.assertAlmostEqual(distance, scalar_haversine(-118.2851, 34.0224, lon, lat), places=4)
+
+    def test_haversine_many_returns_nan_for_missing_coordinates(self):
+        distances = haversine_many(34.0224, -118.2851, [34.0224, None], [-118.2851, None])
+
+        self.assertEqual(distances[0], 0)
+        self.assertTrue(np.isnan(distances[1]))
+
+    def test_haversine_matrix_returns_pairwise_distances(self):
+        matrix = haversine_matrix(self.lats[:3], self.lons[:3], self.lats[:5], self.lons[:5])
+
+        self.assertEqual(matrix.shape, (3, 5))
+        for i in range(3):
+            self.assertAlmostEqual(matrix[i][i], 0)
+            self.assertAlmostEqual(
+              matrix[i][4],
+              haversine(self.lons[i], self.lats[i], self.lons[4], self.lats[4]),
+            )
+
+    def test_haversine_returns_none_for_missing_coordinates(self):
+        self.assertIsNone(haversine(None, 34.0224, -118.2851, 34.0224))
+
+    def test_haversine_many_is_faster_than_scalar_loop_for_many_candidates(self):
+        scalar_time = min(timeit.repeat(
+          lambda: [
+            scalar_haversine(-118.2851, 34.0224, lon, lat)
+            for lat, lon in zip(self.lats, self.lons)
+          ],
+          number=1,
+          repeat=3,
+        ))
+        vectorized_time = min(timeit.repeat(
+          lambda: haversine_many(34.0224, -118.2851, self.lats, self.lons),
+          number=1,
+          repeat=3,
+        ))
+
+        self.assertLess(vectorized_time, scalar_time)
+
+
+class LocationIndexTest(TestCase):
+    """ Test in-memory location index """
+
+    def setUp(self):
+        self.index = LocationIndex()
+        self.index._last_refresh = timezone.now()
+
+    def test_nearby_returns_users_within_bounding_box(self):
+        self.index.update(1, 0, 0)
+        self.index.update(2, .0009, -.0009)
+        self.index.update(3, .0011, 0)
+
+        self.assertEqual(sorted(self.index.nearby(0, 0)), [1, 2])
+
+    def test_nearby_excludes_requesting_user(self):
+        self.index.update(1, 0, 0)
+        self.index.update(2, 0, 0)
+
+        self.assertEqual(self.index.nearby(0, 0, exclude=1), [2])
+
+    def test_nearby_excludes_stale_locations(self):
+        self.index.update(1, 0, 0, timezone.now() - timezone.timedelta(minutes=16))
+
+        self.assertFalse(self.index.nearby(0, 0))
+
+    def test_moved_user_is_only_found_at_new_location(self):
+        self.index.update(1, 0, 0)
+        self.index.update(1, 10, 10)
+
+        self.assertFalse(self.index.nearby(0, 0))
+        self.assertEqual(self.index.nearby(10, 10), [1])
+
+    def test_refresh_loads_recently_located_matchable_users(self):
+        user1 = random_user(1)
+        user1.is_matchable = True
+        user1.latitude = 0
+        user1.longitude = 0
+        user1.save()
+
+        self.index.refresh(force=True)
+
+        self.assertEqual(self.index.nearby(0, 0), [user1.id])
+
+    def test_nearby_widens_longitude_with_latitude(self):
+        self.index.update(1, 60, .0019)
+        self.index.update(2, 60, -.0021)
+
+        self.assertEqual(self.index.nearby(60, 0), [1])
+        self.assertAlmostEqual(
+          haversine(0, 60, .0019, 60),
+          haversine(0, 60, 0, 60.00095),
+          delta=1,
+        )
+
+
+@skipUnless(settings.USE_POSTGIS, "PostGIS is not enabled")
+class NearestUsersTest(TestCase):
+    """ Test KNN candidate queries """
+
+    def setUp(self):
+        for id, offset in ((1, .0005), (2, .0001), (3, .0003), (4, .01)):
+            user = random_user(id)
+            user.latitude = offset
+            user.longitude = 0
+            user.save()
+
+    def test_nearest_orders_users_within_distance(self):
+        nearest_users = spatial.nearest(User.objects.all(), 0, 0)
+
+        self.assertEqual([user.id for user in nearest_users], [2, 3, 1])
+
+    def test_nearest_follows_location_updates(self):
+        User.objects.filter(id=1).update(latitude=0)
+
+        self.assertEqual(spatial.nearest(User.objects.all(), 0, 0, limit=1)[0].id, 1)
+
+    def test_nearest_uses_location_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = spatial.within(User.objects.all(), 0, 0).explain()
+
+        self.assertNotIn('Seq Scan on users_user', plan, plan)
+
+    def test_match_with_nearby_users_claims_a_nearest_user(self):
+        User.objects.update(
+          sex_identity=User.SexChoices.FEMALE,
+          sex_preference=User.SexChoices.MALE,
+          is_matchable=True,
+          loc_update_time=timezone.now(),
+          numerical_answered=to_bytes(1 << 1),
+          text_answers=to_bytes(encode_text([(1, 'a')])),
+        )
+        User.objects.filter(id=1).update(
+          sex_identity=User.SexChoices.MALE,
+          sex_preference=User.SexChoices.FEMALE,
+        )
+
+        UpdateLocation().match_with_nearby_users(User.objects.get(id=1), 0, 0)
+
+        match = Match.objects.get()
+        self.assertEqual(match.user1_id, 1)
+        self.assertIn(match.user2_id, (2, 3))
+
+
+class CompatibilityVectorTest(TestCase):
+    """ Test encoded survey answer vectors """
+
+    def test_shared_numerical_count_counts_answers_on_same_side_of_average(self):
+        answered1, above1 = encode_numerical([(1, 1, 3), (2, 5, 3), (3, 1, 3)])
+        answered2, above2 = encode_numerical([(1, 2, 3), (2, 4, 3), (3, 6, 3), (4, 1, 3)])
+
+        vector1 = CompatibilityVector(answered1, above1)
+        vector2 = CompatibilityVector(answered2, above2)
+
+        self.assertEqual(vector1.shared_numerical_count(vector2), 2)
+        self.assertEqual(vector2.shared_numerical_count(vector1), 2)
+
+    def test_shared_text_count_counts_identical_answers_only(self):
+        vector1 = CompatibilityVector(text_answers=encode_text([(1, 'a'), (2, 'b'), (5, 'c')]))
+        vector2 = CompatibilityVector(text_answers=encode_text([(1, 'a'), (2, 'x'), (7, 'c')]))
+
+        self.assertEqual(vector1.shared_text_count(vector2), 1)
+        self.assertEqual(vector2.shared_text_count(vector1), 1)
+
+    def test_unanswered_questions_are_not_shared(self):
+        self.assertEqual(CompatibilityVector().shared_text_count(CompatibilityVector()), 0)
+        self.assertEqual(CompatibilityVector().shared_numerical_count(CompatibilityVector()), 0)
+
+    def test_saving_and_deleting_responses_updates_user_vector(self):
+        user1 = random_user(1)
+        user1.save()
+        user2 = random_user(2)
+        user2.save()
+        BaseQuestion.objects.create(id=1)
+        NumericalQuestion.objects.create(id=1, base_question_id=1)
+        BaseQuestion.objects.create(id=2)
+        TextQuestion.objects.create(id=2, base_question_id=2)
+
+        NumericalResponse.objects.create(question_id=1, answer=1, user=user2)
+        NumericalResponse.objects.create(question_id=1, answer=5, user=user1)
+        text_response = TextResponse.objects.create(question_id=2, answer='freshman', user=user1)
+
+        vector = CompatibilityVector.from_user(User.objects.get(id=user1.id))
+        self.assertEqual(vector.numerical_answered, 1 << 1)
+        self.assertEqual(vector.numerical_above, 1 << 1)
+        self.assertEqual(vector.shared_text_count(vector), 1)
+        self.assertEqual(vector.age_group, 'freshman')
+
+        text_response.delete()
+
+        vector = CompatibilityVector.from_user(User.objects.get(id=user1.id))
+        self.assertEqual(vector.shared_text_count(vector), 0)
+        self.assertEqual(vector.age_group, '')
+
+
+class MatchScorerTest(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.latitude, self.longitude = 34.0224, -118.2851
+        self.user1 = self.located_user(1, numerical=[(1, 5)], text=[(1, 'a')])
+
+    def located_user(self, id, numerical=(), text=(), offset=0, age=0, age_group='') -> User:
+        user = random_user(id)
+        numerical_answered, numerical_above = encode_numerical([
+          (question_id, answer, 3) for question_id, answer in numerical
+        ])
+        user.numerical_answered = to_bytes(numerical_answered)
+        user.numerical_above = to_bytes(numerical_above)
+        user.text_answers = to_bytes(encode_text(text))
+        user.age_group = age_group
+        user.latitude = self.latitude + offset
+        user.longitude = self.longitude
+        user.loc_update_time = self.now - timezone.timedelta(seconds=age)
+        return user
+
+    def test_rank_should_exclude_incompatible_candidates(self):
+        candidates = [
+          self.located_user(2, numerical=[(1, 1)], text=[(1, 'a')]),
+          self.located_user(3, numerical=[(1, 5)], text=[(1, 'b')]),
+          self.located_user(4, numerical=[(1, 5)], text=[(1, 'a')], age_group='freshman'),
+          self.located_user(5, numerical=[(1, 5)], text=[(1, 'a')]),
+        ]
+        ranked = MatchScorer(self.user1, self.latitude, self.longitude, now=self.now).rank(candidates, k=4)
+
+        self.assertEqual([candidate.user.id for candidate in ranked], [5])
+
+    def test_rank_should_prefer_shared_answers_then_distance_then_freshness(self):
+        self.user1 = self.located_user(1, numerical=[(1, 5), (2, 5)], text=[(1, 'a')])
+        candidates = [
+          self.located_user(2, numerical=[(1, 5)], text=[(1, 'a')], offset=.0005),
+          self.located_user(3, numerical=[(1, 5), (2, 5)], text=[(1, 'a')], offset=.0005),
+          self.located_user(4, numerical=[(1, 5), (2, 5)], text=[(1, 'a')], offset=.0005, age=600),
+          self.located_user(5, numerical=[(1, 5), (2, 5)], text=[(1, 'a')], offset=.0001),
+        ]
+        ranked = MatchScorer(self.user1, self.latitude, self.longitude, now=self.now).rank(candidates, k=4)
+
+        self.assertEqual([candidate.user.id for candidate in ranked], [5, 3, 4, 2])
+        self.assertEqual(ranked[0].shared_numerical, 2)
+        self.assertEqual(ranked[0].shared_text, 1)
+        self.assertAlmostEqual(ranked[0].distance, 11.1, places=1)
+
+    def test_rank_should_be_deterministic(self):
+        candidates = [
+          self.located_user(id, numerical=[(1, 5)], text=[(1, 'a')])
+          for id in range(2, 12)
+        ]
+        scorer = MatchScorer(self.user1, self.latitude, self.longitude, now=self.now)
+
+        self.assertEqual(
+          [candidate.user.id for candidate in scorer.rank(candidates, k=3)],
+          [2, 3, 4],
+        )
+        self.assertEqual(
+          [candidate.user.id for candidate in scorer.rank(reversed(candidates), k=3)],
+          [2, 3, 4],
+        )
+
+    def test_rank_should_skip_candidates_without_location(self):
+        candidate = self.located_user(2, numerical=[(1, 5)], text=[(1, 'a')])
+        candidate.latitude = None
+
+        self.assertEqual(
+          MatchScorer(self.user1, self.latitude, self.longitude, now=self.now).rank([candidate]),
+          [],
+        )
+
+
+class BatchMatcherTest(TestCase):
+    def setUp(self):
+        self.latitude, self.longitude = 34.0224, -118.2851
+
+    def located_user(self, id, sex_identity, sex_preference, text_answer='a', offset=0, age=0) -> User:
+        user = random_user(id, sex_identity, sex_preference)
+        numerical_answered, numerical_above = encode_numerical([(1, 5, 3)])
+        user.numerical_answered = to_bytes(numerical_answered)
+        user.numerical_above = to_bytes(numerical_above)
+        user.text_answers = to_bytes(encode_text([(1, text_answer)]))
+        user.is_matchable = True
+        user.latitude = self.latitude + offset
+        user.longitude = self.longitude
+        user.loc_update_time = timezone.now() - timezone.timedelta(seconds=age)
+        user.save()
+        return user
+
+    def matched_pairs(self) -> set:
+        return {
+          frozenset((user1_id, user2_id))
+          for user1_id, user2_id in Match.objects.values_list('user1_id', 'user2_id')
+        }
+
+    def test_run_once_should_pair_best_candidates_once(self):
+        self.located_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        self.located_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE, offset=.0008)
+        self.located_user(3, User.SexChoices.FEMALE, User.SexChoices.MALE, offset=.0001)
+        self.located_user(4, User.SexChoices.MALE, User.SexChoices.FEMALE, offset=.0009)
+
+        matches = BatchMatcher().run_once()
+
+        self.assertEqual(len(matches), 2)
+        self.assertEqual(self.matched_pairs(), {frozenset((1, 3)), frozenset((2, 4))})
+        self.assertEqual(Notification.objects.filter(type=Notification.Choices.MATCH).count(), 4)
+        self.assertTrue(all(match.initial_notification_sent for match in Match.objects.all()))
+
+    def test_run_once_should_skip_distant_stale_and_incompatible_users(self):
+        self.located_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        self.located_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE, offset=.01)
+        self.located_user(3, User.SexChoices.FEMALE, User.SexChoices.MALE, age=60 * 60)
+        self.located_user(4, User.SexChoices.FEMALE, User.SexChoices.MALE, text_answer='b')
+        self.located_user(5, User.SexChoices.MALE, User.SexChoices.FEMALE, offset=.0001)
+
+        self.assertEqual(BatchMatcher().run_once(), [])
+
+    def test_run_once_should_not_rematch_users(self):
+        user1 = self.located_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        user2 = self.located_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        Match.objects.create(
+          user1=user1,
+          user2=user2,
+          time=timezone.now() - timezone.timedelta(days=2),
+        )
+
+        self.assertEqual(BatchMatcher().run_once(), [])
+
+    def test_update_location_should_not_match_without_inline_matching(self):
+        self.located_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        user2 = self.located_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        request = APIRequestFactory().put(
+          path='update-location/',
+          data={
+            'email': user2.email,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
+          },
+          format='json',
+        )
+
+        with self.settings(INLINE_MATCHING=False):
+            response = async_to_sync(UpdateLocation.as_view())(request)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(Match.objects.exists())
+        self.assertEqual(len(BatchMatcher().run_once()), 1)
+
+    def test_run_once_should_set_active_match_of_both_users(self):
+        user1 = self.located_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        user2 = self.located_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+
+        match, = BatchMatcher().run_once()
+
+        user1.refresh_from_db()
+        user2.refresh_from_db()
+        self.assertEqual(user1.active_match_id, match.id)
+        self.assertEqual(user2.active_match_id, match.id)
+        self.assertEqual(BatchMatcher().snapshot(), [])
+
+    def test_create_matches_should_drop_pairs_matched_inline_since_snapshot(self):
+        user1 = self.located_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        user2 = self.located_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        user3 = self.located_user(3, User.SexChoices.FEMALE, User.SexChoices.MALE, offset=.0001)
+        matcher = BatchMatcher()
+        users = matcher.snapshot()
+        pairs = matcher.pair(matcher.pair_weights(users))
+        inline_match = Match.objects.claim(user1, user3)
+
+        self.assertEqual(matcher.create_matches(pairs, {user.id: user for user in users}), [])
+        self.assertEqual(list(Match.objects.all()), [inline_match])
+        user1.refresh_from_db()
+        self.assertEqual(user1.active_match_id, inline_match.id)
+        self.assertNotIn(user2.id, {inline_match.user1_id, inline_match.user2_id})
+
+    def test_create_matches_should_drop_pair_matched_inline_by_both_paths(self):
+        user1 = self.located_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        user2 = self.located_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        matcher = BatchMatcher()
+        users = matcher.snapshot()
+        pairs = matcher.pair(matcher.pair_weights(users))
+        Match.objects.claim(user1, user2)
+
+        self.assertEqual(matcher.create_matches(pairs, {user.id: user for user in users}), [])
+        self.assertEqual(Match.objects.count(), 1)
+
 
 class PostSurveyAnswersTest(TestCase):
     def setUp(self):
@@ -694,6 +1620,245 @@ class PostSurveyAnswersTest(TestCase):
         self.assertEqual(len(NumericalResponse.objects.filter(user=self.user1)), 2)
         self.assertEqual(len(TextResponse.objects.filter(user=self.user1)), 1)
 
+    def post_survey_answers(self, responses):
+        request = APIRequestFactory().post(
+          path='post-survey-answers/',
+          data={
+            'email': self.user1.email,
+            'responses': responses,
+          },
+          format='json',
+        )
+        return PostSurveyAnswers.as_view()(request)
+
+    def test_resubmitted_survey_answers_should_replace_previous_responses(self):
+        TextQuestion.objects.create(base_question_id=0)
+        NumericalQuestion.objects.create(base_question_id=1)
+
+        self.post_survey_answers([
+          {'question_id': 0, 'answer': 'this'},
+          {'question_id': 1, 'answer': 1},
+        ])
+        response = self.post_survey_answers([
+          {'question_id': 0, 'answer': 'that'},
+          {'question_id': 1, 'answer': 4},
+          {'question_id': 2, 'answer': 'unknown question'},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+          list(TextResponse.objects.filter(user=self.user1).values_list('answer', flat=True)),
+          ['that'],
+        )
+        self.assertEqual(
+          list(NumericalResponse.objects.filter(user=self.user1).values_list('answer', flat=True)),
+          [4],
+        )
+
+    def test_survey_answers_use_fixed_number_of_queries(self):
+        NumericalQuestion.objects.create(base_question_id=0)
+        NumericalQuestion.objects.create(base_question_id=1)
+        NumericalQuestion.objects.create(base_question_id=2)
+        survey_catalog.get()
+
+        with CaptureQueriesContext(connection) as short_survey:
+            self.post_survey_answers([
+              {'question_id': 0, 'answer': 1},
+            ])
+        with CaptureQueriesContext(connection) as long_survey:
+            self.post_survey_answers([
+              {'question_id': 0, 'answer': 1},
+              {'question_id': 1, 'answer': 2},
+              {'question_id': 2, 'answer': 3},
+            ])
+
+        self.assertEqual(len(short_survey), len(long_survey))
+
+    def test_non_finite_survey_answer_should_be_rejected(self):
+        NumericalQuestion.objects.create(base_question_id=0)
+
+        response = self.post_survey_answers([
+          {'question_id': 0, 'answer': 'NaN'},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(NumericalResponse.objects.exists())
+        self.assertEqual(NumericalQuestion.objects.get().average, 3)
+
+    def test_out_of_range_survey_answer_should_be_rejected(self):
+        NumericalQuestion.objects.create(base_question_id=0)
+        NumericalQuestion.objects.create(base_question_id=1)
+
+        response = self.post_survey_answers([
+          {'question_id': 0, 'answer': 1},
+          {'question_id': 1, 'answer': '1e308'},
+        ])
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(NumericalResponse.objects.exists())
+
+
+class ResponseUpsertTest(TestCase):
+    def setUp(self):
+        self.user1 = random_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        self.user1.save()
+
+        BaseQuestion.objects.create(id=0)
+        BaseQuestion.objects.create(id=1)
+        self.numerical_question = NumericalQuestion.objects.create(base_question_id=0)
+        self.text_question = TextQuestion.objects.create(base_question_id=1)
+
+    def test_saving_response_twice_should_replace_answer(self):
+        first = NumericalResponse.objects.create(user=self.user1, question=self.numerical_question, answer=1)
+        second = NumericalResponse.objects.create(user=self.user1, question=self.numerical_question, answer=5)
+
+        responses = NumericalResponse.objects.filter(user=self.user1)
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0].answer, 5)
+        self.assertEqual(first.pk, second.pk)
+
+    def test_upsert_many_should_keep_last_answer_per_question(self):
+        with self.assertNumQueries(1):
+            responses = TextResponse.objects.upsert_many([
+              TextResponse(user=self.user1, question=self.text_question, answer='a'),
+              TextResponse(user=self.user1, question=self.text_question, answer='b'),
+            ])
+
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(TextResponse.objects.get(pk=responses[0].pk).answer, 'b')
+
+    def test_upsert_many_should_update_existing_answers(self):
+        TextResponse.objects.create(user=self.user1, question=self.text_question, answer='a')
+        TextResponse.objects.upsert_many([
+          TextResponse(user=self.user1, question=self.text_question, answer='c'),
+        ])
+
+        self.assertEqual(
+          list(TextResponse.objects.filter(user=self.user1).values_list('answer', flat=True)),
+          ['c'],
+        )
+
+    def test_posting_answer_again_should_replace_answer(self):
+        for answer in (1, 4):
+            request = APIRequestFactory().post(
+              path='numerical-responses/',
+              data={
+                'user': self.user1.id,
+                'question': self.numerical_question.id,
+                'answer': answer,
+              },
+              format='json',
+            )
+            response = NumericalResponseViewset.as_view({"post":"create"})(request)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        responses = NumericalResponse.objects.filter(user=self.user1)
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(response.data['id'], responses[0].id)
+        self.assertEqual(responses[0].answer, 4)
+
+
+class NumericalQuestionStatisticsTest(TestCase):
+    def setUp(self):
+        self.user1 = random_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        self.user2 = random_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        self.user1.save()
+        self.user2.save()
+
+        BaseQuestion.objects.create(id=0)
+        self.question = NumericalQuestion.objects.create(base_question_id=0)
+
+    def test_answers_should_update_average_and_variance(self):
+        NumericalResponse.objects.create(user=self.user1, question=self.question, answer=2)
+        NumericalResponse.objects.create(user=self.user2, question=self.question, answer=6)
+        self.question.refresh_from_db()
+
+        self.assertEqual(self.question.answer_count, 2)
+        self.assertEqual(self.question.average, 4)
+        self.assertEqual(self.question.variance, 4)
+
+    def test_overwritten_and_deleted_answers_should_be_reversed(self):
+        NumericalResponse.objects.create(user=self.user1, question=self.question, answer=2)
+        NumericalResponse.objects.create(user=self.user1, question=self.question, answer=5)
+        response = NumericalResponse.objects.create(user=self.user2, question=self.question, answer=1)
+        response.delete()
+        self.question.refresh_from_db()
+
+        self.assertEqual(self.question.answer_count, 1)
+        self.assertEqual(self.question.average, 5)
+        self.assertEqual(self.question.variance, 0)
+
+    def test_saving_question_should_not_overwrite_statistics(self):
+        NumericalResponse.objects.create(user=self.user1, question=self.question, answer=1)
+        self.question.maximum = 10
+        self.question.save()
+        self.question.refresh_from_db()
+
+        self.assertEqual(self.question.answer_count, 1)
+        self.assertEqual(self.question.average, 1)
+
+    def test_rebuild_statistics_should_match_responses(self):
+        NumericalResponse.objects.create(user=self.user1, question=self.question, answer=1)
+        NumericalResponse.objects.create(user=self.user2, question=self.question, answer=3)
+        NumericalQuestion.objects.update(answer_count=0, answer_sum=0, answer_sum_of_squares=0, average=0)
+
+        with self.assertNumQueries(1):
+            NumericalQuestion.rebuild_statistics()
+        self.question.refresh_from_db()
+
+        self.assertEqual(self.question.answer_count, 2)
+        self.assertEqual(self.question.average, 2)
+        self.assertEqual(self.question.variance, 1)
+
+    def test_upsert_many_should_write_in_question_order(self):
+        BaseQuestion.objects.create(id=1)
+        other_question = NumericalQuestion.objects.create(base_question_id=1)
+
+        responses = NumericalResponse.objects.upsert_many([
+          NumericalResponse(user=self.user1, question=other_question, answer=1),
+          NumericalResponse(user=self.user1, question=self.question, answer=1),
+        ])
+
+        self.assertEqual(
+          [response.question_id for response in responses],
+          sorted([self.question.id, other_question.id]),
+        )
+
+    def test_refresh_compatibility_vectors_should_follow_moved_averages(self):
+        NumericalResponse.objects.create(user=self.user1, question=self.question, answer=5)
+        NumericalResponse.objects.create(user=self.user2, question=self.question, answer=1)
+        User.objects.filter(id=self.user1.id).update(numerical_above=to_bytes(1 << self.question.id))
+        User.objects.filter(id=self.user2.id).update(numerical_above=to_bytes(0))
+        NumericalQuestion.objects.update(average=0)
+
+        self.assertEqual(User.refresh_compatibility_vectors(batch_size=1), 1)
+        self.assertEqual(User.refresh_compatibility_vectors(), 0)
+        self.user2.refresh_from_db()
+        self.assertEqual(from_bytes(self.user2.numerical_above), 1 << self.question.id)
+
+    @mock.patch('users.management.commands.refresh_compatibility_vectors.close_old_connections')
+    @mock.patch('users.management.commands.refresh_compatibility_vectors.time.sleep')
+    @mock.patch.object(User, 'refresh_compatibility_vectors')
+    def test_refresh_command_should_keep_refreshing_after_a_failure(self, refresh, sleep, _):
+        refresh.side_effect = [DatabaseError('connection lost'), 0]
+        sleep.side_effect = [None, KeyboardInterrupt]
+
+        with self.assertLogs('users.management.commands.refresh_compatibility_vectors'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('refresh_compatibility_vectors', interval=0)
+
+        self.assertEqual(refresh.call_count, 2)
+
+    def test_rebuild_command_should_reencode_compatibility_vectors(self):
+        NumericalResponse.objects.create(user=self.user1, question=self.question, answer=1)
+        NumericalResponse.objects.create(user=self.user2, question=self.question, answer=3)
+        User.objects.filter(id=self.user1.id).update(numerical_above=to_bytes(1 << self.question.id))
+
+        call_command('rebuild_answer_statistics', stdout=StringIO())
+        self.user1.refresh_from_db()
+
+        self.assertEqual(from_bytes(self.user1.numerical_above), 0)
+
 
 class DeleteAccountTest(TestCase):
     def setUp(self):
@@ -753,7 +1918,7 @@ class UpdateMatchAcceptanceTest(TestCase):
             'partner_id': self.user2.id,
           }
         )
-        response = AcceptMatch.as_view()(request)
+        response = async_to_sync(AcceptMatch.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(Match.objects.get(user1_id=self.user1.id).user1_accepted)
@@ -762,6 +1927,69 @@ class UpdateMatchAcceptanceTest(TestCase):
           Notification.objects.filter(user_id=self.user2.id).exists()
         )
 
+    def accept(self, user, partner):
+        request = APIRequestFactory().patch(
+          path='update-match-acceptance',
+          data={
+            'user_id': user.id,
+            'partner_id': partner.id,
+          }
+        )
+        return async_to_sync(AcceptMatch.as_view())(request)
+
+    def match_writes(self, queries) -> list:
+        return [
+          query['sql'] for query in queries
+          if query['sql'].startswith(('INSERT INTO "users_match"', 'UPDATE "users_match"'))
+        ]
+
+    def test_each_acceptance_is_one_write(self):
+        with CaptureQueriesContext(connection) as first_accept:
+            self.accept(self.user1, self.user2)
+        with CaptureQueriesContext(connection) as second_accept:
+            self.accept(self.user2, self.user1)
+
+        self.assertEqual(len(self.match_writes(first_accept.captured_queries)), 1)
+        self.assertEqual(len(self.match_writes(second_accept.captured_queries)), 1)
+        match = Match.objects.get()
+        self.assertTrue(match.user2_accepted and match.accept_notification_sent)
+
+    def test_accept_notifications_are_sent_once(self):
+        with mock.patch('users.models.MixpanelClient') as mixpanel:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.accept(self.user1, self.user2)
+                self.accept(self.user2, self.user1)
+                self.accept(self.user2, self.user1)
+
+        self.assertEqual(Notification.objects.filter(type=Notification.Choices.ACCEPT).count(), 2)
+        self.assertEqual(mixpanel.track.call_count, 2)
+
+    def test_creating_match_is_one_write(self):
+        Match.objects.all().delete()
+        Notification.objects.all().delete()
+
+        with mock.patch('users.models.MixpanelClient') as mixpanel:
+            with CaptureQueriesContext(connection) as create:
+                with self.captureOnCommitCallbacks() as callbacks:
+                    Match.objects.create(user1=self.user2, user2=self.user1)
+                self.assertFalse(mixpanel.track.called)
+            for callback in callbacks: callback()
+
+        self.assertEqual(len(self.match_writes(create.captured_queries)), 1)
+        self.assertEqual(Notification.objects.filter(type=Notification.Choices.MATCH).count(), 2)
+        self.assertEqual(mixpanel.track.call_count, 2)
+        match = Match.objects.get()
+        self.assertEqual(match.user1_id, self.user1.id)
+        self.assertTrue(match.initial_notification_sent)
+
+    def test_match_notifications_carry_the_match_id(self):
+        match = Match.objects.get()
+
+        self.assertEqual(
+          [notification.data['match_id'] for notification in Notification.objects.filter(type=Notification.Choices.MATCH)],
+          [match.id, match.id],
+        )
+
 
 class ForceCreateMatchTest(TestCase):
     def setUp(self):
@@ -793,6 +2021,119 @@ class ForceCreateMatchTest(TestCase):
         )
 
 
+class EventStreamTest(TransactionTestCase):
+    """ Test streaming committed messages and notifications """
+
+    def setUp(self):
+        self.user1 = random_user(1, User.SexChoices.MALE, User.SexChoices.FEMALE)
+        self.user2 = random_user(2, User.SexChoices.FEMALE, User.SexChoices.MALE)
+        self.user1.save()
+        self.user2.save()
+        self.listener = EventListener()
+        self.stream = EventStream(self.listener)
+
+    def tearDown(self):
+        self.listener.stop()
+
+    def request(self, headers) -> ApplicationCommunicator:
+        return ApplicationCommunicator(self.stream, {
+          'type': 'http',
+          'method': 'GET',
+          'path': '/events/',
+          'query_string': b'',
+          'headers': headers,
+        })
+
+    async def connect(self, user_id) -> ApplicationCommunicator:
+        token = await sync_to_async(Token.objects.get)(user_id=user_id)
+        communicator = self.request([
+          (b'host', b'testserver'),
+          (b'authorization', f'Token {token.key}'.encode()),
+        ])
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output(timeout=5)
+        self.assertEqual(start['status'], 200)
+        self.assertEqual((await communicator.receive_output(timeout=5))['body'], b': connected\n\n')
+        return communicator
+
+    async def next_event(self, communicator) -> str:
+        return (await communicator.receive_output(timeout=5))['body'].decode()
+
+    async def test_new_message_is_streamed_to_both_users(self):
+        sender_stream = await self.connect(self.user1.id)
+        receiver_stream = await self.connect(self.user2.id)
+
+        await sync_to_async(Message.objects.create)(sender=self.user1, receiver=self.user2, body='hi')
+
+        for communicator in (sender_stream, receiver_stream):
+            event = await self.next_event(communicator)
+            self.assertTrue(event.startswith('event: message\n'), event)
+            self.assertEqual(json.loads(event.split('data: ')[1])['body'], 'hi')
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(timeout=5)
+
+    async def test_queued_notification_is_streamed_to_its_user(self):
+        stream = await self.connect(self.user2.id)
+
+        await sync_to_async(Notification.objects.bulk_create)([
+          Notification(user=self.user2, type=Notification.Choices.MATCH, message='matched'),
+        ])
+
+        event = await self.next_event(stream)
+        self.assertTrue(event.startswith('event: notification\n'), event)
+        self.assertEqual(json.loads(event.split('data: ')[1])['message'], 'matched')
+        await stream.send_input({'type': 'http.disconnect'})
+        await stream.wait(timeout=5)
+
+    async def test_events_of_other_users_are_not_streamed(self):
+        self.stream.HEARTBEAT = .5
+        stream = await self.connect(self.user2.id)
+
+        await sync_to_async(Notification.objects.create)(
+          user=self.user1, type=Notification.Choices.MATCH, message='matched',
+        )
+
+        self.assertEqual(await self.next_event(stream), ': keepalive\n\n')
+        await stream.send_input({'type': 'http.disconnect'})
+        await stream.wait(timeout=5)
+
+    async def rejection_status(self, headers) -> int:
+        communicator = self.request(headers)
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        return (await communicator.receive_output(timeout=5))['status']
+
+    async def test_missing_token_is_rejected(self):
+        self.assertEqual(await self.rejection_status([(b'host', b'testserver')]), 401)
+
+    async def test_invalid_token_is_rejected(self):
+        self.assertEqual(await self.rejection_status([
+          (b'host', b'testserver'),
+          (b'authorization', b'Token invalid'),
+        ]), 401)
+
+    async def test_user_id_parameter_is_not_trusted(self):
+        communicator = ApplicationCommunicator(self.stream, {
+          'type': 'http',
+          'method': 'GET',
+          'path': '/events/',
+          'query_string': f'user_id={self.user1.id}'.encode(),
+          'headers': [(b'host', b'testserver')],
+        })
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+
+        self.assertEqual((await communicator.receive_output(timeout=5))['status'], 401)
+
+    async def test_disallowed_host_is_rejected(self):
+        token = await sync_to_async(Token.objects.get)(user_id=self.user1.id)
+
+        with self.settings(ALLOWED_HOSTS=['testserver']):
+            status_code = await self.rejection_status([
+              (b'host', b'attacker.example'),
+              (b'authorization', f'Token {token.key}'.encode()),
+            ])
+        self.assertEqual(status_code, 400)
+
+
 class MatchNotificationTest(TestCase):
     def setUp(self):
         self.user1 = random_user(1, 'f', 'm')
@@ -859,6 +2200,28 @@ class MatchNotificationTest(TestCase):
         self.assertEqual(len(payload.get('numerical_similarities')), 3)
         self.assertEqual(len(payload.get('text_similarities')), 0)
 
+    def test_initial_match_payloads_use_fixed_number_of_queries(self):
+        self.initialize_identical_responses()
+        match = Match.objects.create(user1=self.user1, user2=self.user2)
+        match = Match.objects.get(id=match.id)
+        survey_catalog.get()
+
+        with self.assertNumQueries(2):
+            match.initial_match_payload(self.user1, self.user2)
+            match.initial_match_payload(self.user2, self.user1)
+
+    def test_initial_match_payload_uses_answer_choice_emoji(self):
+        self.initialize_identical_responses()
+        TextAnswerChoice.objects.create(question_id=1, answer='a', emoji='🎉')
+        match = Match.objects.create(user1=self.user1, user2=self.user2)
+        payload = match.initial_match_payload(self.user1, self.user2)
+
+        emojis = {
+          similarity['shared_response']: similarity['emoji']
+          for similarity in payload.get('text_similarities')
+        }
+        self.assertEqual(emojis, {'a': '🎉', 'b': '❤️', 'c': '❤️'})
+
     def test_flip_initial_match_payload_returns_identical_average_compatibilities(self):
         match = Match.objects.create(user1=self.user1, user2=self.user2)
         payload1 = match.initial_match_payload(self.user2, self.user1)
@@ -872,6 +2235,55 @@ class MatchNotificationTest(TestCase):
         self.assertEqual(payload1.get('text_similarities'), payload2.get('text_similarities'))
 
 
+class SurveyCatalogTest(TestCase):
+    def setUp(self):
+        Category.objects.create(id=1, trait1='hi1', trait2='hi1')
+        BaseQuestion.objects.create(id=1, category_id=1)
+        BaseQuestion.objects.create(id=2, category_id=1)
+        NumericalQuestion.objects.create(id=1, base_question_id=1, average=2.5)
+        TextQuestion.objects.create(id=1, base_question_id=2)
+        TextAnswerChoice.objects.create(question_id=1, answer='a', emoji='🎉')
+
+    def test_catalog_resolves_averages_and_emojis(self):
+        catalog = survey_catalog.get()
+
+        self.assertEqual(catalog.average(1), 2.5)
+        self.assertEqual(catalog.emoji(1, 'a'), '🎉')
+        self.assertIsNone(catalog.emoji(1, 'b'))
+        self.assertEqual(catalog.text_questions[1].base_question.category.trait1, 'hi1')
+
+    def test_catalog_is_reused_between_lookups(self):
+        catalog = survey_catalog.get()
+
+        with self.assertNumQueries(0):
+            self.assertIs(survey_catalog.get(), catalog)
+
+    def test_saving_survey_metadata_invalidates_catalog(self):
+        catalog = survey_catalog.get()
+        Category.objects.filter(id=1).get().save()
+
+        self.assertIsNot(survey_catalog.get(), catalog)
+
+    def test_catalog_rebuilds_when_question_is_missing(self):
+        survey_catalog.get()
+        NumericalQuestion.objects.bulk_create([
+          NumericalQuestion(id=2, base_question_id=2, average=1),
+        ])
+
+        self.assertEqual(survey_catalog.get(numerical_question_ids=[2]).average(2), 1)
+
+    def test_catalog_rebuilds_when_shared_version_changes(self):
+        catalog = survey_catalog.get()
+        NumericalQuestion.objects.filter(id=1).update(average=4)
+        cache.set(survey_catalog.VERSION_KEY, uuid4().hex)
+
+        with mock.patch.object(survey_catalog, 'CHECK_INTERVAL', 0):
+            rebuilt = survey_catalog.get()
+
+        self.assertIsNot(rebuilt, catalog)
+        self.assertEqual(rebuilt.average(1), 4)
+
+
 class StopLocationSharingTest(TestCase):
     def setUp(self):
         self.user1 = random_user(1, 'f', 'm')
@@ -891,7 +2303,7 @@ class StopLocationSharingTest(TestCase):
           }
         )
 
-        response = StopLocationSharing.as_view()(request)
+        response = async_to_sync(StopLocationSharing.as_view())(request)
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(Notification.objects.filter(
@@ -901,6 +2313,167 @@ class StopLocationSharingTest(TestCase):
             type=Notification.Choices.STOP_SHARE,
             user_id=self.user2.id).exists())
 
+class FailingAPNSClient:
+    """ APNS client whose pushes always fail """
+
+    def push(self, messages) -> list:
+        raise ConnectionError('apns unavailable')
+
+
+class UnregisteredTokenAPNSClient(APNSTestClient):
+    """ APNS client that rejects one device token """
+
+    def __init__(self, token, reason='Unregistered') -> None:
+        self.token = token
+        self.reason = reason
+
+    def push(self, messages) -> list:
+        results = super().push(messages)
+        return [
+          self.reason if token == self.token else result
+          for (token, *_), result in zip(messages, results)
+        ]
+
+
+class NotificationDispatcherTest(TestCase):
+    def setUp(self):
+        self.user1 = random_user(1)
+        self.user1.save()
+        APNSDevice.objects.create(user=self.user1, registration_id='token1')
+
+        self.client = APNSTestClient()
+        self.client.sent.clear()
+
+        Notification.objects.bulk_create([
+          Notification(
+            user=self.user1,
+            type=Notification.Choices.STOP_SHARE,
+            message='message1',
+          ),
+          Notification(
+            user=self.user1,
+            type=Notification.Choices.STOP_SHARE,
+            message='message2',
+          ),
+        ])
+
+    def test_creating_notifications_does_not_send_them(self):
+        self.assertEqual(len(self.client.sent), 0)
+        self.assertEqual(Notification.objects.filter(is_sent=False).count(), 2)
+
+    def test_dispatch_sends_pending_notifications(self):
+        dispatched = NotificationDispatcher(self.client).dispatch_pending()
+
+        self.assertEqual(dispatched, 2)
+        self.assertEqual(len(self.client.sent), 2)
+        self.assertFalse(Notification.objects.filter(is_sent=False).exists())
+        self.assertEqual(NotificationDispatcher(self.client).dispatch_pending(), 0)
+
+    def test_failed_dispatch_is_retried_with_backoff(self):
+        dispatcher = NotificationDispatcher(FailingAPNSClient())
+
+        with self.assertLogs('users.dispatch', 'WARNING'):
+            self.assertEqual(dispatcher.dispatch_pending(), 2)
+        self.assertEqual(dispatcher.dispatch_pending(), 0)
+
+        for notification in Notification.objects.all():
+            self.assertFalse(notification.is_sent)
+            self.assertEqual(notification.attempts, 1)
+            self.assertGreater(notification.next_attempt_time, timezone.now())
+            self.assertIn('apns unavailable', notification.last_error)
+
+    def test_transient_device_failure_is_retried_on_that_device_only(self):
+        APNSDevice.objects.create(user=self.user1, registration_id='token2')
+        dispatcher = NotificationDispatcher(UnregisteredTokenAPNSClient('token2', 'ServiceUnavailable'))
+        dispatcher.dispatch_pending()
+
+        for notification in Notification.objects.all():
+            self.assertFalse(notification.is_sent)
+            self.assertEqual(notification.attempts, 1)
+            self.assertEqual(notification.retry_tokens, ['token2'])
+            self.assertIn('ServiceUnavailable', notification.last_error)
+
+        self.client.sent.clear()
+        Notification.objects.update(next_attempt_time=timezone.now())
+        self.assertEqual(NotificationDispatcher(self.client).dispatch_pending(), 2)
+
+        self.assertEqual([sent['token'] for sent in self.client.sent], ['token2', 'token2'])
+        self.assertFalse(Notification.objects.filter(is_sent=False).exists())
+        self.assertTrue(APNSDevice.objects.get(registration_id='token2').active)
+
+    def test_permanent_device_failure_counts_as_sent(self):
+        dispatcher = NotificationDispatcher(UnregisteredTokenAPNSClient('token1'))
+        dispatcher.dispatch_pending()
+
+        self.assertFalse(Notification.objects.filter(is_sent=False).exists())
+        self.assertIn('Unregistered', Notification.objects.first().last_error)
+
+    def test_dispatch_gives_up_after_max_attempts(self):
+        Notification.objects.update(attempts=NotificationDispatcher.MAX_ATTEMPTS)
+
+        self.assertEqual(NotificationDispatcher(self.client).dispatch_pending(), 0)
+        self.assertEqual(len(self.client.sent), 0)
+
+    @mock.patch('users.dispatch.close_old_connections')
+    @mock.patch('users.dispatch.time.sleep')
+    @mock.patch.object(NotificationDispatcher, 'dispatch_pending')
+    def test_run_keeps_dispatching_after_a_failure(self, dispatch_pending, sleep, _):
+        dispatch_pending.side_effect = [DatabaseError('connection lost'), 0]
+        sleep.side_effect = [None, KeyboardInterrupt]
+
+        with self.assertLogs('users.dispatch'):
+            with self.assertRaises(KeyboardInterrupt):
+                NotificationDispatcher(self.client).run(poll_interval=0)
+
+        self.assertEqual(dispatch_pending.call_count, 2)
+
+
+class SendToDevicesTest(TestCase):
+    def setUp(self):
+        self.user1 = random_user(1)
+        self.user2 = random_user(2)
+        self.user1.save()
+        self.user2.save()
+
+        APNSDevice.objects.create(user=self.user1, registration_id='token1a')
+        APNSDevice.objects.create(user=self.user1, registration_id='token1b')
+        APNSDevice.objects.create(user=self.user2, registration_id='token2')
+
+        self.notifications = Notification.objects.bulk_create([
+          Notification(user=self.user1, type=Notification.Choices.MATCH, message='message1'),
+          Notification(user=self.user2, type=Notification.Choices.MATCH, message='message2'),
+        ])
+
+        self.client = APNSTestClient()
+        self.client.sent.clear()
+
+    def test_send_to_devices_resolves_all_devices_in_one_query(self):
+        with self.assertNumQueries(1):
+            failures = Notification.send_to_devices(self.notifications, self.client)
+
+        self.assertEqual(failures, {})
+        self.assertEqual(
+          sorted((sent['token'], sent['alert']) for sent in self.client.sent),
+          [('token1a', 'message1'), ('token1b', 'message1'), ('token2', 'message2')],
+        )
+
+    def test_send_to_devices_reports_and_deactivates_unregistered_devices(self):
+        client = UnregisteredTokenAPNSClient('token1b')
+
+        failures = Notification.send_to_devices(self.notifications, client)
+
+        self.assertEqual(failures, {self.notifications[0].id: {'token1b': 'Unregistered'}})
+        self.assertFalse(APNSDevice.objects.get(registration_id='token1b').active)
+        self.assertTrue(APNSDevice.objects.get(registration_id='token1a').active)
+
+    def test_send_to_devices_skips_inactive_devices(self):
+        APNSDevice.objects.filter(registration_id='token2').update(active=False)
+
+        Notification.send_to_devices(self.notifications, self.client)
+
+        self.assertNotIn('token2', [sent['token'] for sent in self.client.sent])
+
+
 class QuestionViewsetTest(TestCase):
     def setUp(self):
         Category.objects.create(id=1, trait1='hi1', trait2='hi1')
@@ -936,6 +2509,51 @@ class QuestionViewsetTest(TestCase):
         self.assertTrue(response.data[0]['is_numerical'])
         self.assertFalse(response.data[-1]['is_numerical'])
 
+    def test_get_renders_questions_once(self):
+        request = APIRequestFactory().get(
+          path='questions/'
+        )
+        QuestionViewset.as_view({"get":"list"})(request).render()
+
+        with self.assertNumQueries(0):
+            response = QuestionViewset.as_view({"get":"list"})(request).render()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), response.data)
+        self.assertEqual(len(response.data), 6)
+
+    def test_get_with_matching_etag_returns_not_modified(self):
+        request = APIRequestFactory().get(
+          path='questions/'
+        )
+        response = QuestionViewset.as_view({"get":"list"})(request)
+
+        request = APIRequestFactory().get(
+          path='questions/',
+          HTTP_IF_NONE_MATCH=response['ETag'],
+        )
+        cached_response = QuestionViewset.as_view({"get":"list"})(request)
+
+        self.assertEqual(cached_response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(cached_response['ETag'], response['ETag'])
+
+    def test_get_after_question_change_returns_new_etag(self):
+        request = APIRequestFactory().get(
+          path='questions/'
+        )
+        response = QuestionViewset.as_view({"get":"list"})(request)
+        BaseQuestion.objects.filter(id=1).update(prompt='updated')
+        BaseQuestion.objects.get(id=1).save()
+
+        request = APIRequestFactory().get(
+          path='questions/',
+          HTTP_IF_NONE_MATCH=response['ETag'],
+        )
+        updated_response = QuestionViewset.as_view({"get":"list"})(request)
+
+        self.assertEqual(updated_response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(updated_response['ETag'], response['ETag'])
+
 class MessageViewsetTest(TestCase):
     def setUp(self):
         self.user1 = random_user(1)
@@ -954,6 +2572,10 @@ class MessageViewsetTest(TestCase):
           receiver=self.user1,
           body='message2'
         )
+
+    def tearDown(self):
+        """ Keeps these requests from counting towards the throttle of later tests """
+        cache.clear()
     
     def test_get_messages_with_user1_and_user2_returns_two_messages(self):
         request = APIRequestFactory().get(
@@ -964,3 +2586,106 @@ class MessageViewsetTest(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(len(response.data), 2)
 
+    def list_messages(self, query=''):
+        request = APIRequestFactory().get(
+          path=f'messages/?user1_id={self.user2.id}&user2_id={self.user1.id}{query}'
+        )
+        return MessageViewset.as_view({"get": "list"})(request)
+
+    def test_list_reads_sender_and_receiver_ids_in_one_query(self):
+        with self.assertNumQueries(1):
+            response = self.list_messages()
+
+        self.assertEqual(
+          [(message['sender_id'], message['receiver_id']) for message in response.data],
+          [(self.user1.id, self.user2.id), (self.user2.id, self.user1.id)],
+        )
+
+    def test_since_returns_only_newer_messages(self):
+        previous = Message.objects.order_by('timestamp').last()
+        latest = Message.objects.create(
+          sender=self.user1,
+          receiver=self.user2,
+          body='message3',
+          timestamp=previous.timestamp + 1,
+        )
+
+        self.assertEqual(self.list_messages(f'&since={latest.timestamp}').data, [])
+        self.assertEqual(
+          [message['body'] for message in self.list_messages(f'&since={previous.timestamp}').data],
+          ['message3'],
+        )
+
+    def test_since_returns_newer_messages_oldest_first(self):
+        first = Message.objects.order_by('timestamp').first()
+
+        self.assertEqual(
+          [message['body'] for message in self.list_messages(f'&since={first.timestamp - 1}').data],
+          ['message1', 'message2'],
+        )
+
+    def test_limit_pages_through_conversation_by_cursor(self):
+        first_page = self.list_messages('&limit=1')
+        self.assertEqual([message['body'] for message in first_page.data['results']], ['message2'])
+
+        request = APIRequestFactory().get(first_page.data['next'])
+        second_page = MessageViewset.as_view({"get": "list"})(request)
+
+        self.assertEqual([message['body'] for message in second_page.data['results']], ['message1'])
+        self.assertIsNone(second_page.data['next'])
+
+    def test_conversation_query_uses_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = Message.objects.conversation(self.user2.id, self.user1.id).explain()
+
+        self.assertIn('message_conversation_idx', plan, plan)
+
+    def test_expired_messages_are_not_listed(self):
+        Message.objects.create(
+          sender=self.user1,
+          receiver=self.user2,
+          body='expired',
+          timestamp=timezone.now().timestamp() - Message.RETENTION.total_seconds() - 1,
+        )
+        request = APIRequestFactory().get(
+          path=f'messages/?user1_id={self.user1.id}&user2_id={self.user2.id}'
+        )
+        response = MessageViewset.as_view({"get": "list"})(request)
+
+        self.assertEqual(
+          sorted(message['body'] for message in response.data),
+          ['message1', 'message2'],
+        )
+
+    def test_sending_message_is_one_insert(self):
+        with self.assertNumQueries(1):
+            Message.objects.create(sender=self.user1, receiver=self.user2, body='message3')
+
+    def test_purge_expired_deletes_only_expired_messages_in_batches(self):
+        expired_timestamp = timezone.now().timestamp() - Message.RETENTION.total_seconds() - 1
+        Message.objects.bulk_create([
+          Message(sender=self.user1, receiver=self.user2, body='expired', timestamp=expired_timestamp)
+          for _ in range(5)
+        ])
+
+        self.assertEqual(Message.objects.purge_expired(batch_size=2), 5)
+
+        self.assertEqual(
+          sorted(Message.objects.values_list('body', flat=True)),
+          ['message1', 'message2'],
+        )
+
+    @mock.patch('users.management.commands.purge_messages.close_old_connections')
+    @mock.patch('users.management.commands.purge_messages.time.sleep')
+    @mock.patch.object(Message.objects, 'purge_expired')
+    def test_purge_command_keeps_purging_after_a_failure(self, purge_expired, sleep, _):
+        purge_expired.side_effect = [DatabaseError('connection lost'), 0]
+        sleep.side_effect = [None, KeyboardInterrupt]
+
+        with self.assertLogs('users.management.commands.purge_messages'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('purge_messages', interval=0)
+
+        self.assertEqual(purge_expired.call_count, 2)
+
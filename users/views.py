@@ -1,8 +1,13 @@
 """ Defines API for Users """
+import math
 import os
 
-from django.db.models import Q, Count
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.core.mail import send_mail
+from django.http import JsonResponse
 from django.forms import ValidationError
 from django.utils import timezone
 from rest_framework import status, viewsets
@@ -12,7 +17,13 @@ from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.authtoken.models import Token
 
-from users.models import EmailAuthentication, Match, Notification, NumericalQuestion, NumericalResponse, PhoneAuthentication, BaseQuestion, TextQuestion, TextResponse, User, WaitingEmail
+from users.async_views import AsyncAPIView
+from users.location_buffer import location_buffer
+from users.location_index import location_index
+from users.match_history import match_history
+from users.matching import MatchScorer
+from users import spatial
+from users.models import EmailAuthentication, Match, MatchArchive, Notification, NumericalResponse, PhoneAuthentication, BaseQuestion, TextResponse, User, WaitingEmail
 
 import sys
 sys.path.append(".")
@@ -382,42 +393,56 @@ class PostSurveyAnswers(CreateAPIView):
               status.HTTP_400_BAD_REQUEST,
             )
         user_match = user_matches[0]
-        
-        for q_response in q_responses:
-            question_id = q_response.get('question_id')
-            answer = q_response.get('answer')
-
-            questions = BaseQuestion.objects.filter(id=question_id).prefetch_related(
-              'numerical_question', 
-              'text_question',
-            )
 
-            if not questions.exists():
-                continue
+        answers = {}
+        for q_response in q_responses:
+            answers[q_response.get('question_id')] = q_response.get('answer')
 
-            question = questions[0]
+        questions = BaseQuestion.objects.filter(id__in=answers).select_related(
+          'numerical_question',
+          'text_question',
+        )
 
-            numerical_questions = NumericalQuestion.objects.filter(base_question_id=question.id)
-            text_questions = TextQuestion.objects.filter(base_question_id=question.id)
+        numerical_responses = {}
+        text_responses = {}
+        for question in questions:
+            answer = answers[question.id]
 
-            if numerical_questions.exists():
-                numerical_question = numerical_questions[0]
+            if hasattr(question, 'numerical_question'):
+                numerical_question = question.numerical_question
                 try:
-                    NumericalResponse.objects.create(
-                      question_id=numerical_question.id,
-                      answer=float(answer),
-                      user=user_match,
-                    )
-                except:
-                    continue
-            
-            if text_questions.exists():
-                text_question = text_questions[0]
-                TextResponse.objects.create(
-                  question_id=text_question.id,
-                  answer=answer,
-                  user=user_match,
-                )
+                    value = float(answer)
+                except ValueError:
+                    pass
+                else:
+                    if not (
+                      math.isfinite(value) and
+                      numerical_question.minimum <= value <= numerical_question.maximum
+                    ):
+                        return Response(
+                          {
+                            'responses': [
+                              f'answer to question {question.id} must be between '
+                              f'{numerical_question.minimum:g} and {numerical_question.maximum:g}'
+                            ]
+                          },
+                          status.HTTP_400_BAD_REQUEST,
+                        )
+                    numerical_responses[numerical_question.id] = value
+
+            if hasattr(question, 'text_question'):
+                text_responses[question.text_question.id] = answer
+
+        with transaction.atomic():
+            NumericalResponse.objects.upsert_many([
+              NumericalResponse(question_id=question_id, answer=answer, user=user_match)
+              for question_id, answer in numerical_responses.items()
+            ])
+            TextResponse.objects.upsert_many([
+              TextResponse(question_id=question_id, answer=answer, user=user_match)
+              for question_id, answer in text_responses.items()
+            ])
+            user_match.refresh_compatibility_vector()
         
         return Response(survey_request.data, status.HTTP_201_CREATED)
 
@@ -450,7 +475,7 @@ class UpdateLocationSerializer(ModelSerializer):
           'is_encrypted',
         )
 
-class UpdateLocation(UpdateAPIView):
+class UpdateLocation(AsyncAPIView):
     """ List nearby users to a location """
     throttle_class = 'location'
     serializer_class = UpdateLocationSerializer
@@ -459,9 +484,9 @@ class UpdateLocation(UpdateAPIView):
     def decrypt(self, coordinate):
         return coordinate - float(os.environ['LOCATION_KEY'])
 
-    def update(self, request, *args, **kwargs):
-        location_request = UpdateLocationSerializer(data=request.data)
-        location_request.is_valid(raise_exception=True)
+    async def put(self, request, *args, **kwargs):
+        location_request, error = self.validate(request)
+        if error: return error
 
         email = location_request.data.get('email')
         latitude = location_request.data.get('latitude')
@@ -475,161 +500,75 @@ class UpdateLocation(UpdateAPIView):
             latitude = float(latitude)
             longitude = float(longitude)
 
-        updated_users = User.objects.filter(email=email)\
-          .prefetch_related('numerical_responses', 'text_responses')
-        updated_users.update(
-          latitude=latitude,
-          longitude=longitude,
-          loc_update_time=timezone.now()
-        )
-
-        if not updated_users.exists():
-            return Response(
+        updated_user = await User.objects.filter(email=email).afirst()
+        if not updated_user:
+            return JsonResponse(
               {
                 'email': ['email not found'],
               },
-              status.HTTP_400_BAD_REQUEST,
+              status=status.HTTP_400_BAD_REQUEST,
             )
 
-        updated_user = updated_users[0]
+        updated_user.latitude = latitude
+        updated_user.longitude = longitude
+        updated_user.loc_update_time = timezone.now()
+        await sync_to_async(location_buffer.record)(updated_user)
+        location_index.update_user(updated_user)
 
-        if updated_user.is_matchable:
-            self.match_with_nearby_users(updated_user, latitude, longitude)
+        if updated_user.is_matchable and settings.INLINE_MATCHING:
+            await sync_to_async(self.match_with_nearby_users)(updated_user, latitude, longitude)
 
-        return Response(
+        return JsonResponse(
           location_request.data,
-          status.HTTP_200_OK,
-        )
-      
-    def filter_compatible_users(self, user, nearby_users, 
-        minimum_shared_numerical=1, minimum_shared_text=1):
-
-        try: user.numerical_responses
-        except: user.numerical_responses = NumericalResponse.objects.filter(user=user)
-
-        try: user.text_responses
-        except: user.text_responses = TextResponse.objects.filter(user=user)
-
-        compatible_numerical_responses = Q()
-        compatible_text_responses = Q()
-
-        # either both above average or below average        
-        for response in user.numerical_responses.all():
-            compatible_numerical_responses |= (
-              (
-                Q(numerical_responses__question_id=response.question_id)&
-                Q(numerical_responses__question__average__lte=response.answer)&
-                Q(numerical_responses__answer__lte=response.answer)
-              ) | (
-                Q(numerical_responses__question_id=response.question_id)&
-                Q(numerical_responses__question__average__gte=response.answer)&
-                Q(numerical_responses__answer__gte=response.answer)
-              )
-            )
-
-        age_restriction = Q()
-        for response in user.text_responses.all():
-            compatible_text_responses |= (
-              Q(text_responses__question_id=response.question_id)&
-              Q(text_responses__answer=response.answer)
-            )
-            if response.answer == "freshman" or response.answer == "graduate":
-                age_restriction = (
-                  Q(text_responses__answer=response.answer)
-                )
-            else:
-                age_restriction = (
-                  ~Q(text_responses__answer="freshman")&
-                  ~Q(text_responses__answer="graduate")
-                )
-
-        compatible_numerical_count = Count(
-          'numerical_responses', 
-          filter=compatible_numerical_responses
-        )
-        compatible_text_count = Count(
-          'text_responses', 
-          filter=compatible_text_responses
+          status=status.HTTP_200_OK,
         )
 
-        return nearby_users.annotate(
-          compatible_numerical_count=compatible_numerical_count,
-          compatible_text_count=compatible_text_count,
-        ).filter(
-          compatible_numerical_count__gte=minimum_shared_numerical,
-          compatible_text_count__gte=minimum_shared_text,
-        ).filter(age_restriction)
+    patch = put
 
     def match_with_nearby_users(self, user, latitude, longitude) -> None:
         """ 
         Check if the match window has not expired. 
         If not, match with a nearby user. 
         """
-        past_matches = Q(user1=user) | Q(user2=user)
-        unexpired_matches = Match.objects.filter(
-            past_matches&
-            Q(time__gte=timezone.now()-timezone.timedelta(days=1))
-        )
-        if unexpired_matches.exists(): return
+        now = timezone.now()
+        if user.has_active_match(now): return
 
-        within_latitude = (
-          Q(latitude__isnull=False)&
-          Q(latitude__lte=latitude+.001)&
-          Q(latitude__gte=latitude-.001)
-        )
-        within_longitude = (
-          Q(longitude__isnull=False)&
-          Q(longitude__lte=longitude+.001)&
-          Q(longitude__gte=longitude-.001)
-        )
-        not_current_user = (
-          ~Q(pk=user.pk)
-        )
-        sexually_preferred = (
+        eligible_users = User.objects.filter(
           Q(sex_identity=user.sex_preference)&
-          Q(sex_preference=user.sex_identity)
-        )
-        not_matched_before = (
-          ~Q(match1__user1=user)&
-          ~Q(match1__user2=user)&
-          ~Q(match2__user1=user)&
-          ~Q(match2__user2=user)
-        )
-        recent_update = (
-          Q(loc_update_time__lte=timezone.now())&
-          Q(loc_update_time__gte=timezone.now()-timezone.timedelta(minutes=15))
-        )
-        is_matchable = (
+          Q(sex_preference=user.sex_identity)&
           Q(is_matchable=True)&
-          ~Q(match1__time__gte=timezone.now()-timezone.timedelta(days=1))&
-          ~Q(match2__time__gte=timezone.now()-timezone.timedelta(days=1))
-        )
-
-        nearby_users = User.objects.filter(
-          within_latitude&
-          within_longitude&
-          not_current_user&
-          sexually_preferred&
-          not_matched_before&
-          recent_update&
-          is_matchable
+          (Q(active_match_expires_at__isnull=True) | Q(active_match_expires_at__lte=now))
         )
 
-        if not nearby_users.exists(): return
-
-        compatible_users = self.filter_compatible_users(
-          user=user,
-          nearby_users=nearby_users
-        )
+        if settings.USE_POSTGIS:
+            recently_located = Q(loc_update_time__gte=now-location_index.MAX_AGE)
+            nearby_users = spatial.nearest(
+              eligible_users.filter(recently_located).exclude(pk=user.pk),
+              latitude,
+              longitude,
+              limit=MatchScorer.MAX_CANDIDATES,
+            )
+        else:
+            nearby_ids = location_index.nearby(latitude, longitude, exclude=user.pk)
+            if not nearby_ids: return
+            nearby_users = eligible_users.filter(
+              pk__in=nearby_ids,
+            ).order_by('-loc_update_time', 'id')[:MatchScorer.MAX_CANDIDATES]
+        nearby_users = location_buffer.overlay(list(nearby_users))
+
+        history = match_history.get(user.pk)
+        nearby_users = [
+          nearby_user for nearby_user in nearby_users
+          if not history.has_matched(nearby_user.pk)
+        ]
 
-        if not compatible_users.exists(): return
-        
-        compatible_user = compatible_users[0]
+        ranked_candidates = MatchScorer(user, latitude, longitude).rank(nearby_users, k=len(nearby_users))
+        for candidate in ranked_candidates:
+            if Match.objects.claim(user, candidate.user, now): return
+            match_history.invalidate(user.pk, candidate.user.pk)
 
-        Match.objects.create(
-          user1=user,
-          user2=compatible_user,
-        )
+            user.refresh_from_db(fields=['active_match', 'active_match_expires_at'])
+            if user.has_active_match(now): return
 
 
 # Delete Account
@@ -690,42 +629,40 @@ class AcceptMatchSerializer(Serializer):
     user_id = IntegerField()
     partner_id = IntegerField()
 
-class AcceptMatch(UpdateAPIView):
+class AcceptMatch(AsyncAPIView):
     """ Updates Match to reflect match acceptance """
     serializer_class = AcceptMatchSerializer
     permission_class = [AllowAny, ]
 
-    def update(self, request, *args, **kwargs):
-        update_request = AcceptMatchSerializer(data=request.data)
-        update_request.is_valid(raise_exception=True)
+    async def patch(self, request, *args, **kwargs):
+        update_request, error = self.validate(request)
+        if error: return error
 
         user_id = update_request.data.get('user_id')
         partner_id = update_request.data.get('partner_id')
+        await sync_to_async(self.accept)(user_id, partner_id)
 
-        # user1_id, user2_id = sorted([user_id, partner_id])
-        user_firsts = Match.objects.filter(
-          user1_id=user_id,
-          user2_id=partner_id,
-        )
-        user_seconds = Match.objects.filter(
-          user1_id=partner_id,
-          user2_id=user_id,
+        return JsonResponse(
+          update_request.data,
+          status=status.HTTP_200_OK,
         )
-        
-        if user_firsts.exists():
-            user_first = user_firsts[0]
-            user_first.user1_accepted = True
-            user_first.save()
 
-        elif user_seconds.exists():
-            user_second = user_seconds[0]
-            user_second.user2_accepted = True
-            user_second.save()
+    put = patch
 
-        return Response(
-          update_request.data,
-          status.HTTP_200_OK,
-        )
+    def accept(self, user_id, partner_id) -> None:
+        """ Marks the user's side of their match with the partner as accepted """
+        with transaction.atomic():
+            match = Match.objects.select_for_update(of=('self',)).filter(
+              Q(user1_id=user_id, user2_id=partner_id) |
+              Q(user1_id=partner_id, user2_id=user_id)
+            ).select_related('user1', 'user2').first()
+
+            if match and match.user1_id == user_id:
+                match.user1_accepted = True
+                match.save()
+            elif match:
+                match.user2_accepted = True
+                match.save()
 
 
 class GetPageOrder(ListAPIView):
@@ -749,9 +686,11 @@ class ForceCreateMatch(CreateAPIView):
         user1_id = match_request.data.get('user1_id')
         user2_id = match_request.data.get('user2_id')
 
-        Match.objects.filter(user1_id=user1_id, user2_id=user2_id).delete()
-        Match.objects.filter(user1_id=user2_id, user2_id=user1_id).delete()
-        Match.objects.create(user1_id=user1_id, user2_id=user2_id)
+        with transaction.atomic():
+            for model in (Match, MatchArchive):
+                model.objects.filter(user1_id=user1_id, user2_id=user2_id).delete()
+                model.objects.filter(user1_id=user2_id, user2_id=user1_id).delete()
+            Match.objects.create(user1_id=user1_id, user2_id=user2_id)
 
         return Response(
           match_request.data,
@@ -763,16 +702,16 @@ class StopLocationSharingSerializer(Serializer):
     user_id = IntegerField()
     partner_id = IntegerField()
 
-class StopLocationSharing(CreateAPIView):
+class StopLocationSharing(AsyncAPIView):
     serializer_class = StopLocationSharingSerializer
-    def create(self, request, *args, **kwargs):
-        stop_location_request = StopLocationSharingSerializer(data=request.data)
-        stop_location_request.is_valid(raise_exception=True)
+    async def post(self, request, *args, **kwargs):
+        stop_location_request, error = self.validate(request)
+        if error: return error
 
         user_id = stop_location_request.data.get('user_id')
         partner_id = stop_location_request.data.get('partner_id')
 
-        Notification.objects.bulk_create([
+        await Notification.objects.abulk_create([
           Notification(
             user_id=user_id,
             type=Notification.Choices.STOP_SHARE,
@@ -791,7 +730,7 @@ class StopLocationSharing(CreateAPIView):
           ),
         ])
 
-        return Response(
+        return JsonResponse(
           stop_location_request.data,
-          status.HTTP_201_CREATED,
+          status=status.HTTP_201_CREATED,
         )
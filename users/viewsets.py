@@ -1,9 +1,18 @@
 """ Defines REST viewsets for all models """
-from django.db.models import Q
-from rest_framework import viewsets
+from hashlib import sha1
+from operator import itemgetter
+
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status, viewsets
 from rest_framework.permissions import AllowAny
-from rest_framework.serializers import ModelSerializer, SerializerMethodField, IntegerField
-from users.models import Category, Interest, NumericalQuestion, TextAnswerChoice, TextQuestion, User, Match, BaseQuestion, NumericalResponse, TextResponse, WaitingEmail, BannedEmail, Message
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.pagination import CursorPagination
+from rest_framework.serializers import FloatField, IntegerField, ModelSerializer, Serializer, SerializerMethodField
+from users.survey_catalog import survey_catalog
+from users.models import Category, Interest, NumericalQuestion, TextAnswerChoice, TextQuestion, User, Match, MatchArchive, BaseQuestion, NumericalResponse, TextResponse, WaitingEmail, BannedEmail, Message, Notification
 
 
 """ Serializers """
@@ -31,6 +40,12 @@ class MatchSerializer(ModelSerializer):
         model = Match
         fields = '__all__'
 
+class MatchArchiveSerializer(ModelSerializer):
+    class Meta:
+        """ JSON fields from MatchArchive """
+        model = MatchArchive
+        fields = '__all__'
+
 class WaitingEmailSerializer(ModelSerializer):
     class Meta:
         """ JSON fields from WaitingEmail """
@@ -53,16 +68,17 @@ class QuestionSerializer(ModelSerializer):
         model = BaseQuestion
         fields = '__all__'
 
+    def catalog(self):
+        return self.context.get('catalog') or survey_catalog.get()
+
     def get_is_numerical(self, obj):
-        return NumericalQuestion.objects.\
-            filter(base_question_id=obj.id).exists()
+        return obj.id in self.catalog().numerical_questions_by_base
     
     def get_is_multiple_answer(self, obj):
-        text_questions = TextQuestion.objects.\
-            filter(base_question_id=obj.id)
-        if not text_questions.exists():
+        text_question = self.catalog().text_questions_by_base.get(obj.id)
+        if not text_question:
             return False
-        return text_questions[0].is_multiple_answer
+        return text_question.is_multiple_answer
 
     def hard_programmed_answers(self, question):
         if question.base_question.category.trait1 == "year":
@@ -70,19 +86,17 @@ class QuestionSerializer(ModelSerializer):
         return None
 
     def get_text_answer_choices(self, obj):
-        text_questions = TextQuestion.objects.\
-            filter(base_question_id=obj.id).\
-            prefetch_related('text_answer_choices')
-        if not text_questions.exists():
+        catalog = self.catalog()
+        text_question = catalog.text_questions_by_base.get(obj.id)
+        if not text_question:
             return []
-        text_question = text_questions[0]
         programmed_answers = self.hard_programmed_answers(text_question)
         if programmed_answers:
             return programmed_answers
         text_answer_choices = [
             text_answer_choice.answer 
             for text_answer_choice in 
-            text_question.text_answer_choices.all()
+            catalog.answer_choices[text_question.id]
         ]
         prefix_list = []
         suffix_list = []
@@ -122,26 +136,36 @@ class NumericalResponseSerializer(ModelSerializer):
         """ JSON fields from NumericalResponse """
         model = NumericalResponse
         fields = '__all__'
+        # Answering a question again replaces the previous answer
+        validators = []
 
 class TextResponseSerializer(ModelSerializer):
     class Meta:
         """ JSON fields from TextResponse """
         model = TextResponse
         fields = '__all__'
+        # Answering a question again replaces the previous answer
+        validators = []
 
 class MessageSerializer(ModelSerializer):
-    sender_id = SerializerMethodField()
-    receiver_id = SerializerMethodField()
+    sender_id = IntegerField(read_only=True)
+    receiver_id = IntegerField(read_only=True)
 
     class Meta:
         model = Message
         fields = '__all__'
 
-    def get_sender_id(self, obj):
-        return obj.sender.id
-    
-    def get_receiver_id(self, obj):
-        return obj.receiver.id
+class NotificationSerializer(ModelSerializer):
+    class Meta:
+        """ JSON fields from Notification shown to its user """
+        model = Notification
+        fields = ('id', 'user', 'type', 'message', 'data', 'time')
+
+class ConversationQuerySerializer(Serializer):
+    """ MessageViewset query parameters """
+    user1_id = IntegerField()
+    user2_id = IntegerField()
+    since = FloatField(required=False)
 
 class InterestSerializer(ModelSerializer):
     class Meta:
@@ -149,6 +173,23 @@ class InterestSerializer(ModelSerializer):
         model = Interest
         fields = '__all__'
 
+""" Responses """
+
+
+class PrerenderedResponse(Response):
+    """ Response whose JSON body was rendered ahead of time """
+
+    def __init__(self, data, content, **kwargs):
+        super().__init__(data, **kwargs)
+        self.prerendered_content = content
+
+    @property
+    def rendered_content(self):
+        if not isinstance(self.accepted_renderer, JSONRenderer):
+            return super().rendered_content
+        self['Content-Type'] = self.accepted_renderer.media_type
+        return self.prerendered_content
+
 """ Viewsets """
 
 
@@ -179,11 +220,25 @@ class BannedEmailViewset(viewsets.ModelViewSet):
 class MatchViewset(viewsets.ModelViewSet):
     """
     A viewset for viewing and editing match instances.
+    Expired matches the sweeper moved to the archive are still listed
+    and retrieved, keeping their ids, but can no longer be edited.
     """
     serializer_class = MatchSerializer
     permission_class = [AllowAny, ]
     queryset = Match.objects.all()
 
+    def list(self, request, *args, **kwargs):
+        matches = MatchSerializer(self.get_queryset(), many=True).data
+        archived_matches = MatchArchiveSerializer(MatchArchive.objects.all(), many=True).data
+        return Response(sorted(matches + archived_matches, key=itemgetter('id')))
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            archived_match = get_object_or_404(MatchArchive, pk=kwargs['pk'])
+            return Response(MatchArchiveSerializer(archived_match).data)
+
 class CategoryViewset(viewsets.ModelViewSet):
     serializer_class = CategorySerializer
     permission_class = [AllowAny, ]
@@ -197,17 +252,40 @@ class QuestionViewset(viewsets.ModelViewSet):
     permission_class = [AllowAny, ]
     queryset = BaseQuestion.objects.all()
 
-    def list(self, *args, **kwargs):
-        response = super().list(*args, **kwargs)
+    """ Rendered question list of the current survey catalog """
+    rendered_list = None
+
+    def render_list(self, catalog) -> tuple:
+        """ Serializes the catalog's questions once, numerical questions first """
+        questions = QuestionSerializer(
+          catalog.base_questions.values(),
+          many=True,
+          context={'catalog': catalog},
+        ).data
         numerical_questions = []
         text_questions = []
-        for question in response.data:
+        for question in questions:
             if question.get('is_numerical'):
                 numerical_questions.append(question)
             else:
                 text_questions.append(question)
-        response.data = numerical_questions + text_questions
-        return response
+        data = numerical_questions + text_questions
+
+        content = JSONRenderer().render(data)
+        etag = quote_etag(sha1(content).hexdigest())
+        return catalog.version, data, content, etag
+
+    def list(self, request, *args, **kwargs):
+        catalog = survey_catalog.get()
+        rendered_list = QuestionViewset.rendered_list
+        if not rendered_list or rendered_list[0] != catalog.version:
+            rendered_list = self.render_list(catalog)
+            QuestionViewset.rendered_list = rendered_list
+        _, data, content, etag = rendered_list
+
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return PrerenderedResponse(data, content, headers={'ETag': etag})
 
 class TextQuestionViewset(viewsets.ModelViewSet):
     """
@@ -247,27 +325,40 @@ class TextResponseViewset(viewsets.ModelViewSet):
     permission_class = [AllowAny, ]
     queryset = TextResponse.objects.all()
 
+class MessagePagination(CursorPagination):
+    """
+    Keyset pagination over a conversation, newest first. Only applies
+    when a limit is given, so unpaginated clients keep getting a list.
+    """
+    ordering = '-timestamp'
+    page_size = None
+    page_size_query_param = 'limit'
+    max_page_size = 100
+
 class MessageViewset(viewsets.ModelViewSet):
     """
     A viewset for viewing and editing message instances.
+    Lists the conversation between user1_id and user2_id oldest first,
+    only the messages after the since timestamp when it is given. Pages
+    requested with a limit run newest first.
     """
     serializer_class = MessageSerializer
     permission_class = [AllowAny, ]
+    pagination_class = MessagePagination
     queryset = Message.objects.all()
 
     def get_queryset(self, *args, **kwargs):
-        user1_id = self.request.query_params.get('user1_id')
-        user2_id = self.request.query_params.get('user2_id')
-
-        return Message.objects.filter(
-            (
-                Q(sender=user1_id)&
-                Q(receiver=user2_id)
-            ) | (
-                Q(receiver=user1_id)&
-                Q(sender=user2_id)
-            )  
+        query = ConversationQuerySerializer(data=self.request.query_params)
+        if not query.is_valid(): return Message.objects.none()
+
+        messages = Message.objects.conversation(
+          query.validated_data['user1_id'],
+          query.validated_data['user2_id'],
         )
+        since = query.validated_data.get('since')
+        if since is not None:
+            messages = messages.filter(timestamp__gt=since)
+        return messages.order_by('timestamp')
         
 class InterestViewset(viewsets.ModelViewSet):
     """